@@ -1,34 +1,88 @@
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import update_last_login
 from django.contrib.auth.password_validation import validate_password
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
 from django.utils.translation import gettext as _
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
 
-from subscription.models import UserProfile, SystemUser, Customer
+from subscription.models import UserProfile, SystemUser, Customer, RevokedToken
+from subscription.utils.entitlements import TOKEN_CLAIM, get_token_claims, token_claims_enabled
+from subscription.utils.revocation import check_not_revoked, set_issued_at
+
+
+def get_access_token(refresh: RefreshToken, user_id: int) -> AccessToken:
+    """ Gera o token de acesso a partir do refresh, com as entitlements do usuário se
+    SUBSCRIPTION_JWT_ENTITLEMENT_CLAIMS estiver ligado. Elas vão só no token de acesso, já que o refresh vive muito mais
+    e as entitlements são recalculadas a cada refresh """
+    access = refresh.access_token
+    if token_claims_enabled():
+        claims = get_token_claims(user_id)
+        if claims is not None:
+            access[TOKEN_CLAIM] = claims
+    return access
 
 
 class ModifiedTokenObtainPairSerializer(TokenObtainPairSerializer):
 
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        set_issued_at(token)
+        return token
+
     def validate(self, attrs):
-        data = super().validate(attrs)
-        # adicionando o campo expires_in
+        # autentica o usuário (TokenObtainSerializer.validate) e gera o par de tokens uma única vez
+        data = super(TokenObtainPairSerializer, self).validate(attrs)
         refresh = self.get_token(self.user)
-        data['expires_in'] = int(refresh.access_token.lifetime.total_seconds())
+        access = get_access_token(refresh, self.user.id)
+        data['refresh'] = str(refresh)
+        data['access'] = str(access)
+        # adicionando o campo expires_in
+        data['expires_in'] = int(access.lifetime.total_seconds())
+        if api_settings.UPDATE_LAST_LOGIN:
+            update_last_login(None, self.user)
         return data
 
 
 class ModifiedTokenRefreshSerializer(TokenRefreshSerializer):
 
     def validate(self, attrs):
+        # mesma lógica do TokenRefreshSerializer.validate, mas decodificando o refresh uma única vez
+        refresh = self.token_class(attrs['refresh'])
+        check_not_revoked(refresh)
+        access = get_access_token(refresh, refresh[api_settings.USER_ID_CLAIM])
+        data = {'access': str(access)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                try:
+                    refresh.blacklist()
+                except AttributeError:
+                    # app de blacklist não instalado
+                    pass
+                # o refresh antigo também vai pra lista de revogados, que é verificada sem ir ao BD
+                RevokedToken.revoke_tokens([refresh])
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            set_issued_at(refresh)
+            data['refresh'] = str(refresh)
         # adicionando o campo expires_in
-        data = super().validate(attrs)
-        refresh = RefreshToken(attrs['refresh'])
-        data['expires_in'] = int(refresh.access_token.lifetime.total_seconds())
+        data['expires_in'] = int(access.lifetime.total_seconds())
         return data
 
 
+class LogoutSerializer(serializers.Serializer):
+    refresh = serializers.CharField()
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        check_not_revoked(refresh)
+        return {'refresh': refresh}
+
+
 class RegisterSerializer(serializers.ModelSerializer):
     email = serializers.EmailField(required=True, validators=[UniqueValidator(
         queryset=get_user_model().objects.all())])
@@ -1,10 +1,13 @@
+import hmac
 from typing import Tuple
 
+from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
-from django.core.mail import EmailMessage
 from django.db import transaction
+from django.http import HttpResponse
 from django.utils import timezone
+from django_rest_passwordreset.models import ResetPasswordToken
 from onipkg_contrib.log_helper import log_error, log_tests
 from rest_framework import generics
 from rest_framework.views import APIView
@@ -12,16 +15,22 @@ from django.utils.translation import gettext_lazy as _
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
 from .serializers import ModifiedTokenObtainPairSerializer, ModifiedTokenRefreshSerializer, ProfileSerializer, \
-    SystemUserSerializer, CustomerSerializer
+    SystemUserSerializer, CustomerSerializer, LogoutSerializer
 from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
+from rest_framework_simplejwt.tokens import Token
 from rest_framework_simplejwt.views import TokenViewBase, TokenObtainPairView
 
-from ...models import SystemUser, UserProfile, Customer, PaidContent
+from ...models import SystemUser, UserProfile, Customer, PaidContent, RevokedToken, OutgoingEmail
 from ...utils.api_helpers import get_default_200_response_for_rest_api, get_default_400_response_for_rest_api, \
-    get_default_404_response_for_rest_api, get_default_403_response_for_rest_api, get_profile_from_request, \
+    get_default_404_response_for_rest_api, get_default_403_response_for_rest_api, \
     get_custom_action_not_allowed_http_code_and_message
+from ...utils.entitlements import get_entitlements
+from ...utils.hashing import HashingPoolBusy
+from ...utils.metrics import metrics
 from ...utils.base_viewsets import CustomListCreateFilterClass, CustomRetrieveUpdateDestroyFilterClass, \
-    CustomListFilterClass, CustomRetrieveFilterClass, CustomRetrieveUpdateFilterClass
+    CustomListFilterClass, CustomRetrieveFilterClass, CustomRetrieveUpdateFilterClass, CustomExportFilterClass, \
+    CustomApiViewFilterClass
 
 
 class ModifiedObtainTokenPairView(TokenObtainPairView):
@@ -42,6 +51,26 @@ class ModifiedTokenRefreshView(TokenViewBase):
     serializer_class = ModifiedTokenRefreshSerializer
 
 
+class LogoutView(APIView):
+    """
+    Encerra a sessão, revogando o token de refresh informado e o token de acesso usado na requisição (se houver)
+    Viewset aberta (não realiza verificação de acesso por Cliente ou Perfil)
+    """
+    permission_classes = (AllowAny,)
+
+    def post(self, request):
+        serializer = LogoutSerializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        tokens = [serializer.validated_data['refresh']]
+        if isinstance(request.auth, Token):
+            tokens.append(request.auth)
+        RevokedToken.revoke_tokens(tokens)
+        return get_default_200_response_for_rest_api()
+
+
 class RegisterView(APIView):
     """
     View para cadastro de novos usuários
@@ -65,7 +94,8 @@ class RegisterView(APIView):
     @staticmethod
     def send_welcome_mail(recipient_email: str, recipient_name: str) -> None:
         """
-        Envia o email de boas vindas pro usuário recém-cadastrado
+        Coloca o email de boas vindas pro usuário recém-cadastrado na caixa de saída (o envio é feito pelo comando
+        send_outgoing_emails)
 
         Args:
             recipient_email: endereco de email do recipiente
@@ -74,9 +104,8 @@ class RegisterView(APIView):
         Returns:
             None
         """
-        mail = EmailMessage('Seja bem-vindo(a)!', f'Olá, {recipient_name}! Bem-vindo(a) ao nosso sistema!',
-                            to=[recipient_email])
-        mail.send()
+        OutgoingEmail.enqueue('Seja bem-vindo(a)!', f'Olá, {recipient_name}! Bem-vindo(a) ao nosso sistema!',
+                              to=[recipient_email])
 
     def post(self, request):
         """
@@ -90,12 +119,17 @@ class RegisterView(APIView):
         # Fazemos um .copy() no request.POST pra evitar erro de "This QueryDict instance is immutable" no algoritmo
         data = request.POST.copy()
         try:
-            # Cria o usuário no BD
-            user = self.create_user(data)
+            # O usuário e o email de boas vindas são gravados na mesma transação: se um falhar, nenhum dos dois fica
+            with transaction.atomic():
+                # Cria o usuário no BD
+                user = self.create_user(data)
 
-            # Se chegou até aqui, deu tudo certo. Enviaremos um email de boas vindas e retornaremos 200
-            self.send_welcome_mail(user.email, user.first_name)
+                # Se chegou até aqui, deu tudo certo. Enviaremos um email de boas vindas e retornaremos 200
+                self.send_welcome_mail(user.email, user.first_name)
             return get_default_200_response_for_rest_api({'user_id': user.id})
+        except HashingPoolBusy:
+            # pool de hashing cheio: 503 com Retry-After, pro cliente tentar de novo
+            raise
         except Exception as e:
             log_error(e)
             return get_default_400_response_for_rest_api()
@@ -138,8 +172,8 @@ class CompleteSignupView(APIView):
     def post(self, request):
         data = request.POST.copy()
         try:
-            user = SystemUser.objects.get(id=request.user.id)
-            self.complete_signup(data, user)
+            # o usuário já foi carregado pela autenticação
+            self.complete_signup(data, request.user)
         except Exception as e:
             log_error(e)
             return get_default_404_response_for_rest_api()
@@ -182,7 +216,7 @@ class ChangePasswordView(APIView):
 
     def put(self, request):
         # Inicializa variáveis necessárias pro algoritmo
-        user = SystemUser.objects.get(id=request.user.id)
+        user = request.user  # já carregado pela autenticação
         new_password = request.POST.get('new_password')
 
         # Verifica a senha antiga do usuário pra assegurar a segurança da operação
@@ -199,6 +233,8 @@ class ChangePasswordView(APIView):
         # Atualiza a senha e salva o usuário (o set_password NAO salva no BD automáticamente)
         user.set_password(new_password)
         user.save()
+        # Os tokens emitidos com a senha antiga deixam de valer
+        RevokedToken.revoke_user(user.id)
         return get_default_200_response_for_rest_api()
 
 
@@ -226,15 +262,29 @@ class ProfileListCreate(CustomListCreateFilterClass):
     serializer_class = ProfileSerializer
     related_module = 'auth'
 
+    @staticmethod
+    def send_invite_mail(user: SystemUser, customer_name: str) -> None:
+        """
+        Gera o token de reset de senha do usuário recém-criado e coloca o convite com ele na caixa de saída, na mesma
+        transação da criação do perfil (o envio é feito pelo comando send_outgoing_emails)
+
+        Args:
+            user: usuário convidado
+            customer_name: nome do cliente que fez o convite
+        """
+        token = ResetPasswordToken.objects.create(user=user)
+        UserProfile.build_invite_email(user, customer_name, token.key).save()
+
     @transaction.atomic
     def create(self, request, *args, **kwargs):
         """
         Cria novos Perfis com base em informacoes vindas do front. Cria/pega o usuário
         com base no email informado pelo cliente e define os campos necessários no perfil
         """
-        # Repete a validacao de perm de criacao porque demos override no create
-        profile: UserProfile = get_profile_from_request(request)
-        if not profile.can_create():
+        # Repete a validacao de perm de criacao porque demos override no create (o contexto já foi resolvido no
+        # check_permissions, então isso não vai ao BD de novo)
+        entitlements = get_entitlements(request)
+        if not entitlements.can_create():
             self.permission_denied(
                 request,
                 **get_custom_action_not_allowed_http_code_and_message()
@@ -252,13 +302,50 @@ class ProfileListCreate(CustomListCreateFilterClass):
             user = SystemUser(first_name=user_name, email=user_email)
             user.set_unusable_password()  # Em vez de criar o usuário com is_active=False, criamos com senha fake
             user.save()
-            # Ao criar esse user, o sinal post_save de CustomUser vai enviar o email de ativação de conta pra ele
+            # O convite vai pela caixa de saída, então só é enviado se o perfil for criado
+            self.send_invite_mail(user, entitlements.customer.name)
             response_msg = _(
                 'O usuário informado ainda não existe. Um convite foi enviado para o endereço de email informado.')
 
-        UserProfile.new_profile(
-            {'user': user, 'client': profile.client, 'allowed_actions': data.get('allowed_actions')})
-        return get_default_200_response_for_rest_api({'msg': response_msg, 'id': profile.id})
+        # os ids vêm das entitlements (em cache), sem carregar o perfil e o cliente de novo
+        profile_entitlements = entitlements.profile_entitlements
+        UserProfile.new_profile({'user': user, 'client_id': profile_entitlements.customer_id,
+                                 'allowed_actions': data.get('allowed_actions')})
+        return get_default_200_response_for_rest_api({'msg': response_msg, 'id': profile_entitlements.profile_id})
+
+
+class ProfileBulkInvite(CustomApiViewFilterClass):
+    """
+    Adiciona vários usuários ao cliente de uma vez (ver UserProfile.bulk_invite). O corpo é
+    `{"invites": [{"email": ..., "name": ..., "allowed_actions": ...}, ...]}` e a resposta traz o resultado de cada
+    linha. Tudo é feito em uma única transação.
+    Viewset fechada (limita os resultados com base no plano do Cliente e no acesso do Perfil)
+    """
+    related_module = 'auth'
+
+    @staticmethod
+    def get_max_invites() -> int:
+        return getattr(settings, 'SUBSCRIPTION_BULK_INVITE_MAX', 1000)
+
+    @transaction.atomic
+    def post(self, request):
+        entitlements = get_entitlements(request)
+        if not entitlements.can_create():
+            self.permission_denied(
+                request,
+                **get_custom_action_not_allowed_http_code_and_message()
+            )
+        invites = request.data.get('invites')
+        if not isinstance(invites, list) or not invites:
+            return get_default_400_response_for_rest_api({'invites': _('Informe a lista de convites.')})
+        if len(invites) > self.get_max_invites():
+            return get_default_400_response_for_rest_api(
+                {'invites': _('Envie no máximo %(max)d convites por vez.') % {'max': self.get_max_invites()}})
+        results = UserProfile.bulk_invite(entitlements.customer, invites)
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return get_default_200_response_for_rest_api({'results': results, 'counts': counts})
 
 
 class ProfileRetrieveUpdateDestroy(CustomRetrieveUpdateDestroyFilterClass):
@@ -293,3 +380,39 @@ class CustomerRetrieveUpdate(CustomRetrieveUpdateFilterClass):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
     related_module = 'auth'
+
+
+class UserExport(CustomExportFilterClass):
+    queryset = SystemUser.objects.all()
+    export_fields = ('id', 'email', 'first_name', 'last_name', 'is_active', 'date_joined')
+    related_module = 'auth'
+
+
+class CustomerExport(CustomExportFilterClass):
+    queryset = Customer.objects.all()
+    export_fields = ('id', 'name', 'owner_id', 'created_at')
+    related_module = 'auth'
+
+
+class PaidContentExport(CustomExportFilterClass):
+    queryset = PaidContent.objects.all()
+    export_fields = ('id', 'customer_id', 'stripe_id', 'type', 'is_exclusive', 'value', 'start_date', 'expiration_date')
+    related_module = 'auth'
+
+
+class MetricsView(APIView):
+    """
+    Exporta as métricas do processo (utils/metrics.py) no formato de texto do Prometheus. Só responde se
+    SUBSCRIPTION_METRICS_ENABLED estiver ligado; com SUBSCRIPTION_METRICS_TOKEN, exige o header
+    `Authorization: Bearer <token>`. Não passa pela autenticação JWT, pra que o coletor não precise de um usuário
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        if not getattr(settings, 'SUBSCRIPTION_METRICS_ENABLED', False):
+            return get_default_404_response_for_rest_api()
+        token = getattr(settings, 'SUBSCRIPTION_METRICS_TOKEN', None)
+        if token and not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+            return get_default_403_response_for_rest_api()
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
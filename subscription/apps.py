@@ -1,6 +1,48 @@
+import logging
+
 from django.apps import AppConfig
+from django.db import DatabaseError, transaction
+from django.db.models.signals import post_migrate
+
+logger = logging.getLogger(__name__)
+
+
+def register_features_after_migrate(**kwargs):
+    """ Registra as features do catálogo assim que as tabelas existem, pra que as rotas não neguem acesso a elas """
+    from .utils.features import sync_catalog_features
+    try:
+        sync_catalog_features()
+    except OSError:
+        # projeto ainda sem plans.json: as features são registradas quando ele for criado
+        pass
+
+
+def register_features_of_new_catalog(plans, **kwargs):
+    """ Registra as features de uma versão nova do plans.json (ex.: uma feature incluída num plano) """
+    from .utils.features import sync_catalog_features
+
+    def sync():
+        try:
+            sync_catalog_features(plans)
+        except DatabaseError:
+            # ex.: catálogo carregado antes do migrate criar a tabela Feature (o post_migrate registra depois)
+            logger.exception('Não foi possível registrar as features do catálogo de planos.')
+
+    # numa transação, só depois do commit, pra que as posições não sejam desfeitas junto com ela (se ela própria for
+    # desfeita, as features ficam pro próximo migrate ou migrate_feature_masks)
+    transaction.on_commit(sync)
 
 
 class SubscriptionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'subscription'
+
+    def ready(self):
+        from .utils.plans import plans_reloaded
+        post_migrate.connect(register_features_after_migrate, sender=self)
+        plans_reloaded.connect(register_features_of_new_catalog)
+        from .utils.usage import is_write_behind_enabled, usage_counters
+        if is_write_behind_enabled():
+            # grava os contadores de uso pendentes antes do processo terminar
+            import atexit
+            atexit.register(usage_counters.shutdown)
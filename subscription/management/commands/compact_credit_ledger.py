@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from subscription.models import CreditLedgerEntry
+
+
+class Command(BaseCommand):
+    help = ('Compacta as movimentações antigas do livro-razão de créditos em uma entrada de saldo consolidado por '
+            'cliente.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=30,
+                            help='Compacta as movimentações mais antigas que essa quantidade de dias.')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Quantidade de clientes por lote.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['older_than_days'])
+        chunk_size = options['chunk_size']
+        old_entries = CreditLedgerEntry.objects.filter(created_at__lt=before)
+        last_customer_id = 0
+        customers = compacted = 0
+        while True:
+            customer_ids = list(old_entries.filter(customer_id__gt=last_customer_id).order_by('customer_id')
+                                .values_list('customer_id', flat=True).distinct()[:chunk_size])
+            if not customer_ids:
+                break
+            for customer_id in customer_ids:
+                compacted += CreditLedgerEntry.compact(customer_id, before)
+            customers += len(customer_ids)
+            last_customer_id = customer_ids[-1]
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {compacted} movimentações de {customers} clientes compactadas.'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from subscription.models import PaidContent
+
+
+class Command(BaseCommand):
+    help = ('Encerra as assinaturas free sem vencimento duplicadas, mantendo a mais antiga de cada cliente. Execute '
+            'antes do migrate que cria a constraint paidcontent_unique_open_free, que falharia com as duplicatas.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Quantidade de clientes por lote.')
+
+    def handle(self, *args, **options):
+        expired = PaidContent.expire_duplicate_free_signatures(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Concluído: {expired} assinaturas free duplicadas encerradas.'))
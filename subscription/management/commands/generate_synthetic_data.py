@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscription.utils.synthetic import SyntheticDataGenerator
+
+
+class Command(BaseCommand):
+    help = ('Gera clientes, perfis e históricos de conteúdos pagos sintéticos, com planos do catálogo, pra testes de '
+            'escala (planos de consulta, benchmarks, listagens). Não use no BD de produção.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('customers', type=int, help='Quantidade de clientes (cada um com um dono).')
+        parser.add_argument('--profiles', type=int, default=5, help='Perfis de cada cliente, além do dono.')
+        parser.add_argument('--history', type=int, default=100, help='Conteúdos pagos no histórico de cada cliente.')
+        parser.add_argument('--active-ratio', type=float, default=0.8,
+                            help='Fração dos clientes que termina com uma assinatura exclusiva ativa.')
+        parser.add_argument('--years', type=int, default=5, help='Período (em anos) coberto pelos históricos.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed do sorteio (a mesma seed gera os mesmos dados).')
+        parser.add_argument('--prefix', default='synthetic', help='Prefixo dos emails dos usuários gerados.')
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help='Quantidade máxima de linhas de cada tabela gravadas por bloco (e por transação).')
+
+    def handle(self, *args, **options):
+        started_at = time.monotonic()
+        try:
+            generator = SyntheticDataGenerator(
+                options['customers'], profiles=options['profiles'], history=options['history'], seed=options['seed'],
+                chunk_size=options['chunk_size'], prefix=options['prefix'], years=options['years'],
+                active_ratio=options['active_ratio'])
+
+            def progress(totals):
+                if options['verbosity'] > 1:
+                    elapsed = time.monotonic() - started_at
+                    self.stdout.write(f'{totals["customers"]}/{options["customers"]} clientes, '
+                                      f'{totals["paid_contents"]} conteúdos pagos ({elapsed:.1f}s)')
+
+            totals = generator.generate(progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído em {time.monotonic() - started_at:.1f}s: {totals["customers"]} clientes, {totals["users"]} '
+            f'usuários, {totals["profiles"]} perfis e {totals["paid_contents"]} conteúdos pagos.'))
@@ -0,0 +1,83 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from subscription.utils.benchmarks import get_environment
+from subscription.utils.load_test import LoadTest, ROUTES, parse_mix
+from subscription.utils.plans import plan_catalog
+
+
+class Command(BaseCommand):
+    help = ('Teste de carga em processo das rotas de autenticação, perfis, clientes e compras, com um pool de threads '
+            'e dados sintéticos em um BD de teste descartável. Mostra a vazão e as latências p50/p95/p99 de cada rota, '
+            'em cada nível de concorrência, e verifica as invariantes que as corridas entre requisições quebrariam.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,4,16',
+                            help='Níveis de concorrência (threads), separados por vírgula. Cada um é uma rodada.')
+        parser.add_argument('--requests', type=int, default=1000, help='Requisições por rodada.')
+        parser.add_argument('--mix', default=None,
+                            help=f'Pesos das rotas no formato rota=peso,rota=peso. Rotas: {", ".join(ROUTES)} '
+                                 f'(padrão: {",".join(f"{route}={weight}" for route, weight in ROUTES.items())}).')
+        parser.add_argument('--customers', type=int, default=10,
+                            help='Clientes sintéticos (os usuários virtuais são distribuídos entre eles).')
+        parser.add_argument('--users', type=int, default=None,
+                            help='Usuários virtuais (padrão: o maior nível de concorrência).')
+        parser.add_argument('--history', type=int, default=100, help='Histórico de conteúdos pagos de cada cliente.')
+        parser.add_argument('--processors', type=int, default=2,
+                            help='Threads processando os webhooks de compra durante o teste.')
+        parser.add_argument('--plan', default=None,
+                            help='Plano comprado pelo register-purchase (padrão: a primeira assinatura do catálogo).')
+        parser.add_argument('--seed', type=int, default=0, help='Seed do sorteio das rotas e dos dados.')
+        parser.add_argument('--url-prefix', default=None,
+                            help='Prefixo das rotas do pacote (padrão: derivado da rota de login no urls.py).')
+        parser.add_argument('--output', default=None, help='Arquivo onde gravar o json (padrão: a saída padrão).')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+            mix = parse_mix(options['mix']) if options['mix'] else None
+            plan = plan_catalog.get_plan(options['plan']) if options['plan'] else None
+        except KeyError:
+            raise CommandError(f'O plano {options["plan"]} não existe no catálogo.')
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not levels or min(levels) < 1:
+            raise CommandError('Informe pelo menos um nível de concorrência positivo.')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            try:
+                load_test = LoadTest(mix, customers=options['customers'], users=options['users'] or max(levels),
+                                     history=options['history'], processors=options['processors'], plan=plan,
+                                     seed=options['seed'], url_prefix=options['url_prefix'])
+                load_test.setup()
+            except ValueError as e:
+                raise CommandError(str(e))
+            rounds = []
+            for level in levels:
+                rounds.append(load_test.run(level, options['requests']))
+                if options['verbosity'] > 1:
+                    self.stderr.write(f'concorrência {level}: {rounds[-1]["throughput"]:.1f} req/s')
+            environment = get_environment({key: options[key] for key in ('requests', 'customers', 'history',
+                                                                         'processors', 'seed')})
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        content = json.dumps({'environment': environment, 'mix': load_test.mix, 'rounds': rounds}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(content + '\n')
+            for report in rounds:
+                self.stdout.write(f'concorrência {report["concurrency"]}: {report["throughput"]:.1f} req/s')
+                for route, metrics in report['routes'].items():
+                    self.stdout.write(f'  {route}: {metrics["throughput"]:.1f} req/s, p50 {metrics["p50"]:.1f}ms, '
+                                      f'p95 {metrics["p95"]:.1f}ms, p99 {metrics["p99"]:.1f}ms, '
+                                      f'{metrics["errors"]} erros')
+        else:
+            self.stdout.write(content)
+        broken = {name: value for report in rounds for name, value in report['invariants'].items() if value}
+        if broken:
+            raise CommandError(f'Invariantes quebradas: {json.dumps(broken)}')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from subscription.models import Customer, PaidContent
+
+
+class Command(BaseCommand):
+    help = 'Salva no BD a assinatura free dos clientes que não têm nenhuma assinatura ativa (backfill em lotes).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Quantidade de clientes por lote.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        checked = created = 0
+        while True:
+            # paginação por chave (id > último id visto), pra não pagar OFFSET em tabelas grandes
+            customer_ids = list(Customer.objects.filter(id__gt=last_id).order_by('id')
+                                .values_list('id', flat=True)[:chunk_size])
+            if not customer_ids:
+                break
+            created += PaidContent.materialize_free_signatures(customer_ids)
+            checked += len(customer_ids)
+            last_id = customer_ids[-1]
+            self.stdout.write(f'{checked} clientes verificados, {created} sem assinatura ativa')
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {checked} clientes verificados, {created} assinaturas free materializadas.'))
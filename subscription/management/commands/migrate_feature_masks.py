@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from subscription.utils.features import feature_registry, refresh_profile_masks
+
+
+class Command(BaseCommand):
+    help = ('Registra as features do catálogo de planos que ainda não têm posição de bit e preenche a máscara de '
+            'features (features_mask) dos perfis a partir do campo available_features. O registro já é feito sozinho '
+            'depois do migrate e quando o plans.json muda; o comando serve pra recalcular as máscaras (--all) ou '
+            'migrar uma base grande em lotes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Quantidade de perfis por lote.')
+        parser.add_argument('--all', action='store_true',
+                            help='Recalcula a máscara de todos os perfis, e não só dos que ainda não foram migrados.')
+
+    def handle(self, *args, **options):
+        registered = feature_registry.register_catalog()
+        if registered:
+            self.stdout.write(f'Features registradas: {", ".join(registered)}')
+        migrated = 0
+        for migrated in refresh_profile_masks(registered, options['all'], options['chunk_size']):
+            self.stdout.write(f'{migrated} perfis migrados')
+        self.stdout.write(self.style.SUCCESS(f'Concluído: {migrated} perfis migrados.'))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from subscription.models import StripeWebhookEvent
+
+
+class Command(BaseCommand):
+    help = 'Processa os eventos do Stripe pendentes na caixa de entrada de webhooks, em lotes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Quantidade de eventos por lote.')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Quantidade de tentativas antes de um evento ser marcado como falho.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Continua rodando e buscando eventos novos em vez de parar quando a fila esvaziar.')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Com --loop, segundos de espera quando a fila está vazia.')
+
+    def handle(self, *args, **options):
+        totals = {}
+        while True:
+            counts = StripeWebhookEvent.process_pending(options['batch_size'], options['max_attempts'])
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+            if counts['total']:
+                continue
+            if not options['loop']:
+                break
+            connection.close_if_unusable_or_obsolete()
+            time.sleep(options['interval'])
+        Status = StripeWebhookEvent.Status
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {totals.get(Status.DONE, 0)} eventos processados, {totals.get(Status.IGNORED, 0)} ignorados '
+            f'e {totals.get(Status.FAILED, 0)} falhos.'))
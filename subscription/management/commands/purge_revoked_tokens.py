@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from subscription.models import RevokedToken
+
+
+class Command(BaseCommand):
+    help = 'Apaga as revogações de tokens que já expiraram (os tokens revogados não seriam aceitos de qualquer forma).'
+
+    def handle(self, *args, **options):
+        deleted = RevokedToken.purge_expired()
+        self.stdout.write(self.style.SUCCESS(f'Concluído: {deleted} revogações expiradas apagadas.'))
@@ -0,0 +1,200 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Iterator, Optional, Tuple, List, Dict, Callable
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from subscription.models import PaidContent, Customer
+from subscription.utils.plans import plan_catalog
+from subscription.utils.stripe_events import parse_purchase_description
+
+# (id do evento, tipo, descrição, momento do pagamento)
+Event = Tuple[str, str, Optional[str], Optional[datetime]]
+# chamado com a posição e o motivo de cada linha que não pôde ser lida, que é pulada
+OnInvalid = Callable[[str, str], None]
+
+
+def parse_created(value) -> Optional[datetime]:
+    """ Converte o momento do evento, que pode vir como timestamp unix (json do Stripe) ou data (csv) """
+    if value in (None, ''):
+        return None
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return datetime.fromtimestamp(int(value), tz=dt_timezone.utc)
+    created = parse_datetime(str(value))
+    if created is not None and created.tzinfo is None:
+        # as datas dos exports do Stripe são em UTC
+        created = created.replace(tzinfo=dt_timezone.utc)
+    return created
+
+
+def read_ndjson(file, on_invalid: OnInvalid) -> Iterator[Event]:
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            event = json.loads(line)
+            payment = (event.get('data') or {}).get('object') or {}
+            yield event['id'], event.get('type', ''), payment.get('description'), parse_created(event.get('created'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            on_invalid(f'linha {number}', f'evento inválido: {e}')
+
+
+def read_csv(file, on_invalid: OnInvalid) -> Iterator[Event]:
+    reader = csv.DictReader(file)
+    # os exports do Stripe usam nomes como "Description" e "Created (UTC)"
+    columns = {name.lower().split(' (')[0]: name for name in reader.fieldnames or ()}
+    if 'id' not in columns or 'description' not in columns:
+        raise CommandError('O csv deve ter as colunas "id" e "description".')
+    for row in reader:
+        try:
+            yield (row[columns['id']], row[columns['type']] if 'type' in columns else 'payment_intent.succeeded',
+                   row[columns['description']], parse_created(row.get(columns.get('created'))))
+        except ValueError as e:
+            on_invalid(f'linha {reader.line_num}', f'evento inválido: {e}')
+
+
+class Command(BaseCommand):
+    help = ('Reconcilia as compras com um export de eventos do Stripe (ndjson ou csv), registrando em lote só as '
+            'compras que estão faltando. O arquivo é lido em streaming, então o uso de memória não depende do tamanho '
+            'dele.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Caminho do export (.ndjson, .jsonl ou .csv, opcionalmente .gz).')
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            help='Formato do arquivo (padrão: deduzido pela extensão).')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Quantidade de eventos por lote.')
+        parser.add_argument('--legacy-window', type=float, default=72,
+                            help='Janela (em horas, pra mais ou pra menos) em torno do pagamento em que uma compra sem '
+                                 'id de evento, do mesmo cliente e produto, é considerada a compra do evento.')
+        parser.add_argument('--dry-run', action='store_true', help='Só mostra a diferença, sem registrar nada.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        name = path[:-3] if path.endswith('.gz') else path
+        file_format = options['format'] or ('csv' if name.endswith('.csv') else 'ndjson')
+        opener = gzip.open if path.endswith('.gz') else io.open
+        self.totals = dict.fromkeys(['read', 'ignored', 'invalid', 'present', 'legacy', 'missing'], 0)
+        self.legacy_window = timedelta(hours=options['legacy_window'])
+        # compras antigas já associadas a algum evento. Fora do dry-run, a associação é gravada a cada lote e as
+        # próximas consultas já não encontram a compra, então só o dry-run precisa lembrar delas entre os lotes
+        self.claimed = set() if options['dry_run'] else None
+        with opener(path, 'rt', encoding='utf-8', newline='') as file:
+            reader = read_csv if file_format == 'csv' else read_ndjson
+            events = reader(file, self.unreadable)
+            while chunk := list(itertools.islice(events, options['chunk_size'])):
+                self.reconcile_chunk(chunk, options['dry_run'])
+
+        totals = self.totals
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {totals["read"]} eventos lidos, {totals["present"]} compras já registradas, '
+            f'{totals["legacy"]} compras antigas associadas aos eventos, '
+            f'{totals["missing"]} compras {"faltando" if options["dry_run"] else "registradas"}, '
+            f'{totals["ignored"]} eventos ignorados e {totals["invalid"]} inválidos.'))
+
+    def reconcile_chunk(self, chunk: List[Event], dry_run: bool) -> None:
+        self.totals['read'] += len(chunk)
+        # o mesmo evento pode aparecer mais de uma vez no export
+        candidates = {}
+        for event_id, event_type, description, created in chunk:
+            if event_type != 'payment_intent.succeeded' or event_id in candidates:
+                self.totals['ignored'] += 1
+                continue
+            try:
+                customer_id, product_id = parse_purchase_description(description or '')
+                plan = plan_catalog.get_plan(product_id)
+            except (KeyError, ValueError):
+                self.invalid(event_id, f'descrição inválida: {description!r}')
+                continue
+            candidates[event_id] = (customer_id, plan, created)
+
+        # junta os eventos do lote com as compras e os clientes que já existem (uma consulta pra cada)
+        present = set(PaidContent.objects.filter(stripe_event_id__in=list(candidates))
+                      .values_list('stripe_event_id', flat=True))
+        customer_ids = set(Customer.objects.filter(id__in={customer_id for customer_id, _, _ in candidates.values()})
+                           .values_list('id', flat=True))
+        missing = []
+        for event_id, (customer_id, plan, created) in candidates.items():
+            if event_id in present:
+                self.totals['present'] += 1
+            elif customer_id not in customer_ids:
+                self.invalid(event_id, f'cliente {customer_id} não existe')
+            else:
+                missing.append((event_id, customer_id, plan, created))
+
+        legacy = self.match_legacy_purchases(missing)
+        purchases = []
+        for event_id, customer_id, plan, created in missing:
+            if event_id in legacy:
+                self.totals['legacy'] += 1
+                self.stdout.write(f'= {event_id} cliente={customer_id} produto={plan.id} compra={legacy[event_id]}')
+                continue
+            self.totals['missing'] += 1
+            self.stdout.write(f'+ {event_id} cliente={customer_id} produto={plan.id}')
+            purchases.append(PaidContent.build_purchase(plan, customer_id, start_date=created,
+                                                        stripe_event_id=event_id))
+        if dry_run:
+            return
+        with transaction.atomic():
+            # a compra antiga passa a apontar pro evento, então a próxima reconciliação já a encontra pelo id
+            PaidContent.objects.bulk_update([PaidContent(id=purchase_id, stripe_event_id=event_id)
+                                             for event_id, purchase_id in legacy.items()], ['stripe_event_id'])
+            PaidContent.insert_purchases(purchases)
+
+    def match_legacy_purchases(self, missing: List[tuple]) -> Dict[str, int]:
+        """
+        Associa os eventos sem compra às compras registradas antes da caixa de entrada de webhooks, que não têm
+        stripe_event_id: uma compra do mesmo cliente e produto, com início até `--legacy-window` horas do pagamento, é
+        considerada a compra do evento (a de data mais próxima, se houver mais de uma). Cada compra antiga é associada a
+        no máximo um evento. Eventos sem data são associados a qualquer compra antiga do mesmo cliente e produto.
+
+        Returns:
+            Dicionário id do evento -> id da compra antiga
+        """
+        if not missing:
+            return {}
+        claimed = self.claimed if self.claimed is not None else set()
+        legacy = PaidContent.objects.filter(stripe_event_id__isnull=True,
+                                            customer_id__in={customer_id for _, customer_id, _, _ in missing},
+                                            stripe_id__in={plan.id for _, _, plan, _ in missing})
+        dates = [created for _, _, _, created in missing if created is not None]
+        if len(dates) == len(missing):
+            legacy = legacy.filter(start_date__gte=min(dates) - self.legacy_window,
+                                   start_date__lte=max(dates) + self.legacy_window)
+        rows = {}
+        for purchase_id, customer_id, stripe_id, start_date in legacy.values_list('id', 'customer_id', 'stripe_id',
+                                                                                  'start_date'):
+            if purchase_id not in claimed:
+                rows.setdefault((customer_id, stripe_id), []).append((purchase_id, start_date))
+
+        def distance(row, created) -> timedelta:
+            if created is None or row[1] is None:
+                return timedelta(0)
+            return abs(row[1] - created)
+
+        # os pares (evento, compra antiga) são associados do mais próximo pro mais distante
+        pairs = sorted(
+            (distance(row, created), event_id, row)
+            for event_id, customer_id, plan, created in missing for row in rows.get((customer_id, plan.id), ())
+            if created is None or (row[1] is not None and distance(row, created) <= self.legacy_window)
+        )
+        matches = {}
+        for _, event_id, (purchase_id, _) in pairs:
+            if event_id not in matches and purchase_id not in claimed:
+                matches[event_id] = purchase_id
+                claimed.add(purchase_id)
+        return matches
+
+    def unreadable(self, position: str, reason: str) -> None:
+        """ Linha do arquivo que não pôde ser lida: conta como lida e inválida, e a leitura continua """
+        self.totals['read'] += 1
+        self.invalid(position, reason)
+
+    def invalid(self, event_id: str, reason: str) -> None:
+        self.totals['invalid'] += 1
+        self.stderr.write(f'! {event_id} {reason}')
@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from subscription.utils.benchmarks import BENCHMARKS, run_benchmarks, compare, get_environment
+from subscription.utils.plans import plan_catalog
+
+
+class Command(BaseCommand):
+    help = ('Mede o tempo e as consultas das operações do caminho de autorização e de compra, com dados sintéticos em '
+            'um BD de teste descartável (em memória, no SQLite), e compara os resultados com um baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', metavar='operação',
+                            help=f'Operações a medir (padrão: todas). Opções: {", ".join(BENCHMARKS)}.')
+        parser.add_argument('--iterations', type=int, default=200, help='Execuções medidas de cada operação.')
+        parser.add_argument('--warmup', type=int, default=10, help='Execuções não medidas antes das medidas.')
+        parser.add_argument('--history', type=int, default=1000,
+                            help='Tamanho do histórico de conteúdos pagos de cada cliente sintético.')
+        parser.add_argument('--profiles', type=int, default=20, help='Perfis de cada cliente sintético.')
+        parser.add_argument('--plan', default=None,
+                            help='Plano das assinaturas e compras (padrão: a primeira assinatura do catálogo).')
+        parser.add_argument('--output', default=None, help='Arquivo onde gravar o json (padrão: a saída padrão).')
+        parser.add_argument('--baseline', default=None, help='json de uma execução anterior pra comparar.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Aumento do tempo mediano, em relação ao baseline, que conta como regressão '
+                                 '(0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        unknown = set(options['names']) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f'Operações desconhecidas: {", ".join(sorted(unknown))}.')
+        try:
+            plan = plan_catalog.get_plan(options['plan']) if options['plan'] else None
+        except KeyError:
+            raise CommandError(f'O plano {options["plan"]} não existe no catálogo.')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            try:
+                results = run_benchmarks(options['names'], options['iterations'], options['warmup'],
+                                         options['history'], options['profiles'], plan)
+            except ValueError as e:
+                raise CommandError(str(e))
+            environment = get_environment({key: options[key] for key in ('iterations', 'warmup', 'history',
+                                                                         'profiles')})
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = {
+            'environment': environment,
+            'results': {name: result.as_dict() for name, result in results.items()},
+        }
+        if baseline is not None:
+            report['threshold'] = options['threshold']
+            report['regressions'] = compare(results, baseline['results'], options['threshold'])
+        content = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(content + '\n')
+        else:
+            self.stdout.write(content)
+
+        if report.get('regressions'):
+            raise CommandError('Regressões em relação ao baseline: ' + ', '.join(
+                f'{regression["name"]} ({regression["metric"]})' for regression in report['regressions']))
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f'Concluído: {len(results)} operações medidas.'))
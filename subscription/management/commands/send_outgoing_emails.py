@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from subscription.models import OutgoingEmail
+
+
+class Command(BaseCommand):
+    help = 'Envia os emails pendentes na caixa de saída, em lotes (uma conexão com o servidor de email por lote).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Quantidade de emails por lote.')
+        parser.add_argument('--max-attempts', type=int, default=5,
+                            help='Quantidade de tentativas antes de um email ser marcado como falho.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Continua rodando e buscando emails novos em vez de parar quando a fila esvaziar.')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Com --loop, segundos de espera quando a fila está vazia.')
+
+    def handle(self, *args, **options):
+        totals = {}
+        while True:
+            counts = OutgoingEmail.send_pending(options['batch_size'], options['max_attempts'])
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+            if counts['total']:
+                continue
+            if not options['loop']:
+                break
+            connection.close_if_unusable_or_obsolete()
+            time.sleep(options['interval'])
+        Status = OutgoingEmail.Status
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {totals.get(Status.SENT, 0)} emails enviados e {totals.get(Status.FAILED, 0)} falhos.'))
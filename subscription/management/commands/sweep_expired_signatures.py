@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from subscription.models import PaidContent
+
+
+class Command(BaseCommand):
+    help = ('Percorre as assinaturas vencidas desde a última execução, rebaixando pro plano free os clientes que '
+            'ficaram sem assinatura ativa e invalidando as entitlements deles.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Quantidade de assinaturas por lote.')
+        parser.add_argument('--max-batches', type=int, default=None,
+                            help='Quantidade máxima de lotes nessa execução (padrão: sem limite).')
+        parser.add_argument('--since-days', type=int, default=None,
+                            help='Na primeira execução, considera só as assinaturas vencidas nessa quantidade de dias.')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(days=options['since_days']) if options['since_days'] is not None else None
+        totals = PaidContent.sweep_expired_signatures(options['batch_size'], options['max_batches'], since)
+        self.stdout.write(self.style.SUCCESS(
+            f'Concluído: {totals["signatures"]} assinaturas vencidas verificadas, {totals["downgraded"]} clientes '
+            f'rebaixados pro plano free.'))
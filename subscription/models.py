@@ -1,14 +1,29 @@
-from typing import Optional, List
-
-from django.db import models
-from django.db.models import QuerySet, Q
+import random
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Optional, List, Iterable, FrozenSet, Dict
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import models, transaction, IntegrityError, connection
+from django.db.models import QuerySet, Q, F, Sum, Case, When, Value, Min, Count
+from django.db.models.functions import Greatest
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as t
 from django.contrib.auth.models import AbstractUser, Permission
 from django.contrib.auth.base_user import BaseUserManager
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 
 from onipkg_contrib.log_helper import log_error
 from onipkg_contrib.models.base_model import BaseModel
+from subscription.utils.entitlements import invalidate_customer_entitlements, invalidate_user_entitlements, \
+    get_entitlements
+from subscription.utils.features import feature_registry
+from subscription.utils.hashing import make_password, check_password, HashingPoolBusy
+from subscription.utils.metrics import webhook_processing_seconds, webhook_lag_seconds
+from subscription.utils.plans import plan_catalog, Plan
+from subscription.utils.revocation import revocation_list, get_token_key, get_user_key
+from subscription.utils.usage import usage_counters, is_write_behind_enabled, get_usage_period
 from subscription.utils.utils import BasePermissionClass
 
 
@@ -81,6 +96,28 @@ class SystemUser(AbstractUser):
         verbose_name = t('Usuário')
         verbose_name_plural = t('Usuários')
 
+    def set_password(self, raw_password):
+        """ set_password do Django, mas com o hashing no pool limitado (ver utils/hashing.py) """
+        self.password = make_password(raw_password)
+        self._password = raw_password
+
+    def check_password(self, raw_password):
+        """ check_password do Django, com o hashing no pool limitado. Se o hasher ou os parâmetros dele (ex.: iterações
+        do PBKDF2) mudaram desde que a senha foi gravada, o hash é refeito e salvo no login """
+        correct, must_update = check_password(raw_password, self.password)
+        if correct and must_update:
+            self.set_password(raw_password)
+            self._password = None
+            self.save(update_fields=['password'])
+        return correct
+
+    @classmethod
+    def get_queryset(cls, request, *args, **kwargs):
+        """
+        Usuários visíveis pra requisição (listagem das views base): os usuários com perfil no cliente do usuário logado
+        """
+        return cls.objects.filter(profile__client_id=get_entitlements(request).customer_id)
+
     # métodos da classe - Quer herdar precisa implementar esse método
     @staticmethod
     def new_user(data: dict) -> Optional['SystemUser']:
@@ -92,12 +129,33 @@ class SystemUser(AbstractUser):
             user.set_password(data.get('password'))
             user.save()
             return user
+        except HashingPoolBusy:
+            raise
         except Exception as e:
             print(e)
             log_error(e)
             return None
 
 
+class Feature(models.Model):
+    """Registro das features conhecidas pelo sistema. Cada feature tem uma posição de bit fixa, usada nas máscaras de
+    features dos planos e dos perfis (ver subscription.utils.features.FeatureRegistry).
+
+    Attributes:
+        code (models.CharField): Código da feature (o mesmo usado no plans.json e no related_module das views).
+        bit (models.PositiveSmallIntegerField): Posição do bit da feature nas máscaras.
+    """
+    code = models.CharField(verbose_name=t('Código'), max_length=255, unique=True)
+    bit = models.PositiveSmallIntegerField(verbose_name=t('Bit'), unique=True)
+
+    class Meta:
+        verbose_name = t('Funcionalidade')
+        verbose_name_plural = t('Funcionalidades')
+
+    def __str__(self):
+        return self.code
+
+
 class Customer(BaseModel):
     """Classe que representa o cliente do sistema. Possui um dono e pode possuir outros usuários atrelados. Possui um
     ou mais conteúdos pagos (no mínimo possui um conteúdo pago que é a assinatura free).
@@ -130,7 +188,7 @@ class Customer(BaseModel):
         Returns:
             Número inteiro representando a quandidade de créditos
         """
-        return 100000
+        return CreditBalance.get_balance(self.id)
 
     def has_quota(self, amount) -> bool:
         """
@@ -143,39 +201,34 @@ class Customer(BaseModel):
         """
         return amount <= self.quota
 
-    def use_quota(self, amount) -> None:
+    def use_quota(self, amount) -> bool:
         """
-        Gasta uma determinada quantia em créditos desse Manager
+        Gasta uma determinada quantia em créditos desse Manager. O débito é atômico e nunca deixa o saldo negativo
         Args:
             amount: quantia gasta
 
         Returns:
-            None
+            True se os créditos foram debitados, False se o Manager não tinha saldo suficiente
         """
-        return self.quota - amount
+        return CreditBalance.debit(self.id, amount)
 
     def get_active_signature(self) -> 'PaidContent':
         """
-        Retorna a assinatura ativa do cliente
-        """
-        active_signatures = self.paidcontent_set.filter(
-            Q(Q(expiration_date__gte=timezone.localtime(timezone.now())) | Q(expiration_date__isnull=True)) & Q(
-                type=PaidContent.Types.SIGNATURE))
-        if len(active_signatures) > 1:
-            if active_signatures.filter(is_exclusive=True).count() > 1:
-                raise Exception('Cliente possui mais de uma assinatura exclusiva ativa')
-        elif len(active_signatures) == 0:
-            # Se o cara nao tiver uma assinatura ativa, coloca ele no plano free automaticamente
-            free_signature = PaidContent(
-                customer=self,
-                start_date=timezone.localtime(timezone.now()),
-                value=0,
-                is_exclusive=True,
-                type=PaidContent.Types.SIGNATURE,
-                stripe_id='free',
-            )
-            free_signature.save()
-            return free_signature
+        Retorna a assinatura ativa do cliente (que pode ser uma assinatura free virtual, com pk None, se o cliente não
+        tiver nenhuma assinatura ativa no BD). Quando há mais de uma assinatura ativa, a exclusiva tem prioridade, e
+        depois a mais recente. Tudo é resolvido em uma única consulta (que usa o índice de PaidContent por cliente, tipo
+        e vencimento) e só busca as duas primeiras linhas, que é o suficiente pra detectar assinaturas exclusivas
+        duplicadas.
+        """
+        active_signatures = list(PaidContent.active_signatures_queryset().filter(customer=self)[:2])
+        if not active_signatures:
+            # Se o cara nao tiver uma assinatura ativa, ele está no plano free. A assinatura free é virtual (não é
+            # salva aqui), pra que essa leitura nunca vire uma escrita. Quem materializa as assinaturas free no BD é o
+            # comando materialize_free_signatures (ou o sweep_expired_signatures)
+            return PaidContent.build_free_signature(self)
+        # como as exclusivas vêm primeiro, se a segunda é exclusiva a primeira também é
+        if len(active_signatures) > 1 and active_signatures[1].is_exclusive:
+            raise Exception('Cliente possui mais de uma assinatura exclusiva ativa')
         return active_signatures[0]
 
     @property
@@ -184,8 +237,7 @@ class Customer(BaseModel):
         Retorna a lista de funcionalidades disponíveis para o cliente, com base nas features listadas no json, sob
         o stripe_id que representa a assinatura do cliente
         """
-        return [content.get('id') for content in self.get_active_signature().get_data().get('purchased_content', []) if
-                content.get('type') == 'feature']
+        return list(self.get_active_signature().get_plan().features)
 
 
 class PaidContent(BaseModel):
@@ -214,75 +266,349 @@ class PaidContent(BaseModel):
     value = models.DecimalField(verbose_name=t('Valor pago'), max_digits=10, decimal_places=2, null=True, blank=True)
     # id do conteúdo no Stripe
     stripe_id = models.CharField(verbose_name=t('ID Stripe'), max_length=255)
+    # id do evento do Stripe que gerou a compra (garante que um mesmo evento não gere duas compras)
+    stripe_event_id = models.CharField(verbose_name=t('ID do Evento Stripe'), max_length=255, null=True, blank=True,
+                                       unique=True)
 
     class Meta:
         verbose_name = t('Conteúdo Pago')
         verbose_name_plural = t('Conteúdos Pagos')
+        indexes = [
+            # resolução da assinatura ativa (Customer.get_active_signature)
+            models.Index(fields=['customer', 'type', 'expiration_date'], name='paidcontent_active_sig_idx'),
+            models.Index(fields=['customer', 'type'], condition=Q(expiration_date__isnull=True),
+                         name='paidcontent_open_sig_idx'),
+            # varredura das assinaturas vencidas (PaidContent.sweep_expired_signatures)
+            models.Index(fields=['expiration_date', 'id'], condition=Q(type='SIG'),
+                         name='paidcontent_expiration_idx'),
+        ]
+        constraints = [
+            # um cliente tem no máximo uma assinatura free sem vencimento, o que torna a materialização idempotente
+            models.UniqueConstraint(fields=['customer'], condition=Q(stripe_id='free', expiration_date__isnull=True),
+                                    name='paidcontent_unique_open_free'),
+        ]
 
     def __str__(self):
         return self.stripe_id
 
+    @classmethod
+    def get_queryset(cls, request, *args, **kwargs):
+        """ Conteúdos pagos visíveis pra requisição: os do cliente do usuário logado """
+        return cls.objects.filter(customer_id=get_entitlements(request).customer_id)
+
+    @classmethod
+    def build_free_signature(cls, customer: 'Customer' = None, customer_id: int = None) -> 'PaidContent':
+        """
+        Monta (sem salvar) a assinatura do plano free de um cliente
+        """
+        signature = cls(
+            customer_id=customer.id if customer else customer_id,
+            start_date=timezone.localtime(timezone.now()),
+            value=0,
+            is_exclusive=True,
+            type=cls.Types.SIGNATURE,
+            stripe_id='free',
+        )
+        if customer is not None:
+            signature.customer = customer
+        return signature
+
+    @classmethod
+    def materialize_free_signatures(cls, customer_ids: Iterable[int]) -> int:
+        """
+        Salva no BD a assinatura free dos clientes informados que não têm nenhuma assinatura ativa. É idempotente: a
+        constraint de assinatura free aberta única faz com que execuções concorrentes não dupliquem nada.
+
+        Args:
+            customer_ids: ids dos clientes a verificar
+
+        Returns:
+            Quantidade de clientes que estavam sem assinatura ativa
+        """
+        customer_ids = set(customer_ids)
+        with_signature = set(cls.active_signatures_queryset().filter(customer_id__in=customer_ids).order_by()
+                             .values_list('customer_id', flat=True).distinct())
+        missing = customer_ids - with_signature
+        with transaction.atomic():
+            cls.objects.bulk_create([cls.build_free_signature(customer_id=customer_id) for customer_id in missing],
+                                    ignore_conflicts=True)
+            for customer_id in missing:
+                invalidate_customer_entitlements(customer_id)
+        return len(missing)
+
+    @classmethod
+    def expire_duplicate_free_signatures(cls, chunk_size: int = 1000) -> int:
+        """
+        Encerra as assinaturas free sem vencimento duplicadas (criadas antes da constraint paidcontent_unique_open_free,
+        quando a leitura da assinatura ativa materializava a free sem trava). Fica a mais antiga de cada cliente; as
+        outras vencem agora. Precisa ser executado antes do migrate que cria a constraint, então só usa colunas que já
+        existiam
+
+        Args:
+            chunk_size: quantidade de clientes por lote
+
+        Returns:
+            Quantidade de assinaturas encerradas
+        """
+        open_free = cls.objects.filter(stripe_id='free', expiration_date__isnull=True)
+        duplicated = open_free.values('customer_id').annotate(kept_id=Min('id'), total=Count('id')) \
+            .filter(total__gt=1).order_by('customer_id')
+        last_customer_id = None
+        expired = 0
+        while True:
+            queryset = duplicated if last_customer_id is None else duplicated.filter(customer_id__gt=last_customer_id)
+            groups = list(queryset.values_list('customer_id', 'kept_id')[:chunk_size])
+            if not groups:
+                return expired
+            customer_ids = [customer_id for customer_id, _ in groups]
+            with transaction.atomic():
+                expired += open_free.filter(customer_id__in=customer_ids) \
+                    .exclude(id__in=[kept_id for _, kept_id in groups]).update(expiration_date=timezone.now())
+                for customer_id in customer_ids:
+                    invalidate_customer_entitlements(customer_id)
+            last_customer_id = customer_ids[-1]
+
+    @classmethod
+    def active_signatures_queryset(cls) -> QuerySet:
+        """
+        Retorna as assinaturas ativas agora, em ordem de prioridade: exclusivas primeiro, depois as mais recentes (o id
+        desempata, pra que o resultado seja determinístico)
+        """
+        return cls.objects.filter(
+            Q(expiration_date__gte=timezone.localtime(timezone.now())) | Q(expiration_date__isnull=True),
+            type=cls.Types.SIGNATURE,
+        ).order_by('-is_exclusive', F('start_date').desc(nulls_last=True), '-id')
+
+    @classmethod
+    def sweep_expired_signatures(cls, batch_size: int = 500, max_batches: int = None, since=None) -> Dict[str, int]:
+        """
+        Percorre as assinaturas que venceram desde a última execução e já rebaixa pro plano free os clientes que
+        ficaram sem assinatura ativa, em vez de deixar isso pra primeira requisição depois do vencimento. Também
+        invalida as entitlements de todos os clientes com assinaturas vencidas.
+
+        A varredura anda por (expiration_date, id), usando o índice de vencimento, em lotes. A posição é salva em
+        SweepCheckpoint ao fim de cada lote, na mesma transação, então uma execução interrompida continua de onde parou.
+        Pode ser chamado pelo comando sweep_expired_signatures ou por uma tarefa periódica.
+
+        Args:
+            batch_size: quantidade de assinaturas por lote
+            max_batches: quantidade máxima de lotes nessa execução (padrão: até alcançar o momento atual)
+            since: na primeira execução (sem posição salva), considera só as assinaturas vencidas a partir desse momento
+
+        Returns:
+            Dicionário com a quantidade de assinaturas vencidas lidas e de clientes rebaixados pro plano free
+        """
+        now = timezone.now()
+        totals = {'signatures': 0, 'downgraded': 0}
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            with transaction.atomic():
+                checkpoint = SweepCheckpoint.get_for_update('expired_signatures')
+                position = checkpoint.position or since
+                signatures = cls.objects.filter(type=cls.Types.SIGNATURE, expiration_date__lte=now)
+                if position is not None:
+                    signatures = signatures.filter(Q(expiration_date__gt=position) |
+                                                   Q(expiration_date=position, id__gt=checkpoint.last_id))
+                batch = list(signatures.order_by('expiration_date', 'id').values_list(
+                    'id', 'customer_id', 'expiration_date')[:batch_size])
+                if not batch:
+                    break
+                customer_ids = {customer_id for _, customer_id, _ in batch}
+                totals['downgraded'] += cls.materialize_free_signatures(customer_ids)
+                for customer_id in customer_ids:
+                    invalidate_customer_entitlements(customer_id)
+                checkpoint.last_id, _, checkpoint.position = batch[-1]
+                checkpoint.save()
+            totals['signatures'] += len(batch)
+            batches += 1
+        return totals
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # qualquer mudança em um conteúdo pago pode mudar a assinatura ativa do cliente
+        invalidate_customer_entitlements(self.customer_id)
+
+    def delete(self, *args, **kwargs):
+        customer_id = self.customer_id
+        result = super().delete(*args, **kwargs)
+        invalidate_customer_entitlements(customer_id)
+        return result
+
     @staticmethod
     def get_products() -> dict:
         """
-        Carrega os produtos pagáveis do arquivo json e retorna em formato de dicionário
+        Retorna os produtos pagáveis do arquivo json em formato de dicionário. O arquivo é lido uma única vez pelo
+        catálogo de planos, então o dicionário retornado é uma cópia que pode ser alterada à vontade.
         """
-        import json
-        import os
-        from django.conf import settings
-        # carrega o arquivo de planos
-        with open(os.path.join(settings.BASE_DIR, 'subscription/plans.json'), 'r') as f:
-            plans = json.load(f)
-        return plans
+        return plan_catalog.products.get_data()
+
+    def get_plan(self) -> Plan:
+        """
+        Retorna o produto compilado (imutável) correspondente a esse conteúdo pago
+        """
+        return plan_catalog.get_plan(self.stripe_id)  # acesso direto proposital p dar keyerror se não existir
 
     def get_data(self) -> dict:
         """
-        Pega os dados do produto pagável, compilando informações do json e do bd
+        Pega os dados do produto pagável, compilando informações do json e do bd. Os valores aninhados vêm do catálogo
+        e são somente leitura (use `get_plan().as_dict()` se precisar de uma cópia mutável).
         """
-        plans = self.get_products()
-        plan = plans[self.stripe_id]  # acesso direto proposital p dar keyerror se não existir. se vira aí pra tratar <3
-        plan['expiration_date'] = self.expiration_date
-        plan['start_date'] = self.start_date
-        return plan
+        plan = self.get_plan()  # acesso direto proposital p dar keyerror se não existir. se vira aí pra tratar <3
+        return {**plan.raw, 'expiration_date': self.expiration_date, 'start_date': self.start_date}
 
     @classmethod
-    def register_purchase(cls, stripe_id: str, customer: 'Customer') -> 'PaidContent':
-        """ Preenche os dados de uma assinatura com base nos planos definidos no arquivo json.
+    def build_purchase(cls, plan: Plan, customer_id: int, start_date=None,
+                       stripe_event_id: str = None) -> 'PaidContent':
+        """ Monta (sem salvar) a compra de um plano, com os dados definidos no arquivo json
 
         Args:
-            stripe_id: id do plano no stripe
-            customer: objeto customer que realizou a assinatura
+            plan: plano comprado
+            customer_id: id do cliente que realizou a compra
+            start_date: início da vigência (padrão: agora)
+            stripe_event_id: id do evento do Stripe que gerou a compra
         """
-        from datetime import timedelta
-
-        plans = cls.get_products()
-        # pega o plano do cliente
-        plan = plans[stripe_id]
-
-        purchase = cls(customer=customer, stripe_id=stripe_id)
+        purchase = cls(customer_id=customer_id, stripe_id=plan.id, stripe_event_id=stripe_event_id)
         # pega o valor da assinatura
-        purchase.value = plan['value']
+        purchase.value = plan.value
 
         # pega a data de inicio da assinatura
-        purchase.start_date = timezone.localtime(timezone.now())
+        purchase.start_date = start_date or timezone.localtime(timezone.now())
 
         # calcula a data de vencimento da assinatura
-        if expiration_time := plan.get('expiration_time'):
+        if expiration_time := plan.expiration_time:
             purchase.expiration_date = purchase.start_date + timedelta(days=expiration_time)
 
-        purchase.type = plan['type']
-        purchase.is_exclusive = plan['signature_exclusive']
-        if purchase.is_exclusive and purchase.type == cls.Types.SIGNATURE:
-            active_signature = customer.get_active_signature()
-            if active_signature.is_exclusive:
-                # se a assinatura for exclusiva, cancela todas as outras assinaturas do cliente
-                active_signature.expiration_date = timezone.localtime(timezone.now())
-                active_signature.save()
-
-        # salva a assinatura
-        purchase.save()
+        purchase.type = plan.type
+        purchase.is_exclusive = plan.signature_exclusive
         return purchase
 
+    @classmethod
+    def register_purchase(cls, stripe_id: str, customer: 'Customer', stripe_event_id: str = None) -> 'PaidContent':
+        """ Preenche os dados de uma assinatura com base nos planos definidos no arquivo json.
+
+        Args:
+            stripe_id: id do plano no stripe
+            customer: objeto customer que realizou a assinatura
+            stripe_event_id: id do evento do Stripe que gerou a compra. Se informado e a compra desse evento já tiver
+                sido registrada, retorna a compra existente em vez de registrar de novo
+        """
+        # pega o plano do cliente
+        plan = plan_catalog.get_plan(stripe_id)
+
+        purchase = cls.build_purchase(plan, customer.id, stripe_event_id=stripe_event_id)
+        purchase.customer = customer
+        try:
+            with transaction.atomic():
+                if stripe_event_id is not None:
+                    existing = cls.objects.filter(stripe_event_id=stripe_event_id).first()
+                    if existing is not None:
+                        return existing
+
+                if purchase.is_exclusive and purchase.type == cls.Types.SIGNATURE:
+                    active_signature = customer.get_active_signature()
+                    # a assinatura free virtual (sem pk) não tem o que cancelar no BD
+                    if active_signature.pk and active_signature.is_exclusive:
+                        # se a assinatura for exclusiva, cancela todas as outras assinaturas do cliente
+                        active_signature.expiration_date = timezone.localtime(timezone.now())
+                        active_signature.save()
+
+                # salva a assinatura
+                purchase.save()
+
+                # concede os créditos do plano, se houver
+                if plan.credits:
+                    CreditBalance.grant(customer.id, plan.credits, reason=stripe_id)
+        except IntegrityError:
+            # o stripe_event_id é único: se outra transação registrou a compra do mesmo evento entre a verificação e o
+            # INSERT, tudo o que foi feito aqui é desfeito e a compra dela é retornada
+            existing = cls.objects.filter(stripe_event_id=stripe_event_id).first() if stripe_event_id else None
+            if existing is None:
+                raise
+            return existing
+        return purchase
+
+    @classmethod
+    def bulk_register_purchases(cls, purchases: Iterable[tuple]) -> List['PaidContent']:
+        """ Versão em lote do register_purchase, pra muitos clientes de uma vez (migração de planos, concessão de
+        assinaturas pra empresas etc.). Tudo acontece em uma transação, com uma quantidade de consultas que não depende
+        da quantidade de compras (ver insert_purchases).
+
+        Args:
+            purchases: pares (cliente ou id do cliente, id do plano no stripe)
+
+        Returns:
+            As compras registradas
+        """
+        start_date = timezone.localtime(timezone.now())
+        return cls.insert_purchases([
+            cls.build_purchase(plan_catalog.get_plan(stripe_id),
+                               customer.id if isinstance(customer, Customer) else customer, start_date=start_date)
+            for customer, stripe_id in purchases
+        ])
+
+    @classmethod
+    def insert_purchases(cls, purchases: List['PaidContent']) -> List['PaidContent']:
+        """ Grava em lote compras montadas com build_purchase, em uma transação, respeitando a exclusividade das
+        assinaturas: as assinaturas exclusivas ativas dos clientes são buscadas em uma única consulta e, em cada
+        cliente, toda assinatura exclusiva (existente ou nova) vence no início da próxima. As existentes que forem
+        substituídas são vencidas em um único UPDATE e as novas são inseridas com um único bulk_create.
+
+        As compras podem ter datas de início no passado (ex.: reprocessamento de eventos do Stripe).
+
+        Returns:
+            As compras gravadas
+        """
+        if not purchases:
+            return []
+        min_date = datetime.min.replace(tzinfo=dt_timezone.utc)
+
+        def start_of(signature):
+            return signature.start_date or min_date
+
+        new_exclusive = {}
+        for purchase in purchases:
+            if purchase.is_exclusive and purchase.type == cls.Types.SIGNATURE:
+                new_exclusive.setdefault(purchase.customer_id, []).append(purchase)
+
+        with transaction.atomic():
+            timelines = {customer_id: list(items) for customer_id, items in new_exclusive.items()}
+            if new_exclusive:
+                for signature in cls.active_signatures_queryset().filter(customer_id__in=list(new_exclusive),
+                                                                          is_exclusive=True):
+                    timelines[signature.customer_id].append(signature)
+            expirations = {}
+            for timeline in timelines.values():
+                # em caso de empate, a assinatura que já existia é a substituída
+                timeline.sort(key=lambda signature: (start_of(signature), signature.pk is None))
+                for current, following in zip(timeline, timeline[1:]):
+                    if current.expiration_date is None or current.expiration_date > start_of(following):
+                        current.expiration_date = start_of(following)
+                        if current.pk is not None:
+                            expirations[current.pk] = current.expiration_date
+            if len(set(expirations.values())) == 1:
+                # caso comum (compras feitas agora): todas vencem no mesmo momento
+                cls.objects.filter(id__in=list(expirations)).update(expiration_date=next(iter(expirations.values())))
+            elif expirations:
+                cls.objects.filter(id__in=list(expirations)).update(expiration_date=Case(
+                    *[When(id=signature_id, then=Value(date)) for signature_id, date in expirations.items()],
+                    output_field=models.DateTimeField()))
+
+            cls.objects.bulk_create(purchases)
+
+            # concede os créditos dos planos, se houver
+            credits = {}
+            for purchase in purchases:
+                amount = purchase.get_plan().credits
+                if amount:
+                    plan_credits = credits.setdefault(purchase.stripe_id, {})
+                    plan_credits[purchase.customer_id] = plan_credits.get(purchase.customer_id, 0) + amount
+            for stripe_id, amounts in credits.items():
+                CreditBalance.grant_many(amounts, reason=stripe_id)
+
+            for customer_id in {purchase.customer_id for purchase in purchases}:
+                invalidate_customer_entitlements(customer_id)
+        return purchases
+
     def has_expired(self) -> bool:
         """Verifica se a assinatura expirou.
 
@@ -308,15 +634,38 @@ class UserProfile(BaseModel):
                                        max_length=3)
     available_features = models.CharField(verbose_name=t('Funcionalidades Disponíveis'), max_length=255, null=True,
                                           blank=True)
+    # available_features em forma de máscara de bits (ver Feature). Nulo enquanto o perfil não tiver sido migrado
+    features_mask = models.BigIntegerField(verbose_name=t('Máscara de Funcionalidades'), null=True, blank=True)
 
     class Meta:
         verbose_name = t('Perfil de Usuário')
         verbose_name_plural = t('Perfis de Usuários')
         unique_together = ['user', 'client']
+        indexes = [
+            # listagem paginada dos perfis de um cliente (ordenada pela pk)
+            models.Index(fields=['client', 'id'], name='userprofile_client_id_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.email} ({self.client.name})'
 
+    def save(self, *args, **kwargs):
+        self.features_mask = feature_registry.get_mask(self.get_feature_set())
+        if kwargs.get('update_fields') is not None and 'available_features' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'features_mask'}
+        super().save(*args, **kwargs)
+        invalidate_user_entitlements(self.user_id)
+        invalidate_customer_entitlements(self.client_id)
+
+    def delete(self, *args, **kwargs):
+        user_id, client_id = self.user_id, self.client_id
+        result = super().delete(*args, **kwargs)
+        invalidate_user_entitlements(user_id)
+        invalidate_customer_entitlements(client_id)
+        # os tokens já emitidos carregam o acesso do perfil removido
+        RevokedToken.revoke_user(user_id)
+        return result
+
     @staticmethod
     def new_profile(data: dict) -> Optional["UserProfile"]:
         """
@@ -329,6 +678,108 @@ class UserProfile(BaseModel):
         except Exception as e:
             log_error(e)
 
+    @staticmethod
+    def build_invite_email(user: SystemUser, customer_name: str, token: str) -> 'OutgoingEmail':
+        """
+        Monta (sem gravar) o email de convite de um usuário recém-criado, com o token de reset de senha que ativa a
+        conta. O link é montado a partir de SUBSCRIPTION_INVITE_URL
+        (ex.: 'https://app.exemplo.com/ativar?token={token}')
+        """
+        invite_url = getattr(settings, 'SUBSCRIPTION_INVITE_URL', None)
+        activation = f'acesse {invite_url.format(token=token)}' if invite_url else f'use o código {token}'
+        return OutgoingEmail(
+            subject='Você foi convidado(a)!',
+            body=f'Olá, {user.first_name or user.email}! Você foi convidado(a) por {customer_name} para acessar o '
+                 f'nosso sistema. Para ativar a sua conta e definir a sua senha, {activation}.',
+            to=[user.email])
+
+    @classmethod
+    def bulk_invite(cls, customer: Customer, invites: List[dict]) -> List[dict]:
+        """
+        Adiciona vários usuários a um cliente de uma vez, com uma quantidade constante de consultas: os usuários que já
+        existem são buscados com um único `email__in`, e os usuários que faltam, os perfis, os tokens de ativação e os
+        convites são criados com um bulk_create cada. Deve ser chamado dentro de uma transação.
+
+        Args:
+            customer: cliente que recebe os perfis
+            invites: linhas com `email`, `allowed_actions` e, opcionalmente, `name`
+
+        Returns:
+            Resultado de cada linha, na mesma ordem: `email`, `status` ('invited' pra usuário novo, convidado por email;
+            'added' pra usuário que já existia; 'exists' se ele já tinha perfil no cliente; 'error') e `profile_id` ou
+            `error`
+        """
+        from django.core.exceptions import ValidationError
+        from django.core.validators import validate_email
+        from django_rest_passwordreset.models import ResetPasswordToken
+
+        results, rows = [], {}
+        for invite in invites:
+            email = str(invite.get('email') or '').strip() if isinstance(invite, dict) else ''
+            result = {'email': email, 'status': 'error'}
+            results.append(result)
+            try:
+                validate_email(email)
+            except ValidationError:
+                result['error'] = t('Endereço de email inválido')
+                continue
+            if invite.get('allowed_actions') not in AllowedActions.values:
+                result['error'] = t('Permissão inválida')
+            elif email in rows:
+                result['error'] = t('Email repetido')
+            else:
+                rows[email] = (invite, result)
+
+        users = {user.email: user for user in SystemUser.objects.filter(email__in=list(rows))
+                 .select_related('profile')}
+        new_users = []
+        for email, (invite, result) in rows.items():
+            user = users.get(email)
+            if user is None:
+                user = SystemUser(email=email, first_name=invite.get('name') or '')
+                user.set_unusable_password()  # o usuário ativa a conta definindo a senha pelo link do convite
+                new_users.append(user)
+                users[email] = user
+                result['status'] = 'invited'
+                continue
+            profile = getattr(user, 'profile', None)
+            if profile is None:
+                result['status'] = 'added'
+            elif profile.client_id == customer.id:
+                result.update(status='exists', profile_id=profile.id)
+            else:
+                result['error'] = t('Usuário já tem perfil em outro cliente')
+        if new_users:
+            SystemUser.objects.bulk_create(new_users)
+            if any(user.pk is None for user in new_users):
+                # o BD não devolve as pks do bulk_create (ex.: SQLite no Django 3.2)
+                ids = dict(SystemUser.objects.filter(email__in=[user.email for user in new_users])
+                           .values_list('email', 'id'))
+                for user in new_users:
+                    user.pk = ids[user.email]
+
+        added = [(users[email], invite, result) for email, (invite, result) in rows.items() if
+                 result['status'] in ('invited', 'added')]
+        profiles = [cls(user=user, client=customer, allowed_actions=invite['allowed_actions'], features_mask=0)
+                    for user, invite, _ in added]
+        cls.objects.bulk_create(profiles)
+        if any(profile.pk is None for profile in profiles):
+            ids = dict(cls.objects.filter(user__in=[user.pk for user, _, _ in added]).values_list('user_id', 'id'))
+            for profile in profiles:
+                profile.pk = ids[profile.user_id]
+        for profile, (_, _, result) in zip(profiles, added):
+            result['profile_id'] = profile.pk
+
+        if new_users:
+            tokens = [ResetPasswordToken(user=user, key=ResetPasswordToken.generate_key()) for user in new_users]
+            ResetPasswordToken.objects.bulk_create(tokens)
+            OutgoingEmail.objects.bulk_create([cls.build_invite_email(token.user, customer.name, token.key)
+                                               for token in tokens])
+        for user, _, _ in added:
+            invalidate_user_entitlements(user.pk)
+        invalidate_customer_entitlements(customer.id)
+        return results
+
     def can_read(self) -> bool:
         """ Indica se a instância de usuário tem permissão para READ """
         return self.allowed_actions in AllowedActions.get_read_permissions()
@@ -345,17 +796,47 @@ class UserProfile(BaseModel):
         """ Indica se a instância de usuário tem permissão para CREATE """
         return self.allowed_actions in AllowedActions.get_create_permissions()
 
-    def get_available_features(self) -> List[str]:
+    def get_feature_set(self) -> FrozenSet[str]:
+        """ Retorna as features liberadas pro perfil (sem considerar o plano do cliente) """
+        return frozenset(self.available_features.split(',')) if self.available_features else frozenset()
+
+    def get_available_features(self, client_features: Iterable[str] = None) -> List[str]:
         """ Retorna a lista de códigos das funcionalidades disponíveis pro usuário com base no cliente dele
+
+        Args:
+            client_features: features do plano do cliente, se quem chama já as tiver em mãos (evita resolver a
+                assinatura ativa do cliente de novo)
         """
+        if not self.available_features or not self.client_id:
+            return []
+        if client_features is None:
+            client_features = self.client.available_features
         # Faz uma interseção pra garantir que o perfil não acesse funcionalidades que o cliente não tem acesso
-        return [] if not self.available_features or not self.client else list(
-            set(self.client.available_features).intersection(set(self.available_features.split(','))))
+        return list(self.get_feature_set().intersection(client_features))
+
+    def get_features_mask(self) -> int:
+        """ Retorna a máscara das features liberadas pro perfil (sem considerar o plano do cliente) """
+        if self.features_mask is None:
+            # perfil ainda não migrado pelo comando migrate_feature_masks
+            return feature_registry.get_mask(self.get_feature_set())
+        return self.features_mask
+
+    def get_available_features_mask(self) -> int:
+        """ Máscara das features disponíveis pro usuário, com base no plano do cliente dele """
+        if not self.client_id:
+            return 0
+        return self.get_features_mask() & feature_registry.get_plan_mask(
+            self.client.get_active_signature().get_plan())
 
     def can_access_feature(self, feature: str) -> bool:
         """ Verifica se o usuário tem acesso a uma determinada funcionalidade
         """
-        return feature in self.get_available_features()
+        return feature_registry.contains(self.get_available_features_mask(), feature)
+
+    def can_access_features(self, features: Iterable[str]) -> Dict[str, bool]:
+        """ Verifica de uma vez se o usuário tem acesso a cada uma das funcionalidades informadas
+        """
+        return feature_registry.check(self.get_available_features_mask(), features)
 
     def has_credits(self, price) -> bool:
         """
@@ -366,18 +847,634 @@ class UserProfile(BaseModel):
         Returns:
             True se o usuário puder gastar os créditos desejados
         """
-        return False if not self.client else self.client.has_quota(price)
+        if not self.client_id:
+            return False
+        if is_write_behind_enabled():
+            return price <= usage_counters.get_available_credits(self.client_id)
+        return price <= CreditBalance.get_balance(self.client_id)
 
-    def spend_credits(self, price) -> None:
+    def spend_credits(self, price, feature: str = None) -> bool:
         """
         Gasta créditos do usuário (pela RN, quem tem crédito é o Manager, então é um Profile que gasta os créditos de
-        um Manager)
+        um Manager). Com SUBSCRIPTION_USAGE_WRITE_BEHIND, o débito é acumulado em memória e gravado em lote
         Args:
             price: quantidade de créditos gasta
+            feature: feature que consumiu os créditos, pra registrar nos contadores de uso (opcional)
 
         Returns:
-            None
+            True se os créditos foram debitados, False se o Manager não tinha saldo suficiente
         """
-        if not self.client:
+        if not self.client_id:
+            return False
+        if is_write_behind_enabled():
+            return usage_counters.try_spend(self.client_id, price, feature)
+        return CreditBalance.debit(self.client_id, price, reason=f'profile:{self.id}')
+
+
+class CreditBalance(models.Model):
+    """Saldo de créditos de um cliente. O saldo é dividido em shards (várias linhas por cliente) pra que débitos
+    concorrentes do mesmo cliente não disputem o lock de uma única linha: cada débito tenta um shard aleatório com um
+    UPDATE condicional (saldo >= valor), sem ler o saldo antes. O saldo do cliente é a soma dos shards.
+
+    Toda movimentação também é registrada em CreditLedgerEntry, de modo que a soma do livro-razão de um cliente é sempre
+    igual à soma dos seus shards.
+
+    Attributes:
+        customer (models.ForeignKey): Cliente dono do saldo.
+        shard (models.PositiveSmallIntegerField): Número do shard.
+        balance (models.BigIntegerField): Saldo do shard.
+    """
+    customer = models.ForeignKey(to=Customer, on_delete=models.CASCADE, verbose_name=t('Cliente'),
+                                 related_name='credit_balances')
+    shard = models.PositiveSmallIntegerField(verbose_name=t('Shard'))
+    balance = models.BigIntegerField(verbose_name=t('Saldo'), default=0)
+
+    class Meta:
+        verbose_name = t('Saldo de Créditos')
+        verbose_name_plural = t('Saldos de Créditos')
+        unique_together = ['customer', 'shard']
+
+    @staticmethod
+    def get_shard_count() -> int:
+        return getattr(settings, 'SUBSCRIPTION_CREDIT_SHARDS', 8)
+
+    @classmethod
+    def get_balance(cls, customer_id: int) -> int:
+        """ Retorna o saldo de créditos do cliente (uma consulta, que lê no máximo uma linha por shard) """
+        return cls.objects.filter(customer_id=customer_id).aggregate(total=Sum('balance'))['total'] or 0
+
+    @classmethod
+    def _add_to_shard(cls, customer_id: int, shard: int, amount: int) -> None:
+        if cls.objects.filter(customer_id=customer_id, shard=shard).update(balance=F('balance') + amount):
             return
-        self.client.use_quota(price)
+        try:
+            with transaction.atomic():
+                cls.objects.create(customer_id=customer_id, shard=shard, balance=amount)
+        except IntegrityError:
+            # outra transação criou o shard nesse meio tempo
+            cls.objects.filter(customer_id=customer_id, shard=shard).update(balance=F('balance') + amount)
+
+    @classmethod
+    def grant(cls, customer_id: int, amount: int, reason: str = '') -> None:
+        """ Concede créditos ao cliente
+
+        Args:
+            customer_id: id do cliente
+            amount: quantidade de créditos
+            reason: motivo da concessão (ex.: stripe_id do plano comprado), registrado no livro-razão
+        """
+        with transaction.atomic():
+            cls._add_to_shard(customer_id, random.randrange(cls.get_shard_count()), amount)
+            CreditLedgerEntry.objects.create(customer_id=customer_id, amount=amount, reason=reason,
+                                             kind=CreditLedgerEntry.Kinds.GRANT)
+
+    @classmethod
+    def grant_many(cls, amounts: Dict[int, int], reason: str = '') -> None:
+        """ Concede créditos a vários clientes de uma vez. Todas as concessões vão pro shard 0 de cada cliente em um
+        único UPDATE
+
+        Args:
+            amounts: dicionário customer_id -> quantidade de créditos
+            reason: motivo das concessões, registrado no livro-razão
+        """
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(customer_id=customer_id, shard=0) for customer_id in amounts],
+                                    ignore_conflicts=True)
+            cls.objects.filter(customer_id__in=list(amounts), shard=0).update(balance=F('balance') + Case(
+                *[When(customer_id=customer_id, then=Value(amount)) for customer_id, amount in amounts.items()],
+                output_field=models.BigIntegerField()))
+            CreditLedgerEntry.objects.bulk_create([
+                CreditLedgerEntry(customer_id=customer_id, amount=amount, reason=reason,
+                                  kind=CreditLedgerEntry.Kinds.GRANT)
+                for customer_id, amount in amounts.items()])
+
+    @classmethod
+    def debit(cls, customer_id: int, amount: int, reason: str = '') -> bool:
+        """ Debita créditos do cliente, se ele tiver saldo suficiente
+
+        Args:
+            customer_id: id do cliente
+            amount: quantidade de créditos
+            reason: motivo do débito, registrado no livro-razão
+
+        Returns:
+            True se os créditos foram debitados, False se o cliente não tinha saldo suficiente
+        """
+        shard_count = cls.get_shard_count()
+        first_shard = random.randrange(shard_count)
+        with transaction.atomic():
+            for i in range(shard_count):
+                shard = (first_shard + i) % shard_count
+                if cls.objects.filter(customer_id=customer_id, shard=shard, balance__gte=amount).update(
+                        balance=F('balance') - amount):
+                    break
+            else:
+                # nenhum shard sozinho tem saldo suficiente, mas a soma deles pode ter (caminho raro)
+                if cls._consolidate(customer_id, amount) is None:
+                    return False
+            CreditLedgerEntry.objects.create(customer_id=customer_id, amount=-amount, reason=reason,
+                                             kind=CreditLedgerEntry.Kinds.DEBIT)
+        return True
+
+    @classmethod
+    def debit_many(cls, amounts: Dict[int, int], reason: str = '') -> Dict[int, int]:
+        """ Debita créditos de vários clientes de uma vez (usado pelo flush dos contadores de uso, que já verificou o
+        saldo em memória). Os débitos que cabem no shard 0 de cada cliente vão em um único UPDATE condicional, como no
+        `debit`; os outros juntam os shards do cliente. Como a verificação em memória tolera um saldo negativo (ver
+        UsageCounters), um débito maior que o saldo zera o saldo, e a diferença é registrada no livro-razão como saldo
+        negativo perdoado (OVERDRAFT), pra que o saldo nunca fique negativo e continue igual à soma do livro-razão
+
+        Args:
+            amounts: dicionário customer_id -> quantidade de créditos
+            reason: motivo dos débitos, registrado no livro-razão
+
+        Returns:
+            Dicionário customer_id -> créditos perdoados, dos clientes que não tinham saldo suficiente
+        """
+        overdrafts = {}
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(customer_id=customer_id, shard=0) for customer_id in amounts],
+                                    ignore_conflicts=True)
+            balances = dict(cls.objects.select_for_update().filter(customer_id__in=list(amounts), shard=0)
+                            .values_list('customer_id', 'balance'))
+            covered = {customer_id: amount for customer_id, amount in amounts.items()
+                       if balances[customer_id] >= amount}
+            if covered:
+                debit = Case(*[When(customer_id=customer_id, then=Value(amount)) for customer_id, amount in
+                               covered.items()], output_field=models.BigIntegerField())
+                cls.objects.filter(customer_id__in=list(covered), shard=0, balance__gte=debit).update(
+                    balance=F('balance') - debit)
+            for customer_id, amount in amounts.items():
+                if customer_id not in covered:
+                    debited = cls._consolidate(customer_id, amount, clamp=True)
+                    if debited < amount:
+                        overdrafts[customer_id] = amount - debited
+            CreditLedgerEntry.objects.bulk_create([
+                CreditLedgerEntry(customer_id=customer_id, amount=-amount, reason=reason,
+                                  kind=CreditLedgerEntry.Kinds.DEBIT)
+                for customer_id, amount in amounts.items()
+            ] + [
+                CreditLedgerEntry(customer_id=customer_id, amount=amount, reason=reason,
+                                  kind=CreditLedgerEntry.Kinds.OVERDRAFT)
+                for customer_id, amount in overdrafts.items()
+            ])
+        return overdrafts
+
+    @classmethod
+    def _consolidate(cls, customer_id: int, amount: int, clamp: bool = False) -> Optional[int]:
+        """ Junta o saldo de todos os shards do cliente em um só e debita dele. É o único caminho que trava as linhas do
+        cliente, por isso só é usado quando o débito não cabe em nenhum shard isolado
+
+        Args:
+            customer_id: id do cliente
+            amount: quantidade de créditos
+            clamp: se o saldo não cobrir o débito, debita o que houver (zerando o saldo) em vez de não debitar nada
+
+        Returns:
+            Quantidade debitada, ou None se o saldo não cobria o débito (sem clamp)
+        """
+        shards = list(cls.objects.select_for_update().filter(customer_id=customer_id).order_by('shard'))
+        total = sum(shard.balance for shard in shards)
+        if total < amount and not clamp:
+            return None
+        debited = min(total, amount)
+        if shards:
+            for shard in shards:
+                shard.balance = 0
+            shards[0].balance = total - debited
+            cls.objects.bulk_update(shards, ['balance'])
+        return debited
+
+
+class CreditLedgerEntry(models.Model):
+    """Livro-razão (somente inserção) das movimentações de créditos de um cliente. Periodicamente, as entradas antigas
+    são compactadas em uma única entrada do tipo SNAPSHOT, com a soma delas (comando compact_credit_ledger).
+
+    Attributes:
+        customer (models.ForeignKey): Cliente da movimentação.
+        kind (models.CharField): Tipo da movimentação.
+        amount (models.BigIntegerField): Quantidade de créditos (negativa em débitos).
+        reason (models.CharField): Motivo da movimentação.
+        created_at (models.DateTimeField): Momento da movimentação.
+    """
+
+    class Kinds(models.TextChoices):
+        GRANT = 'GRT', t('Concessão')
+        DEBIT = 'DEB', t('Débito')
+        OVERDRAFT = 'OVD', t('Saldo negativo perdoado')
+        SNAPSHOT = 'SNP', t('Saldo consolidado')
+
+    customer = models.ForeignKey(to=Customer, on_delete=models.CASCADE, verbose_name=t('Cliente'),
+                                 related_name='credit_ledger')
+    kind = models.CharField(verbose_name=t('Tipo'), max_length=3, choices=Kinds.choices)
+    amount = models.BigIntegerField(verbose_name=t('Quantidade'))
+    reason = models.CharField(verbose_name=t('Motivo'), max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(verbose_name=t('Data'), default=timezone.now)
+
+    class Meta:
+        verbose_name = t('Movimentação de Créditos')
+        verbose_name_plural = t('Movimentações de Créditos')
+        indexes = [
+            models.Index(fields=['customer', 'created_at'], name='creditledger_customer_idx'),
+        ]
+
+    @classmethod
+    def compact(cls, customer_id: int, before) -> int:
+        """ Substitui as movimentações do cliente anteriores a `before` por uma única entrada SNAPSHOT com a soma delas
+
+        Returns:
+            Quantidade de entradas compactadas
+        """
+        with transaction.atomic():
+            entries = cls.objects.filter(customer_id=customer_id, created_at__lt=before)
+            ids = list(entries.values_list('id', flat=True))
+            if len(ids) <= 1:
+                return 0
+            total = cls.objects.filter(id__in=ids).aggregate(total=Sum('amount'))['total'] or 0
+            cls.objects.filter(id__in=ids).delete()
+            cls.objects.create(customer_id=customer_id, amount=total, kind=cls.Kinds.SNAPSHOT, created_at=before,
+                               reason='compact')
+        return len(ids)
+
+
+class UsageCounter(models.Model):
+    """Contador de uso de uma feature por um cliente em um dia. É alimentado em lote pelos contadores em memória
+    (subscription.utils.usage.UsageCounters).
+
+    Attributes:
+        customer (models.ForeignKey): Cliente.
+        feature (models.CharField): Código da feature usada.
+        period (models.DateField): Dia do uso.
+        amount (models.BigIntegerField): Quantidade de usos no dia.
+    """
+    customer = models.ForeignKey(to=Customer, on_delete=models.CASCADE, verbose_name=t('Cliente'))
+    feature = models.CharField(verbose_name=t('Funcionalidade'), max_length=255)
+    period = models.DateField(verbose_name=t('Período'))
+    amount = models.BigIntegerField(verbose_name=t('Quantidade'), default=0)
+
+    class Meta:
+        verbose_name = t('Contador de Uso')
+        verbose_name_plural = t('Contadores de Uso')
+        unique_together = ['customer', 'feature', 'period']
+
+    @classmethod
+    def increment_many(cls, usage: Dict[tuple, int], period=None, batch_size: int = 200) -> None:
+        """ Soma o uso de vários pares (customer_id, feature) com UPSERTs de até `batch_size` linhas cada, pra não
+        passar do limite de parâmetros por comando do BD (4 por linha)
+
+        Args:
+            usage: dicionário (customer_id, feature) -> quantidade
+            period: dia do uso (padrão: hoje)
+            batch_size: quantidade máxima de linhas por comando
+        """
+        period = period or get_usage_period()
+        rows = [(customer_id, feature, period, amount) for (customer_id, feature), amount in usage.items()]
+        quote = connection.ops.quote_name
+        table = quote(cls._meta.db_table)
+        columns = ', '.join(quote(column) for column in ('customer_id', 'feature', 'period', 'amount'))
+        if connection.vendor in ('postgresql', 'sqlite'):
+            conflict = (f'ON CONFLICT ({quote("customer_id")}, {quote("feature")}, {quote("period")}) '
+                        f'DO UPDATE SET {quote("amount")} = {table}.{quote("amount")} + EXCLUDED.{quote("amount")}')
+        elif connection.vendor == 'mysql':
+            conflict = f'ON DUPLICATE KEY UPDATE {quote("amount")} = {quote("amount")} + VALUES({quote("amount")})'
+        else:
+            # backend sem UPSERT conhecido: faz um UPDATE/INSERT por linha
+            with transaction.atomic():
+                for customer_id, feature, row_period, amount in rows:
+                    if not cls.objects.filter(customer_id=customer_id, feature=feature, period=row_period).update(
+                            amount=F('amount') + amount):
+                        cls.objects.create(customer_id=customer_id, feature=feature, period=row_period, amount=amount)
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                placeholders = ', '.join(['(%s, %s, %s, %s)'] * len(batch))
+                cursor.execute(f'INSERT INTO {table} ({columns}) VALUES {placeholders} {conflict}',
+                               [value for row in batch for value in row])
+
+
+class StripeWebhookEvent(models.Model):
+    """Caixa de entrada dos webhooks do Stripe. O webhook só grava o evento aqui e responde na hora; o processamento
+    (registro da compra) é feito depois, em lotes, pelo comando process_stripe_webhooks. O id do evento é único, então
+    os reenvios do Stripe não geram eventos (nem compras) duplicados.
+
+    Attributes:
+        event_id (models.CharField): Id do evento no Stripe.
+        type (models.CharField): Tipo do evento (ex.: payment_intent.succeeded).
+        payload (models.JSONField): Corpo do webhook, como recebido.
+        status (models.CharField): Situação do processamento.
+        attempts (models.PositiveIntegerField): Quantidade de tentativas de processamento.
+        last_error (models.TextField): Erro da última tentativa que falhou.
+        available_at (models.DateTimeField): Momento a partir do qual o evento pode ser (re)processado.
+        received_at (models.DateTimeField): Momento do recebimento.
+        processed_at (models.DateTimeField): Momento em que o processamento terminou.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = 'PEN', t('Pendente')
+        DONE = 'DON', t('Processado')
+        IGNORED = 'IGN', t('Ignorado')
+        FAILED = 'ERR', t('Falhou')
+
+    event_id = models.CharField(verbose_name=t('ID do Evento'), max_length=255, unique=True)
+    type = models.CharField(verbose_name=t('Tipo'), max_length=255)
+    payload = models.JSONField(verbose_name=t('Conteúdo'))
+    status = models.CharField(verbose_name=t('Situação'), max_length=3, choices=Status.choices,
+                              default=Status.PENDING)
+    attempts = models.PositiveIntegerField(verbose_name=t('Tentativas'), default=0)
+    last_error = models.TextField(verbose_name=t('Último erro'), blank=True, default='')
+    available_at = models.DateTimeField(verbose_name=t('Disponível em'), default=timezone.now)
+    received_at = models.DateTimeField(verbose_name=t('Recebido em'), default=timezone.now)
+    processed_at = models.DateTimeField(verbose_name=t('Processado em'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = t('Evento do Stripe')
+        verbose_name_plural = t('Eventos do Stripe')
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='stripeevent_pending_idx'),
+        ]
+
+    def __str__(self):
+        return self.event_id
+
+    @classmethod
+    def receive(cls, payload: dict) -> None:
+        """ Grava o evento na caixa de entrada (um único INSERT). Eventos repetidos são ignorados """
+        cls.objects.bulk_create([cls(event_id=payload['id'], type=payload.get('type') or '', payload=payload)],
+                                ignore_conflicts=True)
+
+    def handle(self) -> bool:
+        """ Aplica o evento no sistema
+
+        Returns:
+            False se o evento não é de um tipo tratado (e foi ignorado)
+        """
+        from subscription.utils.stripe_events import parse_purchase_description
+        if self.type != 'payment_intent.succeeded':
+            return False
+        client_id, product_id = parse_purchase_description(self.payload['data']['object']['description'])
+        PaidContent.register_purchase(product_id, Customer.objects.get(id=client_id), stripe_event_id=self.event_id)
+        return True
+
+    @classmethod
+    def process_pending(cls, batch_size: int = 100, max_attempts: int = 5) -> Dict[str, int]:
+        """ Processa um lote de eventos pendentes, em uma transação. Cada evento roda em um savepoint próprio: se
+        falhar, só ele é desfeito e volta pra fila com espera exponencial (até `max_attempts` tentativas, depois fica
+        como FAILED). As linhas do lote ficam travadas até o fim da transação, então vários workers podem rodar ao
+        mesmo tempo sem processar o mesmo evento duas vezes
+
+        Returns:
+            Dicionário com a quantidade de eventos por situação final no lote
+        """
+        counts = {status: 0 for status in cls.Status.values}
+        with transaction.atomic():
+            events = list(cls.objects.select_for_update(
+                skip_locked=connection.features.has_select_for_update_skip_locked
+            ).filter(status=cls.Status.PENDING, available_at__lte=timezone.now()).order_by('available_at', 'id')[
+                :batch_size])
+            for event in events:
+                event.attempts += 1
+                started_at = time.perf_counter()
+                try:
+                    with transaction.atomic():
+                        handled = event.handle()
+                except Exception as e:
+                    log_error(e)
+                    event.last_error = repr(e)
+                    if event.attempts >= max_attempts:
+                        event.status = cls.Status.FAILED
+                        event.processed_at = timezone.now()
+                    else:
+                        event.available_at = timezone.now() + timedelta(seconds=2 ** event.attempts)
+                else:
+                    event.status = cls.Status.DONE if handled else cls.Status.IGNORED
+                    event.last_error = ''
+                    event.processed_at = timezone.now()
+                webhook_processing_seconds.observe(time.perf_counter() - started_at, status=event.status)
+                if event.processed_at is not None:
+                    webhook_lag_seconds.observe((event.processed_at - event.received_at).total_seconds(),
+                                                status=event.status)
+                counts[event.status] += 1
+            cls.objects.bulk_update(events, ['status', 'attempts', 'last_error', 'available_at', 'processed_at'])
+        counts['total'] = len(events)
+        return counts
+
+
+class OutgoingEmail(models.Model):
+    """Caixa de saída de emails. As views só gravam o email aqui, dentro da transação da requisição (se ela for
+    desfeita, o email também é), e o envio é feito depois, em lotes, pelo comando send_outgoing_emails, reaproveitando
+    uma única conexão com o servidor de email por lote.
+
+    Attributes:
+        subject (models.CharField): Assunto.
+        body (models.TextField): Corpo do email (texto).
+        from_email (models.CharField): Remetente (vazio usa o DEFAULT_FROM_EMAIL).
+        to (models.JSONField): Lista de destinatários.
+        status (models.CharField): Situação do envio.
+        attempts (models.PositiveIntegerField): Quantidade de tentativas de envio.
+        last_error (models.TextField): Erro da última tentativa que falhou.
+        available_at (models.DateTimeField): Momento a partir do qual o email pode ser (re)enviado.
+        created_at (models.DateTimeField): Momento em que o email foi gravado.
+        sent_at (models.DateTimeField): Momento do envio.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = 'PEN', t('Pendente')
+        SENT = 'SNT', t('Enviado')
+        FAILED = 'ERR', t('Falhou')
+
+    subject = models.CharField(verbose_name=t('Assunto'), max_length=255)
+    body = models.TextField(verbose_name=t('Corpo'))
+    from_email = models.CharField(verbose_name=t('Remetente'), max_length=255, blank=True, default='')
+    to = models.JSONField(verbose_name=t('Destinatários'))
+    status = models.CharField(verbose_name=t('Situação'), max_length=3, choices=Status.choices,
+                              default=Status.PENDING)
+    attempts = models.PositiveIntegerField(verbose_name=t('Tentativas'), default=0)
+    last_error = models.TextField(verbose_name=t('Último erro'), blank=True, default='')
+    available_at = models.DateTimeField(verbose_name=t('Disponível em'), default=timezone.now)
+    created_at = models.DateTimeField(verbose_name=t('Criado em'), default=timezone.now)
+    sent_at = models.DateTimeField(verbose_name=t('Enviado em'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = t('Email de Saída')
+        verbose_name_plural = t('Emails de Saída')
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='outgoingemail_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} ({", ".join(self.to)})'
+
+    @classmethod
+    def enqueue(cls, subject: str, body: str, to: List[str], from_email: str = None) -> 'OutgoingEmail':
+        """ Grava um email na caixa de saída (um único INSERT, na transação atual) """
+        return cls.objects.create(subject=subject, body=body, to=list(to), from_email=from_email or '')
+
+    def get_message(self, mail_connection=None) -> EmailMessage:
+        return EmailMessage(self.subject, self.body, self.from_email or None, self.to, connection=mail_connection)
+
+    def _failed(self, error: Exception, max_attempts: int) -> None:
+        self.last_error = repr(error)
+        if self.attempts >= max_attempts:
+            self.status = self.Status.FAILED
+        else:
+            self.available_at = timezone.now() + timedelta(seconds=2 ** self.attempts)
+
+    @classmethod
+    def send_pending(cls, batch_size: int = 100, max_attempts: int = 5) -> Dict[str, int]:
+        """ Envia um lote de emails pendentes por uma única conexão (get_connection do Django, então funciona com
+        qualquer EMAIL_BACKEND, inclusive o locmem dos testes). Um email que falha volta pra fila com espera exponencial
+        (até `max_attempts` tentativas, depois fica como FAILED). As linhas do lote ficam travadas até o fim da
+        transação, então vários workers podem rodar ao mesmo tempo sem enviar o mesmo email duas vezes
+
+        Returns:
+            Dicionário com a quantidade de emails por situação final no lote
+        """
+        counts = {status: 0 for status in cls.Status.values}
+        with transaction.atomic():
+            emails = list(cls.objects.select_for_update(
+                skip_locked=connection.features.has_select_for_update_skip_locked
+            ).filter(status=cls.Status.PENDING, available_at__lte=timezone.now()).order_by('available_at', 'id')[
+                :batch_size])
+            if emails:
+                mail_connection = get_connection()
+                try:
+                    mail_connection.open()
+                except Exception as e:
+                    # sem conexão, o lote inteiro volta pra fila
+                    log_error(e)
+                    for email in emails:
+                        email.attempts += 1
+                        email._failed(e, max_attempts)
+                else:
+                    try:
+                        for email in emails:
+                            email.attempts += 1
+                            try:
+                                mail_connection.send_messages([email.get_message(mail_connection)])
+                            except Exception as e:
+                                log_error(e)
+                                email._failed(e, max_attempts)
+                            else:
+                                email.status = cls.Status.SENT
+                                email.last_error = ''
+                                email.sent_at = timezone.now()
+                    finally:
+                        mail_connection.close()
+                for email in emails:
+                    counts[email.status] += 1
+                cls.objects.bulk_update(emails, ['status', 'attempts', 'last_error', 'available_at', 'sent_at'])
+        counts['total'] = len(emails)
+        return counts
+
+
+class SweepCheckpoint(models.Model):
+    """Posição em que parou uma varredura periódica (ex.: PaidContent.sweep_expired_signatures), pra que a próxima
+    execução continue dali.
+
+    Attributes:
+        name (models.CharField): Nome da varredura.
+        position (models.DateTimeField): Último valor processado da coluna varrida.
+        last_id (models.BigIntegerField): Id da última linha processada (desempate entre linhas com a mesma posição).
+        updated_at (models.DateTimeField): Momento da última atualização.
+    """
+    name = models.CharField(verbose_name=t('Nome'), max_length=100, unique=True)
+    position = models.DateTimeField(verbose_name=t('Posição'), null=True, blank=True)
+    last_id = models.BigIntegerField(verbose_name=t('Último id'), default=0)
+    updated_at = models.DateTimeField(verbose_name=t('Atualizado em'), auto_now=True)
+
+    class Meta:
+        verbose_name = t('Posição de Varredura')
+        verbose_name_plural = t('Posições de Varreduras')
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def get_for_update(cls, name: str) -> 'SweepCheckpoint':
+        """ Retorna a posição da varredura, travada até o fim da transação (duas execuções simultâneas da mesma
+        varredura se revezam em vez de processar o mesmo lote) """
+        cls.objects.get_or_create(name=name)
+        return cls.objects.select_for_update().get(name=name)
+
+
+class RevokedToken(models.Model):
+    """Revogação de tokens JWT. Cada linha revoga um token específico (chave `jti:<jti>`) ou todos os tokens emitidos
+    pra um usuário até um momento (chave `user:<id>`, com revoked_before). A verificação é feita pelo filtro de Bloom de
+    utils/revocation.py, que só consulta essa tabela quando o filtro acusa a chave.
+
+    Attributes:
+        key (models.CharField): Chave revogada.
+        revoked_before (models.DateTimeField): Tokens do usuário emitidos até esse momento estão revogados (nulo pra
+            jti).
+        revoked_at (models.DateTimeField): Momento da (última) revogação.
+        expires_at (models.DateTimeField): Depois disso os tokens revogados já expiraram, e a linha pode ser apagada.
+    """
+    key = models.CharField(verbose_name=t('Chave'), max_length=255, unique=True)
+    revoked_before = models.DateTimeField(verbose_name=t('Revogados antes de'), null=True, blank=True)
+    revoked_at = models.DateTimeField(verbose_name=t('Revogado em'))
+    expires_at = models.DateTimeField(verbose_name=t('Expira em'))
+
+    class Meta:
+        verbose_name = t('Token Revogado')
+        verbose_name_plural = t('Tokens Revogados')
+        indexes = [
+            # atualização incremental dos filtros dos workers
+            models.Index(fields=['revoked_at'], name='revokedtoken_revoked_at_idx'),
+            models.Index(fields=['expires_at'], name='revokedtoken_expires_at_idx'),
+        ]
+
+    def __str__(self):
+        return self.key
+
+    @staticmethod
+    def _publish(keys: List[str]) -> None:
+        """ Coloca as chaves no filtro do próprio processo assim que a transação commitar """
+        transaction.on_commit(lambda: revocation_list.add(keys))
+
+    @classmethod
+    def revoke_tokens(cls, tokens: Iterable) -> None:
+        """
+        Revoga tokens específicos (de acesso ou de refresh), a partir do jti de cada um. A linha vale até o token
+        expirar
+
+        Args:
+            tokens: tokens do simplejwt (ou dicts com o payload)
+        """
+        now = timezone.now()
+        revoked = [cls(key=get_token_key(token[jwt_settings.JTI_CLAIM]), revoked_at=now,
+                       expires_at=datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)) for token in tokens]
+        cls.objects.bulk_create(revoked, ignore_conflicts=True)
+        cls._publish([token.key for token in revoked])
+
+    @classmethod
+    def revoke_user(cls, user_id: int) -> None:
+        """
+        Revoga todos os tokens emitidos até agora pra um usuário (ex.: depois de uma troca de senha). Os tokens emitidos
+        depois, mesmo no mesmo segundo, continuam valendo (ver ISSUED_AT_CLAIM em utils/revocation.py). A linha vale até
+        o último refresh emitido antes da revogação expirar
+
+        Args:
+            user_id: id do usuário
+        """
+        now = timezone.now()
+        key = get_user_key(user_id)
+        fields = {'revoked_before': now, 'revoked_at': now, 'expires_at': now + jwt_settings.REFRESH_TOKEN_LIFETIME}
+        # numa corrida entre duas revogações, a mais nova prevalece, em qualquer ordem que elas cheguem
+        latest = {field: Greatest(field, Value(value, output_field=models.DateTimeField()))
+                  for field, value in fields.items()}
+        # UPDATE e, se o usuário ainda não tinha revogação, INSERT (o update_or_create faria SELECT FOR UPDATE antes)
+        if not cls.objects.filter(key=key).update(**latest):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(key=key, **fields)
+            except IntegrityError:
+                # outra revogação inseriu a linha depois do nosso UPDATE: tenta de novo sobre ela
+                cls.objects.filter(key=key).update(**latest)
+        cls._publish([key])
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        """ Apaga as revogações cujos tokens já expiraram. Retorna quantas foram apagadas """
+        deleted, _ = cls.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
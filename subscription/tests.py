@@ -1,3 +1,1628 @@
-from django.test import TestCase
+import base64
+import copy
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from typing import List, Tuple
+from unittest import mock
 
-# Create your tests here.
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import connection, transaction
+from django.db.models import Sum, QuerySet
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
+
+from subscription.api.auth.routes import router
+from subscription.models import SystemUser, Customer, PaidContent, UserProfile, RevokedToken, OutgoingEmail, \
+    StripeWebhookEvent, Feature, CreditBalance, CreditLedgerEntry, UsageCounter, SweepCheckpoint
+from subscription.utils.base_viewsets import CustomApiViewFilterClass
+from subscription.utils.benchmarks import run_benchmarks, compare, BENCHMARKS
+from subscription.utils.entitlements import entitlement_cache, invalidate_user_entitlements, TOKEN_CLAIM, \
+    get_customer_entitlements
+from subscription.utils.features import feature_registry
+from subscription.utils.hashing import hashing_pool, HashingPoolBusy
+from subscription.utils.metrics import metrics, QueryMetricsMiddleware
+from subscription.utils.pagination import KeysetPagination
+from subscription.utils.load_test import LoadTest, ROUTES, get_percentile, parse_mix
+from subscription.utils.plans import plan_catalog
+from subscription.utils.rate_limit import rate_limiter
+from subscription.utils.revocation import revocation_list, RevocationJWTAuthentication, set_issued_at
+from subscription.utils.synthetic import SyntheticDataGenerator
+from subscription.utils.usage import UsageCounters
+
+
+def create_customer(email: str = 'owner@example.com', name: str = 'Cliente') -> Customer:
+    owner = SystemUser.objects.create(email=email, first_name='Dono')
+    return Customer.objects.create(name=name, owner=owner)
+
+
+class ActiveSignatureTestCase(TestCase):
+    """ Testes da resolução da assinatura ativa do cliente (Customer.get_active_signature) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        now = timezone.now()
+        # histórico longo de assinaturas vencidas e compras pontuais, que não podem influenciar o resultado
+        PaidContent.objects.bulk_create([
+            PaidContent(customer=cls.customer, stripe_id='old', type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                        start_date=now - timedelta(days=60 + i), expiration_date=now - timedelta(days=30 + i))
+            for i in range(50)
+        ] + [
+            PaidContent(customer=cls.customer, stripe_id='ot', type=PaidContent.Types.ONE_TIME_ONLY,
+                        start_date=now - timedelta(days=i))
+            for i in range(10)
+        ])
+
+    def test_active_signature_is_resolved_in_a_single_query(self):
+        signature = PaidContent.objects.create(customer=self.customer, stripe_id='plan',
+                                               type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                                               start_date=timezone.now(),
+                                               expiration_date=timezone.now() + timedelta(days=30))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.customer.get_active_signature(), signature)
+
+    def test_exclusive_signature_has_priority(self):
+        now = timezone.now()
+        exclusive = PaidContent.objects.create(customer=self.customer, stripe_id='plan',
+                                               type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                                               start_date=now - timedelta(days=1))
+        PaidContent.objects.create(customer=self.customer, stripe_id='addon', type=PaidContent.Types.SIGNATURE,
+                                   is_exclusive=False, start_date=now)
+        self.assertEqual(self.customer.get_active_signature(), exclusive)
+
+    def test_most_recent_signature_wins_among_non_exclusive(self):
+        now = timezone.now()
+        PaidContent.objects.create(customer=self.customer, stripe_id='a', type=PaidContent.Types.SIGNATURE,
+                                   start_date=now - timedelta(days=2))
+        newest = PaidContent.objects.create(customer=self.customer, stripe_id='b', type=PaidContent.Types.SIGNATURE,
+                                            start_date=now - timedelta(days=1))
+        self.assertEqual(self.customer.get_active_signature(), newest)
+
+    def test_more_than_one_exclusive_signature_raises(self):
+        for stripe_id in ('a', 'b'):
+            PaidContent.objects.create(customer=self.customer, stripe_id=stripe_id, type=PaidContent.Types.SIGNATURE,
+                                       is_exclusive=True, start_date=timezone.now())
+        with self.assertRaises(Exception):
+            self.customer.get_active_signature()
+
+    def test_customer_without_signature_gets_virtual_free_signature_without_writes(self):
+        with self.assertNumQueries(1):
+            signature = self.customer.get_active_signature()
+        self.assertIsNone(signature.pk)
+        self.assertEqual(signature.stripe_id, 'free')
+
+    def test_free_signature_materialization_is_idempotent(self):
+        self.assertEqual(PaidContent.materialize_free_signatures([self.customer.id]), 1)
+        self.assertEqual(PaidContent.materialize_free_signatures([self.customer.id]), 0)
+        self.assertEqual(PaidContent.objects.filter(customer=self.customer, stripe_id='free').count(), 1)
+        self.assertIsNotNone(self.customer.get_active_signature().pk)
+
+
+class CreditBalanceTestCase(TestCase):
+    """ Testes do saldo de créditos em shards (CreditBalance) e do livro-razão (CreditLedgerEntry) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+
+    def get_ledger_total(self) -> int:
+        return CreditLedgerEntry.objects.filter(customer=self.customer).aggregate(total=Sum('amount'))['total'] or 0
+
+    def get_shards(self) -> list:
+        return list(CreditBalance.objects.filter(customer=self.customer).order_by('shard')
+                    .values_list('balance', flat=True))
+
+    def test_random_shard_debits_never_overdraw(self):
+        rng = random.Random(0)
+        with mock.patch('subscription.models.random', rng):
+            for _ in range(20):
+                CreditBalance.grant(self.customer.id, rng.randint(1, 10))
+            granted = self.customer.quota
+            spent = 0
+            for _ in range(200):
+                amount = rng.randint(1, 15)
+                balance = self.customer.quota
+                # o débito só é recusado quando a soma dos shards não cobre o valor
+                debited = self.customer.use_quota(amount)
+                self.assertEqual(debited, amount <= balance)
+                spent += amount if debited else 0
+                self.assertTrue(all(shard >= 0 for shard in self.get_shards()))
+        self.assertEqual(self.customer.quota, granted - spent)
+        self.assertEqual(self.get_ledger_total(), self.customer.quota)
+
+    def test_debit_larger_than_any_shard_consolidates_the_shards(self):
+        for shard in range(3):
+            with mock.patch('subscription.models.random.randrange', return_value=shard):
+                CreditBalance.grant(self.customer.id, 5)
+        self.assertTrue(CreditBalance.debit(self.customer.id, 12))
+        self.assertEqual(sorted(self.get_shards()), [0, 0, 3])
+        self.assertFalse(CreditBalance.debit(self.customer.id, 4))
+        self.assertEqual(self.customer.quota, 3)
+        self.assertEqual(self.get_ledger_total(), 3)
+
+    def test_shards_match_the_ledger_after_compact(self):
+        old = timezone.now() - timedelta(days=60)
+        for amount in (10, 20, 30):
+            CreditBalance.grant(self.customer.id, amount)
+        CreditBalance.debit(self.customer.id, 25)
+        CreditLedgerEntry.objects.filter(customer=self.customer).update(created_at=old)
+        CreditBalance.debit(self.customer.id, 5)
+        self.assertEqual(CreditLedgerEntry.compact(self.customer.id, timezone.now() - timedelta(days=30)), 4)
+        self.assertEqual(list(CreditLedgerEntry.objects.filter(customer=self.customer).order_by('created_at')
+                              .values_list('kind', 'amount')),
+                         [(CreditLedgerEntry.Kinds.SNAPSHOT, 35), (CreditLedgerEntry.Kinds.DEBIT, -5)])
+        self.assertEqual(self.get_ledger_total(), self.customer.quota)
+        self.assertEqual(self.customer.quota, 30)
+
+    def test_compact_command_is_idempotent(self):
+        for amount in (10, 20):
+            CreditBalance.grant(self.customer.id, amount)
+        CreditBalance.debit(self.customer.id, 7)
+        CreditLedgerEntry.objects.filter(customer=self.customer).update(created_at=timezone.now() - timedelta(days=60))
+        CreditBalance.grant(self.customer.id, 1)
+        out = io.StringIO()
+        call_command('compact_credit_ledger', stdout=out)
+        self.assertIn('3 movimentações de 1 clientes compactadas', out.getvalue())
+        entries = list(CreditLedgerEntry.objects.filter(customer=self.customer).values_list('kind', 'amount'))
+        out = io.StringIO()
+        call_command('compact_credit_ledger', stdout=out)
+        self.assertIn('0 movimentações', out.getvalue())
+        self.assertEqual(list(CreditLedgerEntry.objects.filter(customer=self.customer).values_list('kind', 'amount')),
+                         entries)
+        self.assertEqual(self.get_ledger_total(), self.customer.quota)
+        self.assertEqual(self.customer.quota, 24)
+
+
+@mock.patch.object(UsageCounters, '_ensure_thread')
+class UsageCountersTestCase(TestCase):
+    """ Testes dos contadores de uso com escrita adiada (UsageCounters) e da gravação em lote deles """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        CreditBalance.grant_many({cls.customer.id: 10})
+
+    def setUp(self):
+        # a thread de flush não é iniciada: os flushes são feitos pelo próprio teste
+        self.counters = UsageCounters(shard_count=2)
+
+    def get_usage(self) -> dict:
+        return dict(UsageCounter.objects.filter(customer=self.customer).values_list('feature', 'amount'))
+
+    def test_flush_writes_usage_and_debits_in_batch(self, _):
+        for _ in range(3):
+            self.counters.add(self.customer.id, 'auth')
+        self.assertTrue(self.counters.try_spend(self.customer.id, 4, 'export'))
+        self.assertEqual(self.counters.get_available_credits(self.customer.id), 6)
+        with CaptureQueriesContext(connection) as queries:
+            self.counters.flush()
+        # um UPSERT do uso e, nos saldos, criação e leitura dos shards 0, um UPDATE e o livro-razão
+        self.assertEqual(len([query for query in queries if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]),
+                         5)
+        self.assertEqual(self.get_usage(), {'auth': 3, 'export': 1})
+        self.assertEqual(self.customer.quota, 6)
+        self.assertEqual(self.counters.get_pending_credits(self.customer.id), 0)
+        self.assertEqual(self.counters.flushes, 1)
+
+    def test_large_flush_is_split_into_batches(self, _):
+        # 4 parâmetros por linha: um único comando passaria do limite de parâmetros do SQLite
+        usage = {(self.customer.id, f'feature-{i}'): i for i in range(10000)}
+        with CaptureQueriesContext(connection) as queries:
+            UsageCounter.increment_many(usage)
+            UsageCounter.increment_many(usage)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 100)
+        self.assertEqual(UsageCounter.objects.filter(customer=self.customer).count(), 10000)
+        self.assertEqual(UsageCounter.objects.get(customer=self.customer, feature='feature-9999').amount, 2 * 9999)
+
+    def test_failed_flush_is_merged_back_and_retried(self, _):
+        self.counters.add(self.customer.id, 'auth')
+        self.counters.try_spend(self.customer.id, 4, 'export')
+        with mock.patch.object(UsageCounter, 'increment_many', side_effect=RuntimeError), \
+                mock.patch('subscription.utils.usage.log_error') as log_error:
+            self.counters.flush()
+        log_error.assert_called_once()
+        self.assertEqual(self.get_usage(), {})
+        self.assertEqual(self.customer.quota, 10)
+        self.assertEqual(self.counters.get_pending_credits(self.customer.id), 4)
+        self.counters.flush()
+        self.assertEqual(self.get_usage(), {'auth': 1, 'export': 1})
+        self.assertEqual(self.customer.quota, 6)
+        self.assertEqual(self.counters.flushes, 1)
+
+    @override_settings(SUBSCRIPTION_USAGE_OVERDRAFT=5)
+    def test_overdraft_is_forgiven_instead_of_leaving_a_negative_balance(self, _):
+        self.assertTrue(self.counters.try_spend(self.customer.id, 13))
+        self.assertFalse(self.counters.try_spend(self.customer.id, 3))
+        self.counters.flush()
+        self.assertEqual(self.customer.quota, 0)
+        self.assertFalse(CreditBalance.objects.filter(customer=self.customer, balance__lt=0).exists())
+        self.assertEqual(list(CreditLedgerEntry.objects.filter(customer=self.customer, reason='usage')
+                              .order_by('kind').values_list('kind', 'amount')),
+                         [(CreditLedgerEntry.Kinds.DEBIT, -13), (CreditLedgerEntry.Kinds.OVERDRAFT, 3)])
+        total = CreditLedgerEntry.objects.filter(customer=self.customer).aggregate(total=Sum('amount'))['total']
+        self.assertEqual(total, 0)
+
+    def test_credits_being_flushed_still_count_as_pending(self, _):
+        self.assertTrue(self.counters.try_spend(self.customer.id, 8))
+        debit_many = CreditBalance.debit_many
+        spent_during_flush = []
+
+        def spend_before_commit(credits, **kwargs):
+            # o flush já tirou os 8 créditos dos contadores, mas o débito ainda não commitou
+            spent_during_flush.append(self.counters.try_spend(self.customer.id, 5))
+            self.assertEqual(self.counters.get_available_credits(self.customer.id), 2)
+            return debit_many(credits, **kwargs)
+
+        with mock.patch.object(CreditBalance, 'debit_many', side_effect=spend_before_commit):
+            self.counters.flush()
+        self.assertEqual(spent_during_flush, [False])
+        # depois do commit, o saldo é relido do BD, já com o débito
+        self.assertEqual(self.counters.get_available_credits(self.customer.id), 2)
+        self.assertEqual(self.counters.get_pending_credits(self.customer.id), 0)
+
+    def test_failed_flush_keeps_credits_pending(self, _):
+        self.assertTrue(self.counters.try_spend(self.customer.id, 8))
+        with mock.patch.object(CreditBalance, 'debit_many', side_effect=RuntimeError), \
+                mock.patch('subscription.utils.usage.log_error'):
+            self.counters.flush()
+        self.assertEqual(self.counters.get_pending_credits(self.customer.id), 8)
+        self.assertFalse(self.counters.try_spend(self.customer.id, 5))
+
+    def test_concurrent_spends_are_checked_one_at_a_time(self, _):
+        # as duas threads leem o saldo antes de qualquer uma registrar o gasto
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_balance(customer_id):
+            barrier.wait()
+            return 10
+
+        results = []
+        with mock.patch.object(CreditBalance, 'get_balance', side_effect=get_balance):
+            threads = [threading.Thread(target=lambda: results.append(self.counters.try_spend(self.customer.id, 6)))
+                       for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sorted(results), [False, True])
+        self.assertEqual(self.counters.get_pending_credits(self.customer.id), 6)
+
+    @override_settings(SUBSCRIPTION_USAGE_BALANCE_CACHE_SIZE=2)
+    def test_balance_cache_is_bounded(self, _):
+        counters = UsageCounters(shard_count=2)
+        customers = [self.customer] + [create_customer(f'other{i}@example.com') for i in range(2)]
+        for customer in customers:
+            counters.get_available_credits(customer.id)
+        self.assertEqual(len(counters._balances), 2)
+        with self.assertNumQueries(1):
+            # o mais antigo saiu do LRU e é relido
+            self.assertEqual(counters.get_available_credits(self.customer.id), 10)
+
+    def test_debit_many_consolidates_credits_spread_across_shards(self, _):
+        other = create_customer('other@example.com')
+        for shard in range(3):
+            with mock.patch('subscription.models.random.randrange', return_value=shard):
+                CreditBalance.grant(other.id, 4)
+        self.assertEqual(CreditBalance.debit_many({self.customer.id: 2, other.id: 9}), {})
+        self.assertEqual(self.customer.quota, 8)
+        self.assertEqual(other.quota, 3)
+
+
+PLANS_FOR_ROUTE_TESTS = {
+    'free': {'type': 'SIG', 'signature_exclusive': True, 'value': 0.0,
+             'purchased_content': [{'type': 'feature', 'id': 'auth'}]},
+}
+
+
+class PlansFileTestCase(TestCase):
+    """ Base dos testes que dependem do plans.json do projeto: grava `plans` em um BASE_DIR temporário """
+    plans = PLANS_FOR_ROUTE_TESTS
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(cls.base_dir, 'subscription'))
+        with open(os.path.join(cls.base_dir, 'subscription', 'plans.json'), 'w') as f:
+            json.dump(cls.plans, f)
+        cls.base_dir_override = override_settings(BASE_DIR=cls.base_dir)
+        cls.base_dir_override.enable()
+        plan_catalog.invalidate()
+        feature_registry.reset()
+        # as features do catálogo são registradas fora da transação da classe, como no deploy (migrate_feature_masks),
+        # e removidas no tearDownClass
+        feature_registry.register_catalog()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        Feature.objects.all().delete()
+        feature_registry.reset()
+        cls.base_dir_override.disable()
+        plan_catalog.invalidate()
+        shutil.rmtree(cls.base_dir)
+
+    def setUp(self):
+        # o BD de cada teste é desfeito, então nada do que ficou em cache de outro teste pode ser reaproveitado
+        cache.clear()
+        entitlement_cache.clear_local()
+        feature_registry.reset()
+        revocation_list.reset()
+        rate_limiter.reset()
+        self.client = APIClient()
+
+
+class BulkPurchaseTestCase(PlansFileTestCase):
+    """ Testes do registro de compras em lote (PaidContent.bulk_register_purchases) """
+
+    def test_bulk_registration_supersedes_exclusive_signatures_in_constant_queries(self):
+        customers = [create_customer(f'owner{i}@example.com') for i in range(20)]
+        old_signatures = PaidContent.objects.bulk_create([
+            PaidContent(customer=customer, stripe_id='old', type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                        start_date=timezone.now() - timedelta(days=1))
+            for customer in customers
+        ])
+        with self.assertNumQueries(5):
+            # savepoint, assinaturas ativas, UPDATE das substituídas, INSERT das novas e release do savepoint
+            purchases = PaidContent.bulk_register_purchases([(customer, 'free') for customer in customers])
+        self.assertEqual(len(purchases), 20)
+        self.assertFalse(PaidContent.active_signatures_queryset().filter(
+            id__in=[signature.id for signature in old_signatures]).exists())
+        for customer in customers:
+            self.assertEqual(customer.get_active_signature().stripe_id, 'free')
+
+    def test_repeated_customer_keeps_only_the_last_exclusive_signature_active(self):
+        customer = create_customer()
+        PaidContent.bulk_register_purchases([(customer.id, 'free'), (customer.id, 'free')])
+        self.assertEqual(PaidContent.active_signatures_queryset().filter(customer=customer, is_exclusive=True)
+                         .count(), 1)
+
+
+@override_settings(SUBSCRIPTION_PLANS_CHECK_INTERVAL=0)
+class PlanCatalogTestCase(PlansFileTestCase):
+    """ Testes da recarga do catálogo de planos (PlanCatalog/WatchedJsonFile) """
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.base_dir, 'subscription', 'plans.json')
+        self.write(self.plans)
+        plan_catalog.invalidate()
+        plan_catalog.plans
+        self.reloads = plan_catalog.products.reloads
+
+    def write(self, content, mtime_offset: int = 0):
+        with open(self.path, 'w') as f:
+            f.write(content if isinstance(content, str) else json.dumps(content))
+        # o mtime é forçado, pra que a mudança seja vista mesmo dentro da resolução do sistema de arquivos
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_offset * 10 ** 9))
+
+    def test_catalog_is_compiled_once_while_the_file_does_not_change(self):
+        for _ in range(10):
+            self.assertEqual(plan_catalog.get_plan('free').features, frozenset({'auth'}))
+        self.assertEqual(plan_catalog.products.reloads, self.reloads)
+
+    def test_mtime_change_without_content_change_does_not_recompile(self):
+        version = plan_catalog.version
+        self.write(self.plans, mtime_offset=10)
+        plan_catalog.plans
+        self.assertEqual(plan_catalog.products.reloads, self.reloads)
+        self.assertEqual(plan_catalog.version, version)
+
+    def test_content_change_recompiles_the_catalog(self):
+        version = plan_catalog.version
+        self.write({**self.plans, 'pro': {'type': 'SIG', 'signature_exclusive': True, 'value': 10.0,
+                                          'purchased_content': [{'type': 'feature', 'id': 'export'}]}},
+                   mtime_offset=10)
+        self.assertEqual(plan_catalog.get_plan('pro').features, frozenset({'export'}))
+        self.assertEqual(plan_catalog.products.reloads, self.reloads + 1)
+        self.assertNotEqual(plan_catalog.version, version)
+
+    def test_invalid_edit_keeps_the_last_good_catalog(self):
+        version = plan_catalog.version
+        with self.assertLogs('subscription.utils.plans', 'ERROR'):
+            self.write('{"free": {"type": "SIG",', mtime_offset=10)
+            self.assertEqual(plan_catalog.get_plan('free').features, frozenset({'auth'}))
+        self.assertEqual(plan_catalog.version, version)
+        # o arquivo inválido não é relido enquanto não mudar, e a correção seguinte é carregada normalmente
+        plan_catalog.plans
+        self.write({'free': {**self.plans['free'], 'value': 1.0}}, mtime_offset=20)
+        self.assertEqual(plan_catalog.get_plan('free').value, 1.0)
+
+    def test_invalid_file_on_first_load_raises(self):
+        self.write('[')
+        plan_catalog.invalidate()
+        with self.assertRaises(ValueError):
+            plan_catalog.plans
+
+
+class EntitlementCacheTestCase(PlansFileTestCase):
+    """ Testes do cache de entitlements (VersionedTwoTierCache) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.scope = f'customer:{cls.customer.id}'
+
+    def get_shared_entry(self) -> tuple:
+        version = entitlement_cache.get_version(self.scope)
+        return entitlement_cache.shared.get(entitlement_cache._key(self.scope, 'entitlements', version))
+
+    def test_version_is_bumped_on_commit(self):
+        version = entitlement_cache.get_version(self.scope)
+        with self.captureOnCommitCallbacks(execute=True):
+            PaidContent.objects.create(customer=self.customer, stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                       is_exclusive=True, start_date=timezone.now())
+            # antes do commit, as outras requisições continuam vendo a versão antiga
+            self.assertEqual(entitlement_cache.get_version(self.scope), version)
+        self.assertGreater(entitlement_cache.get_version(self.scope), version)
+
+    def test_version_is_not_bumped_on_rollback(self):
+        version = entitlement_cache.get_version(self.scope)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                PaidContent.objects.create(customer=self.customer, stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                           is_exclusive=True, start_date=timezone.now())
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(entitlement_cache.get_version(self.scope), version)
+
+    def test_bump_hides_entries_of_the_previous_version(self):
+        get_customer_entitlements(self.customer.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            PaidContent.register_purchase('free', self.customer)
+        with self.assertNumQueries(2):
+            # cliente e assinatura ativa, lidos de novo do BD
+            entitlements = get_customer_entitlements(self.customer.id)
+        self.assertIsNotNone(entitlements.signature_id)
+
+    def test_ttl_ends_at_the_signature_expiration(self):
+        now = timezone.now()
+        expiration_date = now + timedelta(seconds=30)
+        PaidContent.objects.create(customer=self.customer, stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                   is_exclusive=True, start_date=now, expiration_date=expiration_date)
+        get_customer_entitlements(self.customer.id)
+        _, expires_at = self.get_shared_entry()
+        self.assertAlmostEqual(expires_at, expiration_date.timestamp(), delta=1)
+        version = entitlement_cache.get_version(self.scope)
+        with mock.patch('subscription.utils.cache.time') as clock:
+            clock.time.return_value = expiration_date.timestamp() + 1
+            clock.monotonic.return_value = time.monotonic() + 31
+            # nem o LRU do processo nem o backend compartilhado devolvem a entrada depois do vencimento
+            self.assertIsNone(entitlement_cache.get(self.scope, 'entitlements', version=version))
+            entitlement_cache.clear_local()
+            self.assertIsNone(entitlement_cache.get(self.scope, 'entitlements', version=version))
+
+    def test_ttl_is_capped_by_the_cache_timeout(self):
+        PaidContent.objects.create(customer=self.customer, stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                   is_exclusive=True, start_date=timezone.now(),
+                                   expiration_date=timezone.now() + timedelta(days=30))
+        with override_settings(SUBSCRIPTION_ENTITLEMENT_CACHE_TIMEOUT=60):
+            get_customer_entitlements(self.customer.id)
+        _, expires_at = self.get_shared_entry()
+        self.assertAlmostEqual(expires_at, time.time() + 60, delta=1)
+
+    def test_expired_signature_is_not_cached(self):
+        signature = PaidContent.objects.create(customer=self.customer, stripe_id='free',
+                                               type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                                               start_date=timezone.now(),
+                                               expiration_date=timezone.now() + timedelta(seconds=30))
+        with mock.patch('subscription.utils.entitlements.timezone.now',
+                        return_value=signature.expiration_date + timedelta(seconds=1)):
+            get_customer_entitlements(self.customer.id, get_signature=lambda: signature)
+        self.assertIsNone(self.get_shared_entry())
+
+
+class FeatureRegistryTestCase(PlansFileTestCase):
+    """ Testes das máscaras de features (FeatureRegistry) e do comando migrate_feature_masks """
+    plans = {
+        'free': {'type': 'SIG', 'signature_exclusive': True, 'value': 0.0,
+                 'purchased_content': [{'type': 'feature', 'id': 'auth'}]},
+        'pro': {'type': 'SIG', 'signature_exclusive': True, 'value': 10.0,
+                'purchased_content': [{'type': 'feature', 'id': 'auth'}, {'type': 'feature', 'id': 'export'}]},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+
+    def create_profile(self, features: str, email: str = 'member@example.com') -> UserProfile:
+        user = SystemUser.objects.create(email=email)
+        return UserProfile.objects.create(user=user, client=self.customer, available_features=features)
+
+    def test_masks_round_trip(self):
+        mask = feature_registry.get_mask(['auth', 'export'])
+        self.assertEqual(feature_registry.get_codes(mask), frozenset({'auth', 'export'}))
+        self.assertEqual(feature_registry.check(feature_registry.get_mask(['export']), ['auth', 'export']),
+                         {'auth': False, 'export': True})
+        self.assertEqual(feature_registry.get_plan_mask(plan_catalog.get_plan('pro')), mask)
+
+    def test_reads_never_register_features(self):
+        feature_registry.get_mask(['auth'])
+        with self.assertNumQueries(0):
+            self.assertEqual(feature_registry.get_mask(['auth', 'unknown']), feature_registry.get_mask(['auth']))
+            self.assertFalse(feature_registry.contains(-1, 'unknown'))
+        profile = self.create_profile('auth,unknown')
+        self.assertFalse(Feature.objects.filter(code='unknown').exists())
+        self.assertEqual(profile.features_mask, feature_registry.get_mask(['auth']))
+
+    def test_registered_feature_is_visible_inside_the_same_transaction(self):
+        with transaction.atomic():
+            self.assertEqual(feature_registry.register(['reports', 'auth']), ['reports'])
+            self.assertTrue(feature_registry.contains(feature_registry.get_mask(['reports']), 'reports'))
+            profile = self.create_profile('reports')
+            self.assertTrue(feature_registry.contains(profile.features_mask, 'reports'))
+
+    def test_feature_registered_by_another_process_is_seen_after_the_reload_interval(self):
+        self.assertIsNone(feature_registry.get_bit('reports'))
+        Feature.objects.create(code='reports', bit=50)
+        self.assertIsNone(feature_registry.get_bit('reports'))
+        with override_settings(SUBSCRIPTION_FEATURE_RELOAD_INTERVAL=0):
+            self.assertEqual(feature_registry.get_bit('reports'), 50)
+
+    def test_command_registers_catalog_features_and_fills_masks(self):
+        Feature.objects.filter(code='export').delete()
+        feature_registry.reset()
+        # perfis gravados antes do registro de export (sem o bit dele) e antes da máscara existir
+        stale = self.create_profile('auth,export')
+        legacy = self.create_profile('auth', 'legacy@example.com')
+        UserProfile.objects.filter(id=legacy.id).update(features_mask=None)
+        out = io.StringIO()
+        call_command('migrate_feature_masks', stdout=out)
+        self.assertIn('Features registradas: export', out.getvalue())
+        stale.refresh_from_db()
+        legacy.refresh_from_db()
+        self.assertEqual(stale.features_mask, feature_registry.get_mask(['auth', 'export']))
+        self.assertEqual(legacy.features_mask, feature_registry.get_mask(['auth']))
+        # a segunda execução não tem nada pra fazer
+        out = io.StringIO()
+        call_command('migrate_feature_masks', stdout=out)
+        self.assertIn('Concluído: 0 perfis migrados.', out.getvalue())
+
+    @override_settings(ROOT_URLCONF='subscription.urls')
+    def test_migrate_registers_catalog_features(self):
+        # base recém-atualizada: nenhuma feature registrada, e o perfil gravado sem o bit de auth
+        Feature.objects.all().delete()
+        feature_registry.reset()
+        profile = UserProfile.objects.create(user=self.customer.owner, client=self.customer, available_features='auth')
+        PaidContent.register_purchase('free', self.customer)
+        self.client.force_authenticate(self.customer.owner)
+        self.assertEqual(self.client.get('/customers').status_code, 403)
+        with self.captureOnCommitCallbacks(execute=True):
+            emit_post_migrate_signal(verbosity=0, interactive=False, db='default')
+        self.assertEqual(set(Feature.objects.values_list('code', flat=True)), {'auth', 'export'})
+        profile.refresh_from_db()
+        self.assertEqual(profile.features_mask, feature_registry.get_mask(['auth']))
+        self.assertEqual(self.client.get('/customers').status_code, 200)
+
+    def test_new_catalog_version_registers_its_features(self):
+        stale = self.create_profile('auth,reports')
+        self.assertEqual(stale.features_mask, feature_registry.get_mask(['auth']))
+        plans = copy.deepcopy(self.plans)
+        plans['pro']['purchased_content'].append({'type': 'feature', 'id': 'reports'})
+        self.write_plans(plans)
+        self.addCleanup(self.write_plans, self.plans)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIn('reports', plan_catalog.get_plan('pro').features)
+        self.assertTrue(Feature.objects.filter(code='reports').exists())
+        stale.refresh_from_db()
+        self.assertEqual(stale.features_mask, feature_registry.get_mask(['auth', 'reports']))
+        self.assertEqual(feature_registry.get_codes(feature_registry.get_plan_mask(plan_catalog.get_plan('pro'))),
+                         frozenset({'auth', 'export', 'reports'}))
+
+    def write_plans(self, plans: dict) -> None:
+        with open(os.path.join(self.base_dir, 'subscription', 'plans.json'), 'w') as f:
+            json.dump(plans, f)
+        plan_catalog.invalidate()
+
+
+class RateLimitedView(CustomApiViewFilterClass):
+    """ View sem rota, com o limite de requisições da feature `related_module` """
+    related_module = 'auth'
+
+    def get(self, request):
+        return Response({})
+
+
+class RateLimitTestCase(PlansFileTestCase):
+    """ Testes do limite de requisições dos planos, nos dois backends (token buckets em memória e janelas no cache) """
+    plans = {
+        'free': {'type': 'SIG', 'signature_exclusive': True, 'value': 0.0,
+                 'purchased_content': [{'type': 'feature', 'id': 'auth'}, {'type': 'feature', 'id': 'reports'}],
+                 'rate_limits': {'auth': {'requests': 5, 'period': 60},
+                                 'reports': {'requests': 5, 'period': 60, 'burst': 2}}},
+    }
+    # início de uma janela de 60 segundos mais 15 segundos
+    now = 16667 * 60 + 15.0
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth,reports')
+        PaidContent.register_purchase('free', cls.customer)
+
+    def setUp(self):
+        super().setUp()
+        clock = mock.patch('subscription.utils.rate_limit.time')
+        self.clock = clock.start()
+        self.addCleanup(clock.stop)
+        self.clock.time.return_value = self.now
+        self.clock.monotonic.return_value = self.now
+
+    def get(self, feature: str = 'auth'):
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, self.owner)
+        return RateLimitedView.as_view(related_module=feature)(request)
+
+    def get_statuses(self, count: int, feature: str = 'auth') -> list:
+        return [self.get(feature).status_code for _ in range(count)]
+
+    def test_both_backends_enforce_the_same_limit(self):
+        # no token bucket, a próxima ficha chega em period / requests segundos; na janela, quando ela acaba
+        for cache_alias, retry_after in ((None, '12'), ('default', '45')):
+            with self.subTest(cache_alias=cache_alias), override_settings(SUBSCRIPTION_RATE_LIMIT_CACHE=cache_alias):
+                rejections = rate_limiter.rejections
+                self.assertEqual(self.get_statuses(5), [200] * 5)
+                response = self.get()
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(response['Retry-After'], retry_after)
+                self.assertEqual(rate_limiter.rejections, rejections + 1)
+
+    def test_token_bucket_refills_over_time(self):
+        self.assertEqual(self.get_statuses(6), [200] * 5 + [429])
+        self.clock.monotonic.return_value = self.now + 12
+        self.assertEqual(self.get_statuses(2), [200, 429])
+
+    def test_burst_limits_only_the_token_bucket(self):
+        self.assertEqual(self.get_statuses(3, 'reports'), [200, 200, 429])
+        with override_settings(SUBSCRIPTION_RATE_LIMIT_CACHE='default'):
+            # cada janela libera `requests` requisições, e não `burst`
+            self.assertEqual(self.get_statuses(6, 'reports'), [200] * 5 + [429])
+            self.clock.time.return_value = self.now + 45
+            self.assertEqual(self.get_statuses(1, 'reports'), [200])
+
+    def test_limit_is_shared_by_the_customer_profiles_only(self):
+        member = SystemUser.objects.create(email='member@example.com')
+        UserProfile.objects.create(user=member, client=self.customer, available_features='auth')
+        other = create_customer('other@example.com')
+        UserProfile.objects.create(user=other.owner, client=other, available_features='auth')
+        self.assertEqual(self.get_statuses(5), [200] * 5)
+        for user, status_code in ((member, 429), (other.owner, 200)):
+            request = APIRequestFactory().get('/')
+            force_authenticate(request, user)
+            self.assertEqual(RateLimitedView.as_view()(request).status_code, status_code)
+
+
+class StripeWebhookEventTestCase(PlansFileTestCase):
+    """ Testes da caixa de entrada de webhooks do Stripe (StripeWebhookEvent) """
+    plans = {
+        **PLANS_FOR_ROUTE_TESTS,
+        'pro': {'type': 'SIG', 'signature_exclusive': True, 'value': 10.0,
+                'purchased_content': [{'type': 'feature', 'id': 'auth'}, {'type': 'credits', 'amount': 10}]},
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+
+    def receive(self, event_id: str = 'evt_1', customer_id: int = None) -> None:
+        StripeWebhookEvent.receive({'id': event_id, 'type': 'payment_intent.succeeded', 'data': {
+            'object': {'description': f'{customer_id or self.customer.id}-pro'}}})
+
+    def make_available(self) -> None:
+        # pula a espera antes da próxima tentativa
+        StripeWebhookEvent.objects.update(available_at=timezone.now())
+
+    def test_duplicate_delivery_is_ignored(self):
+        self.receive()
+        self.receive()
+        self.assertEqual(StripeWebhookEvent.objects.count(), 1)
+        self.assertEqual(StripeWebhookEvent.process_pending()['DON'], 1)
+        self.assertEqual(StripeWebhookEvent.process_pending()['total'], 0)
+        purchase = PaidContent.objects.get(stripe_event_id='evt_1')
+        # o mesmo evento registrado de novo (ex.: reconciliação) devolve a compra existente
+        self.assertEqual(PaidContent.register_purchase('pro', self.customer, stripe_event_id='evt_1'), purchase)
+        self.assertEqual(self.customer.quota, 10)
+
+    def test_concurrent_registration_of_the_same_event_keeps_the_first_purchase(self):
+        PaidContent.register_purchase('free', self.customer)
+        purchase = PaidContent.register_purchase('pro', self.customer, stripe_event_id='evt_1')
+        first = QuerySet.first
+        calls = []
+
+        def first_missing_the_concurrent_insert(queryset):
+            # a verificação não enxerga a compra, como se a outra transação ainda não tivesse commitado
+            calls.append(queryset)
+            return None if len(calls) == 1 else first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', first_missing_the_concurrent_insert):
+            self.assertEqual(PaidContent.register_purchase('pro', self.customer, stripe_event_id='evt_1'), purchase)
+        self.assertEqual(self.customer.get_active_signature(), purchase)
+        self.assertEqual(PaidContent.objects.filter(stripe_id='pro').count(), 1)
+        self.assertEqual(self.customer.quota, 10)
+
+    def test_failed_event_is_retried_with_backoff(self):
+        self.receive(customer_id=999999)
+        with mock.patch('subscription.models.log_error'):
+            self.assertEqual(StripeWebhookEvent.process_pending()['PEN'], 1)
+        event = StripeWebhookEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('DoesNotExist', event.last_error)
+        self.assertAlmostEqual((event.available_at - timezone.now()).total_seconds(), 2, delta=1)
+        # antes da espera acabar, o evento não é processado de novo
+        self.assertEqual(StripeWebhookEvent.process_pending()['total'], 0)
+        self.make_available()
+        with mock.patch('subscription.models.log_error'):
+            StripeWebhookEvent.process_pending()
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 2)
+        self.assertAlmostEqual((event.available_at - timezone.now()).total_seconds(), 4, delta=1)
+
+    def test_poisoned_event_stops_being_retried_after_max_attempts(self):
+        self.receive(customer_id=999999)
+        self.receive('evt_2')
+        with mock.patch('subscription.models.log_error'):
+            counts = StripeWebhookEvent.process_pending(max_attempts=3)
+            # o evento com problema não atrapalha o resto do lote
+            self.assertEqual((counts['PEN'], counts['DON']), (1, 1))
+            for _ in range(2):
+                self.make_available()
+                StripeWebhookEvent.process_pending(max_attempts=3)
+        event = StripeWebhookEvent.objects.get(event_id='evt_1')
+        self.assertEqual((event.status, event.attempts), (StripeWebhookEvent.Status.FAILED, 3))
+        self.assertIsNotNone(event.processed_at)
+        self.make_available()
+        self.assertEqual(StripeWebhookEvent.process_pending(max_attempts=3)['total'], 0)
+
+
+class ReconcileStripeEventsTestCase(PlansFileTestCase):
+    """ Testes do comando reconcile_stripe_events """
+    plans = StripeWebhookEventTestCase.plans
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.other = create_customer('other@example.com')
+        # compra registrada antes da caixa de entrada de webhooks, sem o id do evento
+        cls.legacy = PaidContent.register_purchase('pro', cls.customer)
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.base_dir, 'export.ndjson')
+        self.addCleanup(os.remove, self.path)
+
+    def reconcile(self, events: list, *args) -> str:
+        with open(self.path, 'w') as f:
+            for event_id, customer, created in events:
+                f.write(json.dumps({'id': event_id, 'type': 'payment_intent.succeeded',
+                                    'created': int(created.timestamp()),
+                                    'data': {'object': {'description': f'{customer.id}-pro'}}}) + '\n')
+        out = io.StringIO()
+        call_command('reconcile_stripe_events', self.path, *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def get_events(self) -> list:
+        paid_at = self.legacy.start_date - timedelta(minutes=5)
+        return [('evt_legacy', self.customer, paid_at), ('evt_new', self.other, paid_at)]
+
+    def test_dry_run_reports_without_writing(self):
+        output = self.reconcile(self.get_events(), '--dry-run')
+        self.assertIn(f'= evt_legacy cliente={self.customer.id} produto=pro compra={self.legacy.id}', output)
+        self.assertIn(f'+ evt_new cliente={self.other.id} produto=pro', output)
+        self.assertIn('1 compras antigas associadas aos eventos, 1 compras faltando', output)
+        self.legacy.refresh_from_db()
+        self.assertIsNone(self.legacy.stripe_event_id)
+        self.assertEqual(PaidContent.objects.count(), 1)
+        self.assertEqual((self.customer.quota, self.other.quota), (10, 0))
+
+    def test_legacy_purchase_is_not_registered_again(self):
+        self.reconcile(self.get_events())
+        self.legacy.refresh_from_db()
+        self.assertEqual(self.legacy.stripe_event_id, 'evt_legacy')
+        self.assertEqual(PaidContent.objects.filter(customer=self.customer).count(), 1)
+        self.assertEqual(PaidContent.objects.get(customer=self.other).stripe_event_id, 'evt_new')
+        # os créditos da compra antiga não são concedidos de novo
+        self.assertEqual((self.customer.quota, self.other.quota), (10, 10))
+        output = self.reconcile(self.get_events())
+        self.assertIn('2 compras já registradas, 0 compras antigas associadas aos eventos, 0 compras registradas',
+                      output)
+
+    def test_legacy_purchase_is_matched_once_and_only_inside_the_window(self):
+        paid_at = self.legacy.start_date
+        output = self.reconcile([('evt_old', self.customer, paid_at - timedelta(days=10)),
+                                 ('evt_2', self.customer, paid_at - timedelta(hours=2)),
+                                 ('evt_1', self.customer, paid_at - timedelta(hours=1))], '--dry-run')
+        # só o evento mais próximo fica com a compra antiga
+        self.assertIn('= evt_1', output)
+        self.assertIn('+ evt_old', output)
+        self.assertIn('+ evt_2', output)
+        output = self.reconcile([('evt_1', self.customer, paid_at - timedelta(hours=1))], '--dry-run',
+                                '--legacy-window', '0.5')
+        self.assertIn('+ evt_1', output)
+
+    def test_malformed_lines_are_counted_and_skipped(self):
+        with open(self.path, 'w') as f:
+            f.write('{"id": "evt_broken", \n')
+            f.write(json.dumps({'type': 'payment_intent.succeeded'}) + '\n')
+            f.write(json.dumps({'id': 'evt_new', 'type': 'payment_intent.succeeded', 'created': '2024-13-45T00:00:00',
+                                'data': {'object': {'description': f'{self.other.id}-pro'}}}) + '\n')
+            f.write(json.dumps({'id': 'evt_ok', 'type': 'payment_intent.succeeded',
+                                'data': {'object': {'description': f'{self.other.id}-pro'}}}) + '\n')
+        out, err = io.StringIO(), io.StringIO()
+        call_command('reconcile_stripe_events', self.path, stdout=out, stderr=err)
+        self.assertIn('4 eventos lidos', out.getvalue())
+        self.assertIn('1 compras registradas, 0 eventos ignorados e 3 inválidos.', out.getvalue())
+        for line in (1, 2, 3):
+            self.assertIn(f'! linha {line} evento inválido', err.getvalue())
+        self.assertTrue(PaidContent.objects.filter(stripe_event_id='evt_ok').exists())
+
+    def test_claims_are_only_kept_in_memory_for_dry_runs(self):
+        paid_at = self.legacy.start_date
+        # o mesmo evento em dois lotes, e dois eventos que disputam a mesma compra antiga em lotes diferentes
+        events = [('evt_1', self.customer, paid_at), ('evt_2', self.customer, paid_at),
+                  ('evt_1', self.customer, paid_at)]
+        output = self.reconcile(events, '--chunk-size', '1')
+        self.assertIn('1 compras já registradas, 1 compras antigas associadas aos eventos, 1 compras registradas',
+                      output)
+        self.assertEqual(PaidContent.objects.filter(customer=self.customer).count(), 2)
+        self.assertEqual(set(PaidContent.objects.filter(customer=self.customer)
+                             .values_list('stripe_event_id', flat=True)), {'evt_1', 'evt_2'})
+
+
+class DuplicateFreeSignaturesTestCase(PlansFileTestCase):
+    """ Limpeza das assinaturas free sem vencimento duplicadas, que impediriam a criação da constraint única """
+
+    def setUp(self):
+        super().setUp()
+        # base anterior à constraint: ela é desfeita junto com a transação do teste
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX {connection.ops.quote_name("paidcontent_unique_open_free")}')
+
+    def create_free_signatures(self, customer: Customer, count: int) -> List[int]:
+        ids = []
+        for _ in range(count):
+            signature = PaidContent.build_free_signature(customer)
+            signature.save()
+            ids.append(signature.id)
+        return ids
+
+    def get_open_free_ids(self, customer: Customer) -> List[int]:
+        return list(PaidContent.objects.filter(customer=customer, stripe_id='free', expiration_date__isnull=True)
+                    .order_by('id').values_list('id', flat=True))
+
+    def test_keeps_the_oldest_open_free_signature(self):
+        customers = [create_customer(f'owner{i}@example.com') for i in range(3)]
+        created = [self.create_free_signatures(customer, count) for customer, count in zip(customers, (3, 1, 2))]
+        out = io.StringIO()
+        call_command('expire_duplicate_free_signatures', '--chunk-size', '1', stdout=out)
+        self.assertIn('Concluído: 3 assinaturas free duplicadas encerradas.', out.getvalue())
+        for customer, ids in zip(customers, created):
+            self.assertEqual(self.get_open_free_ids(customer), ids[:1])
+            self.assertEqual(customer.get_active_signature().id, ids[0])
+        self.assertEqual(PaidContent.objects.filter(stripe_id='free', expiration_date__isnull=False).count(), 3)
+        # a segunda execução não tem nada pra fazer, e a constraint já pode ser criada
+        out = io.StringIO()
+        call_command('expire_duplicate_free_signatures', stdout=out)
+        self.assertIn('Concluído: 0 assinaturas free duplicadas encerradas.', out.getvalue())
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE UNIQUE INDEX {quote("paidcontent_unique_open_free")} '
+                           f'ON {quote(PaidContent._meta.db_table)} ({quote("customer_id")}) '
+                           f"WHERE {quote('stripe_id')} = 'free' AND {quote('expiration_date')} IS NULL")
+
+class SweepExpiredSignaturesTestCase(PlansFileTestCase):
+    """ Testes da varredura das assinaturas vencidas (PaidContent.sweep_expired_signatures) """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.customers = [create_customer(f'owner{i}@example.com') for i in range(5)]
+        # os dois primeiros vencem no mesmo momento: o id desempata a posição salva
+        expirations = [now - timedelta(days=3), now - timedelta(days=3), now - timedelta(days=2),
+                       now - timedelta(days=1), now - timedelta(hours=1)]
+        for customer, expiration_date in zip(cls.customers, expirations):
+            PaidContent.objects.create(customer=customer, stripe_id='old', type=PaidContent.Types.SIGNATURE,
+                                       is_exclusive=True, start_date=now - timedelta(days=30),
+                                       expiration_date=expiration_date)
+        # o último cliente já tem outra assinatura ativa, então não é rebaixado
+        PaidContent.objects.create(customer=cls.customers[-1], stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                   is_exclusive=True, start_date=now, expiration_date=now + timedelta(days=30))
+
+    def sweep(self, *args) -> str:
+        out = io.StringIO()
+        call_command('sweep_expired_signatures', *args, stdout=out)
+        return out.getvalue()
+
+    def get_free_signatures(self) -> int:
+        return PaidContent.objects.filter(stripe_id='free', expiration_date__isnull=True).count()
+
+    def test_partial_run_resumes_from_the_checkpoint(self):
+        self.assertEqual(PaidContent.sweep_expired_signatures(batch_size=1, max_batches=1),
+                         {'signatures': 1, 'downgraded': 1})
+        checkpoint = SweepCheckpoint.objects.get(name='expired_signatures')
+        # a segunda assinatura tem a mesma posição da primeira, e só o id a separa
+        self.assertEqual(PaidContent.objects.filter(expiration_date=checkpoint.position).count(), 2)
+        self.assertIn('4 assinaturas vencidas verificadas, 3 clientes rebaixados', self.sweep('--batch-size', '1'))
+        self.assertEqual(self.get_free_signatures(), 4)
+
+    def test_failed_batch_is_retried_by_the_next_run(self):
+        materialize = PaidContent.materialize_free_signatures
+        calls = []
+
+        def fail_on_second_batch(customer_ids):
+            calls.append(customer_ids)
+            if len(calls) == 2:
+                raise RuntimeError
+            return materialize(customer_ids)
+
+        with mock.patch.object(PaidContent, 'materialize_free_signatures', side_effect=fail_on_second_batch), \
+                self.assertRaises(RuntimeError):
+            PaidContent.sweep_expired_signatures(batch_size=2)
+        # o lote que falhou foi desfeito junto com a posição dele
+        self.assertEqual(self.get_free_signatures(), 2)
+        self.assertEqual(PaidContent.sweep_expired_signatures(batch_size=2), {'signatures': 3, 'downgraded': 2})
+        self.assertEqual(self.get_free_signatures(), 4)
+
+    def test_second_run_does_nothing(self):
+        self.assertIn('5 assinaturas vencidas verificadas, 4 clientes rebaixados', self.sweep())
+        with self.assertNumQueries(5):
+            # savepoint, posição (get_or_create e leitura travada), lote vazio e release
+            output = self.sweep()
+        self.assertIn('0 assinaturas vencidas verificadas, 0 clientes rebaixados', output)
+        self.assertEqual(self.get_free_signatures(), 4)
+
+    def test_signatures_expired_after_the_checkpoint_are_picked_up(self):
+        self.sweep()
+        signature = PaidContent.objects.get(customer=self.customers[-1], stripe_id='free',
+                                            expiration_date__isnull=False)
+        signature.expiration_date = timezone.now() - timedelta(seconds=1)
+        signature.save()
+        self.assertIn('1 assinaturas vencidas verificadas, 1 clientes rebaixados', self.sweep())
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class KeysetPaginationTestCase(PlansFileTestCase):
+    """ Testes da paginação por cursor (utils/pagination.py), direto na paginação e pela rota /users """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+        PaidContent.register_purchase('free', cls.customer)
+        # todos entram no mesmo instante e metade tem o mesmo nome: só a pk desempata
+        date_joined = timezone.now().replace(microsecond=123456)
+        for i in range(7):
+            user = SystemUser.objects.create(email=f'member{i}@example.com', first_name='Ana' if i % 2 else 'Bia',
+                                             date_joined=date_joined)
+            UserProfile.objects.create(user=user, client=cls.customer, available_features='auth')
+
+    def paginate(self, queryset: QuerySet, url: str = '/users?page_size=2') -> Tuple[list, KeysetPagination]:
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(queryset, Request(APIRequestFactory().get(url)))
+        return page, paginator
+
+    def walk(self, queryset: QuerySet, link: str = '/users?page_size=2', direction: str = 'next') -> List[list]:
+        """ Segue os links numa direção, retornando as pks de cada página """
+        pages = []
+        while link:
+            page, paginator = self.paginate(queryset, link)
+            pages.append([obj.pk for obj in page])
+            link = paginator.get_next_link() if direction == 'next' else paginator.get_previous_link()
+        return pages
+
+    def walk_to_last(self, queryset: QuerySet) -> str:
+        link, last = '/users?page_size=2', None
+        while link:
+            last = link
+            link = self.paginate(queryset, link)[1].get_next_link()
+        return last
+
+    def test_ties_are_split_by_pk(self):
+        for ordering in (('date_joined',), ('-date_joined',), ('first_name', '-date_joined'), ('-first_name',)):
+            with self.subTest(ordering=ordering):
+                queryset = SystemUser.objects.order_by(*ordering)
+                expected = list(queryset.order_by(*ordering, '-pk' if ordering[-1].startswith('-') else 'pk')
+                                .values_list('pk', flat=True))
+                pages = self.walk(queryset)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+                self.assertEqual([len(page) for page in pages], [2, 2, 2, 2])
+
+    def test_previous_pages_mirror_the_next_ones(self):
+        queryset = SystemUser.objects.order_by('first_name', 'date_joined')
+        forward = self.walk(queryset)
+        _, paginator = self.paginate(queryset, '/users?page_size=2')
+        self.assertIsNone(paginator.get_previous_link())
+        # do fim pra trás, as mesmas páginas na ordem inversa
+        _, paginator = self.paginate(queryset, self.walk_to_last(queryset))
+        self.assertIsNone(paginator.get_next_link())
+        backward = self.walk(queryset, paginator.get_previous_link(), direction='previous')
+        self.assertEqual(backward[::-1], forward[:-1])
+        # e do começo de novo pra frente, a partir de uma página anterior
+        page, paginator = self.paginate(queryset, paginator.get_previous_link())
+        self.assertEqual([obj.pk for obj in page], forward[-2])
+        page, paginator = self.paginate(queryset, paginator.get_next_link())
+        self.assertEqual([obj.pk for obj in page], forward[-1])
+
+    def test_previous_page_of_deleted_rows_leads_to_the_first_page(self):
+        queryset = SystemUser.objects.order_by('email')
+        _, paginator = self.paginate(queryset)
+        page, paginator = self.paginate(queryset, paginator.get_next_link())
+        previous = paginator.get_previous_link()
+        UserProfile.objects.filter(user__email__lt=page[0].email).delete()
+        SystemUser.objects.filter(email__lt=page[0].email).delete()
+        page, paginator = self.paginate(queryset, previous)
+        self.assertEqual(page, [])
+        self.assertIsNone(paginator.get_previous_link())
+        self.assertEqual(paginator.get_next_link(), 'http://testserver/users?page_size=2')
+
+    def test_tampered_cursor_is_a_bad_request(self):
+        self.client.force_authenticate(self.owner)
+        position = [self.owner.email, self.owner.pk]
+        cursors = {
+            'base64 inválido': '%%%',
+            'json inválido': KeysetPagination.encode_cursor(position)[:-3],
+            'posição que não é uma lista': base64.urlsafe_b64encode(b'{"p": "x"}').decode(),
+            'tamanho errado': KeysetPagination.encode_cursor(position[:1]),
+            'valor que não é escalar': KeysetPagination.encode_cursor([self.owner.email, {'id': 1}]),
+            'pk que não é número': KeysetPagination.encode_cursor([self.owner.email, 'abc']),
+            'valor nulo': base64.urlsafe_b64encode(json.dumps({'p': [None, 1]}).encode()).decode(),
+        }
+        for name, cursor in cursors.items():
+            with self.subTest(name):
+                response = self.client.get('/users', {'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), {'cursor': ['Cursor inválido.']})
+        cursor = KeysetPagination.encode_cursor(['não é data', self.owner.pk])
+        with self.assertRaises(ValidationError):
+            self.paginate(SystemUser.objects.order_by('date_joined'), f'/users?cursor={cursor}')
+
+    def test_list_response_shape(self):
+        self.client.force_authenticate(self.owner)
+        response = self.client.get('/users', {'page_size': 3})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(list(body), ['next', 'previous', 'results'])
+        self.assertIsNone(body['previous'])
+        self.assertEqual(len(body['results']), 3)
+        self.assertTrue(body['next'].startswith('http://testserver/users?'))
+        body = self.client.get(f"{body['next']}&count=true").json()
+        self.assertEqual(list(body), ['next', 'previous', 'count', 'results'])
+        self.assertEqual(body['count'], 8)
+        self.assertIsNotNone(body['previous'])
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class RouteQueryBudgetTestCase(PlansFileTestCase):
+    """
+    Orçamento de consultas de cada rota de api/auth/routes.py, com os caches frios. Se uma mudança fizer alguma rota
+    passar do orçamento (ou uma rota nova for criada sem orçamento), o teste falha. Ao reduzir a quantidade de consultas
+    de uma rota, reduza também o orçamento dela aqui.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        cls.owner.set_password('Senha-antiga-123')
+        cls.owner.save()
+        cls.profile = UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+        PaidContent.register_purchase('free', cls.customer)
+        for i in range(30):
+            user = SystemUser.objects.create(email=f'member{i}@example.com')
+            UserProfile.objects.create(user=user, client=cls.customer, available_features='auth')
+        cls.new_user = SystemUser.objects.create(email='new@example.com')
+
+    def authenticate(self, user: SystemUser = None):
+        self.client.force_authenticate(user or self.owner)
+
+    def get_cases(self) -> dict:
+        """ Requisição e orçamento de cada rota, indexados pelo padrão da rota """
+        refresh = str(RefreshToken.for_user(self.owner))
+        payment = {'id': 'evt_1', 'type': 'payment_intent.succeeded',
+                   'data': {'object': {'description': f'{self.customer.id}-free'}}}
+        return {
+            'login/': (None, 'post', '/login/', {'email': self.owner.email, 'password': 'Senha-antiga-123'}, 1),
+            'login/refresh/': (None, 'post', '/login/refresh/', {'refresh': refresh}, 1),
+            'logout/': (None, 'post', '/logout/', {'refresh': refresh}, 2),
+            'register/': (None, 'post', '/register/', {'email': 'other@example.com', 'password': 'x',
+                                                       'first_name': 'Outro', 'last_name': 'Usuário'}, 4),
+            'register-validate/': (None, 'post', '/register-validate/', {'email': 'other@example.com'}, 1),
+            'complete-signup/': (self.new_user, 'post', '/complete-signup/', {'client_name': 'Novo'}, 8),
+            # a primeira revogação do usuário é um INSERT num savepoint (ver RevokedToken.revoke_user)
+            'change-password/': (self.owner, 'put', '/change-password/',
+                                 {'old_password': 'Senha-antiga-123', 'new_password': 'Senha-nova-456!'}, 5),
+            'get-profile': (self.owner, 'get', '/get-profile', None, 1),
+            'profiles': (self.owner, 'get', '/profiles', None, 4),
+            'profiles/bulk': (self.owner, 'post', '/profiles/bulk', {'invites': [
+                {'email': f'invite{i}@example.com', 'allowed_actions': 'VIE'} for i in range(20)]}, 12),
+            'profiles/<pk>': (self.owner, 'get', f'/profiles/{self.profile.id}', None, 4),
+            'users': (self.owner, 'get', '/users', None, 4),
+            'users/<pk>': (self.owner, 'get', f'/users/{self.owner.id}', None, 4),
+            'customers': (self.owner, 'get', '/customers', None, 4),
+            'customers/<pk>': (self.owner, 'get', f'/customers/{self.customer.id}', None, 4),
+            'users/export': (self.owner, 'get', '/users/export?output=csv', None, 4),
+            'customers/export': (self.owner, 'get', '/customers/export', None, 4),
+            'paid-contents/export': (self.owner, 'get', '/paid-contents/export', None, 4),
+            'register-purchase': (None, 'post', '/register-purchase', payment, 1),
+            'metrics': (None, 'get', '/metrics', None, 0),
+            '^u/change-password/': (None, 'post', '/u/change-password/', {'email': 'nobody@example.com'}, 2),
+        }
+
+    def test_every_route_has_a_query_budget(self):
+        self.assertEqual({str(route.pattern) for route in router}, set(self.get_cases()))
+
+    def test_routes_stay_within_query_budget(self):
+        for route, (user, method, url, data, budget) in self.get_cases().items():
+            # cada rota roda em um savepoint desfeito no fim, pra que uma não interfira na outra
+            with self.subTest(route=route), transaction.atomic():
+                self.setUp()
+                if user is not None:
+                    self.authenticate(user)
+                with CaptureQueriesContext(connection) as queries:
+                    # as views que leem request.POST só aceitam formulário; o webhook do Stripe manda json aninhado
+                    nested = any(isinstance(value, (dict, list)) for value in (data or {}).values())
+                    response = getattr(self.client, method)(url, data, format='json' if nested else None)
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                transaction.set_rollback(True)
+                self.assertLess(response.status_code, 500)
+                self.assertLessEqual(len(queries), budget, '\n'.join(query['sql'] for query in queries))
+
+
+@override_settings(ROOT_URLCONF='subscription.urls', SUBSCRIPTION_JWT_ENTITLEMENT_CLAIMS=True)
+class TokenEntitlementClaimsTestCase(PlansFileTestCase):
+    """ Entitlements gravadas no token de acesso (SUBSCRIPTION_JWT_ENTITLEMENT_CLAIMS) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        cls.owner.set_password('Senha-123')
+        cls.owner.save()
+        cls.profile = UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+        PaidContent.register_purchase('free', cls.customer)
+
+    def login(self) -> dict:
+        response = self.client.post('/login/', {'email': self.owner.email, 'password': 'Senha-123'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @staticmethod
+    def profile_queries(queries) -> list:
+        return [query for query in queries if '"subscription_userprofile"."user_id" =' in query['sql']]
+
+    def test_access_token_carries_entitlements(self):
+        data = self.login()
+        claims = AccessToken(data['access'])[TOKEN_CLAIM]
+        self.assertEqual((claims['cid'], claims['pid'], claims['plan']), (self.customer.id, self.profile.id, 'free'))
+        self.assertNotIn(TOKEN_CLAIM, RefreshToken(data['refresh']).payload)
+        self.assertEqual(data['expires_in'], int(AccessToken.lifetime.total_seconds()))
+
+    def test_permissions_are_checked_from_the_token(self):
+        access = self.login()['access']
+        # com o LRU do processo frio (ex.: outro worker), o perfil não é carregado: só as versões são lidas do cache
+        entitlement_cache.clear_local()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/users/{self.owner.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.profile_queries(queries))
+
+    def test_invalidation_makes_the_token_fall_back_to_the_database(self):
+        access = self.login()['access']
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_user_entitlements(self.owner.id)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/users/{self.owner.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.profile_queries(queries))
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class TokenRevocationTestCase(PlansFileTestCase):
+    """ Revogação de tokens (RevokedToken + filtro de Bloom de utils/revocation.py) """
+
+    def setUp(self):
+        super().setUp()
+        # as views guardam as classes de autenticação do DEFAULT_AUTHENTICATION_CLASSES na definição delas
+        patcher = mock.patch.object(APIView, 'authentication_classes', [RevocationJWTAuthentication])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        cls.owner.set_password('Senha-antiga-123')
+        cls.owner.save()
+        UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+
+    def get(self, token) -> int:
+        return self.client.get('/get-profile', HTTP_AUTHORIZATION=f'Bearer {token}').status_code
+
+    def test_valid_tokens_are_checked_without_queries(self):
+        token = RefreshToken.for_user(self.owner).access_token
+        RevokedToken.revoke_tokens([RefreshToken.for_user(self.owner).access_token])
+        revocation_list.get_filter()
+        with self.assertNumQueries(0):
+            self.assertFalse(revocation_list.is_revoked(token))
+
+    def test_password_change_revokes_previous_tokens(self):
+        refresh = RefreshToken.for_user(self.owner)
+        refresh['iat'] -= 10
+        access = refresh.access_token
+        self.assertEqual(self.get(access), 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put('/change-password/', {'old_password': 'Senha-antiga-123',
+                                                             'new_password': 'Senha-nova-456!'},
+                                       HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(access), 401)
+        self.assertEqual(self.client.post('/login/refresh/', {'refresh': str(refresh)}).status_code, 401)
+        # o login logo depois da troca (normalmente no mesmo segundo dela) vale, assim como o refresh dele
+        tokens = self.client.post('/login/', {'email': self.owner.email, 'password': 'Senha-nova-456!'}).json()
+        self.assertEqual(self.get(tokens['access']), 200)
+        response = self.client.post('/login/refresh/', {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(response.json()['access']), 200)
+
+    def test_revocation_compares_the_sub_second_issue_time(self):
+        revoked_at = timezone.now().replace(microsecond=500000)
+        with mock.patch('django.utils.timezone.now', return_value=revoked_at):
+            RevokedToken.revoke_user(self.owner.id)
+        revocation_list.reset()
+        access = RefreshToken.for_user(self.owner).access_token
+        access['iat'] = int(revoked_at.timestamp())
+        for moment, revoked in ((revoked_at - timedelta(microseconds=1), True), (revoked_at, True),
+                                (revoked_at + timedelta(microseconds=1), False)):
+            with self.subTest(moment=moment), mock.patch('django.utils.timezone.now', return_value=moment):
+                set_issued_at(access)
+                self.assertEqual(revocation_list.is_revoked(access), revoked)
+
+    def test_tokens_without_sub_second_issue_time_are_revoked_in_the_revocation_second(self):
+        access = RefreshToken.for_user(self.owner).access_token
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now().replace(microsecond=999999)):
+            RevokedToken.revoke_user(self.owner.id)
+        revoked_before = RevokedToken.objects.get(key=f'user:{self.owner.id}').revoked_before
+        revocation_list.reset()
+        access['iat'] = int(revoked_before.timestamp())
+        self.assertTrue(revocation_list.is_revoked(access))
+        access['iat'] += 1
+        self.assertFalse(revocation_list.is_revoked(access))
+
+    def test_racing_revocations_keep_the_latest(self):
+        now = timezone.now()
+        update = QuerySet.update
+        calls = []
+
+        def insert_concurrently(queryset, **kwargs):
+            # outra revogação (mais antiga) insere a linha logo depois do primeiro UPDATE
+            calls.append(kwargs)
+            if len(calls) == 1:
+                RevokedToken.objects.create(key=f'user:{self.owner.id}', revoked_before=now - timedelta(hours=1),
+                                            revoked_at=now - timedelta(hours=1), expires_at=now)
+                return 0
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=insert_concurrently):
+            RevokedToken.revoke_user(self.owner.id)
+        self.assertEqual(len(calls), 2)
+        revoked = RevokedToken.objects.get(key=f'user:{self.owner.id}')
+        self.assertGreaterEqual(revoked.revoked_before, now)
+        self.assertGreater(revoked.expires_at, now)
+        # uma revogação mais antiga que chega depois não desfaz a mais nova
+        with mock.patch('django.utils.timezone.now', return_value=now - timedelta(minutes=1)):
+            RevokedToken.revoke_user(self.owner.id)
+        revoked.refresh_from_db()
+        self.assertGreaterEqual(revoked.revoked_before, now)
+
+    def test_revocation_from_other_worker_is_seen_after_refresh_interval(self):
+        access = RefreshToken.for_user(self.owner).access_token
+        revocation_list.get_filter()
+        # revogação feita por outro processo: só chega a este pelo BD
+        RevokedToken.objects.create(key=f'jti:{access["jti"]}', revoked_at=timezone.now(),
+                                    expires_at=timezone.now() + timedelta(minutes=5))
+        with override_settings(SUBSCRIPTION_REVOCATION_REFRESH_INTERVAL=0):
+            self.assertEqual(self.get(access), 401)
+
+    def test_logout_revokes_refresh_token(self):
+        refresh = RefreshToken.for_user(self.owner)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/logout/', {'refresh': str(refresh)}).status_code, 200)
+        self.assertEqual(self.client.post('/login/refresh/', {'refresh': str(refresh)}).status_code, 401)
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class PasswordHashingTestCase(TestCase):
+    """ Hashing de senhas no pool limitado (utils/hashing.py) """
+
+    def setUp(self):
+        # o pool guarda o tamanho configurado na criação
+        hashing_pool.shutdown()
+        self.addCleanup(hashing_pool.shutdown)
+
+    @override_settings(SUBSCRIPTION_HASHING_WORKERS=1, SUBSCRIPTION_HASHING_QUEUE=0)
+    def test_full_pool_rejects_instead_of_queueing(self):
+        release = threading.Event()
+        busy = hashing_pool.submit(release.wait)
+        try:
+            with self.assertRaises(HashingPoolBusy):
+                hashing_pool.run(str, 'x')
+            response = self.client.post('/login/', {'email': 'nobody@example.com', 'password': 'x'})
+            self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+        finally:
+            release.set()
+            busy.result()
+        self.assertEqual(hashing_pool.stats()['rejected'], 2)
+
+    def test_login_rehashes_password_when_hasher_changes(self):
+        hashers = ['django.contrib.auth.hashers.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher']
+        with override_settings(PASSWORD_HASHERS=hashers[1:]):
+            user = SystemUser.objects.create(email='user@example.com')
+            user.set_password('Senha-123')
+            user.save()
+        with override_settings(PASSWORD_HASHERS=hashers):
+            response = self.client.post('/login/', {'email': user.email, 'password': 'Senha-123'})
+        self.assertEqual(response.status_code, 200)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+
+
+class FailingEmailBackend(EmailBackend):
+    """ Backend de email que recusa os destinatários @fail.example.com """
+
+    def send_messages(self, messages):
+        if any(address.endswith('@fail.example.com') for message in messages for address in message.to):
+            raise ConnectionError('recusado')
+        return super().send_messages(messages)
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class OutgoingEmailTestCase(TestCase):
+    """ Caixa de saída de emails (OutgoingEmail) """
+
+    def test_signup_enqueues_welcome_mail_instead_of_sending(self):
+        response = self.client.post('/register/', {'email': 'new@example.com', 'password': 'Senha-123',
+                                                   'first_name': 'Novo', 'last_name': 'Usuário'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutgoingEmail.objects.get().to, ['new@example.com'])
+
+    def test_batch_is_sent_over_a_single_connection(self):
+        for i in range(3):
+            OutgoingEmail.enqueue('Assunto', 'Corpo', [f'user{i}@example.com'])
+        with mock.patch('subscription.models.get_connection', wraps=get_connection) as connect:
+            counts = OutgoingEmail.send_pending()
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(counts[OutgoingEmail.Status.SENT], 3)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['user0@example.com', 'user1@example.com', 'user2@example.com'])
+
+    @override_settings(EMAIL_BACKEND='subscription.tests.FailingEmailBackend')
+    def test_failed_delivery_is_retried_with_backoff(self):
+        failing = OutgoingEmail.enqueue('Assunto', 'Corpo', ['user@fail.example.com'])
+        OutgoingEmail.enqueue('Assunto', 'Corpo', ['user@example.com'])
+        OutgoingEmail.send_pending(max_attempts=2)
+        failing.refresh_from_db()
+        self.assertEqual((failing.status, failing.attempts), (OutgoingEmail.Status.PENDING, 1))
+        self.assertGreater(failing.available_at, timezone.now())
+        self.assertEqual(len(mail.outbox), 1)
+
+        OutgoingEmail.objects.filter(pk=failing.pk).update(available_at=timezone.now())
+        OutgoingEmail.send_pending(max_attempts=2)
+        failing.refresh_from_db()
+        self.assertEqual((failing.status, failing.attempts), (OutgoingEmail.Status.FAILED, 2))
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class BulkInviteTestCase(PlansFileTestCase):
+    """ Convite de vários usuários de uma vez (UserProfile.bulk_invite) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+        PaidContent.register_purchase('free', cls.customer)
+        cls.without_profile = SystemUser.objects.create(email='loose@example.com')
+        other = create_customer('other@example.com', 'Outro')
+        cls.other_member = SystemUser.objects.create(email='taken@example.com')
+        UserProfile.objects.create(user=cls.other_member, client=other)
+
+    def invite(self, invites: list):
+        self.client.force_authenticate(self.owner)
+        return self.client.post('/profiles/bulk', {'invites': invites}, format='json')
+
+    def test_rows_are_reported_individually(self):
+        response = self.invite([
+            {'email': 'new@example.com', 'name': 'Novo', 'allowed_actions': 'EDT'},
+            {'email': 'loose@example.com', 'allowed_actions': 'VIE'},
+            {'email': self.owner.email, 'allowed_actions': 'VIE'},
+            {'email': 'taken@example.com', 'allowed_actions': 'VIE'},
+            {'email': 'new@example.com', 'allowed_actions': 'VIE'},
+            {'email': 'invalid', 'allowed_actions': 'VIE'},
+            {'email': 'other@example.com', 'allowed_actions': 'XXX'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['status'] for row in response.json()['results']],
+                         ['invited', 'added', 'exists', 'error', 'error', 'error', 'error'])
+        self.assertEqual(UserProfile.objects.get(user__email='new@example.com').allowed_actions, 'EDT')
+        self.assertEqual(UserProfile.objects.get(user=self.without_profile).client_id, self.customer.id)
+        self.assertEqual(list(OutgoingEmail.objects.values_list('to', flat=True)), [['new@example.com']])
+
+    def test_query_count_does_not_depend_on_the_number_of_invites(self):
+        query_counts = []
+        for size in (5, 50):
+            invites = [{'email': f'user{size}-{i}@example.com', 'allowed_actions': 'VIE'} for i in range(size)]
+            self.setUp()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self.invite(invites).status_code, 200)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class BenchmarkTestCase(PlansFileTestCase):
+    """ Suíte de benchmarks (utils/benchmarks.py) com poucas execuções: aqui só importam as consultas e a comparação """
+
+    def test_benchmarks_record_time_and_queries(self):
+        results = run_benchmarks(iterations=3, warmup=1, history=50, profiles=2)
+        self.assertEqual(set(results), set(BENCHMARKS))
+        self.assertEqual(results['check_permissions'].queries, 0)
+        self.assertEqual(results['get_active_signature'].queries, 1)
+        self.assertEqual(results['get_profile_from_request'].queries, 1)
+        self.assertEqual(results['get_products'].queries, 0)
+        self.assertTrue(all(result.min <= result.median <= result.max for result in results.values()))
+
+    def test_regressions_are_detected_against_the_baseline(self):
+        results = run_benchmarks(['get_active_signature'], iterations=3, warmup=0, history=10, profiles=0)
+        result = results['get_active_signature']
+        baseline = {'get_active_signature': {**result.as_dict(), 'median': result.median / 2}}
+        self.assertEqual([regression['metric'] for regression in compare(results, baseline, threshold=0.2)],
+                         ['median'])
+        self.assertEqual(compare(results, baseline, threshold=10), [])
+        baseline['get_active_signature'].update(median=result.median, queries=0)
+        self.assertEqual([regression['metric'] for regression in compare(results, baseline)], ['queries'])
+
+
+class SyntheticDataTestCase(PlansFileTestCase):
+    """ Gerador de dados sintéticos (utils/synthetic.py) """
+    plans = {
+        **PLANS_FOR_ROUTE_TESTS,
+        'pro': {'type': 'SIG', 'signature_exclusive': True, 'value': 99.99, 'expiration_time': 30,
+                'purchased_content': [{'type': 'feature', 'id': 'auth'}, {'type': 'feature', 'id': 'export'}]},
+        'addon': {'type': 'SIG', 'value': 9.99, 'purchased_content': [{'type': 'feature', 'id': 'export'}]},
+        'credits': {'type': 'OT', 'value': 5.0, 'purchased_content': [{'type': 'credits', 'amount': 10}]},
+    }
+
+    def generate(self, prefix: str, seed: int = 1) -> dict:
+        return SyntheticDataGenerator(12, profiles=3, history=40, seed=seed, chunk_size=100, prefix=prefix).generate()
+
+    def test_generated_volumes_and_history_mix(self):
+        self.assertEqual(self.generate('a'), {'customers': 12, 'users': 48, 'profiles': 48, 'paid_contents': 480})
+        contents = PaidContent.objects.all()
+        self.assertTrue(contents.filter(type=PaidContent.Types.ONE_TIME_ONLY).exists())
+        self.assertTrue(contents.filter(is_exclusive=True, expiration_date__lt=timezone.now()).exists())
+        self.assertTrue(contents.filter(type=PaidContent.Types.SIGNATURE, expiration_date__isnull=True).exists())
+        self.assertEqual(set(contents.values_list('stripe_id', flat=True)) - set(self.plans), set())
+        for customer in Customer.objects.all():
+            # nunca há mais de uma assinatura exclusiva ativa
+            customer.get_active_signature()
+
+    def test_same_seed_generates_the_same_data(self):
+        def snapshot(prefix):
+            return list(PaidContent.objects.filter(customer__owner__email__startswith=prefix)
+                        .order_by('customer_id', 'start_date').values_list('stripe_id', 'type', 'is_exclusive'))
+
+        self.generate('a')
+        self.generate('b')
+        self.generate('c', seed=2)
+        self.assertEqual(snapshot('a-'), snapshot('b-'))
+        self.assertNotEqual(snapshot('a-'), snapshot('c-'))
+        with self.assertRaises(ValueError):
+            self.generate('a')
+
+
+@override_settings(ROOT_URLCONF='subscription.urls')
+class LoadTestTestCase(PlansFileTestCase):
+    """ Teste de carga (utils/load_test.py). As rodadas com threads precisam de dados commitados, então aqui só são
+    verificados os usuários virtuais, as métricas e as invariantes """
+
+    def test_virtual_users_exercise_every_route(self):
+        load_test = LoadTest(customers=2, users=2, history=5)
+        load_test.setup()
+        worker = load_test.workers[0]
+        self.assertEqual(worker.url_prefix, '/')
+        for route in ROUTES:
+            self.assertIn(worker.request(route).status_code, (200, 201), route)
+        self.assertEqual(StripeWebhookEvent.process_pending()['DON'], 1)
+        self.assertEqual(load_test.check_invariants(), {'duplicate_exclusive_signatures': 0,
+                                                        'duplicate_free_signatures': 0, 'failed_events': 0})
+
+    def test_invariants_catch_duplicate_exclusive_signatures(self):
+        load_test = LoadTest(customers=1, users=1, history=0)
+        load_test.setup()
+        customer_id = load_test.workers[0].customer_id
+        for _ in range(2):
+            PaidContent.objects.create(customer_id=customer_id, stripe_id='free', type=PaidContent.Types.SIGNATURE,
+                                       is_exclusive=True, start_date=timezone.now(),
+                                       expiration_date=timezone.now() + timedelta(days=1))
+        self.assertEqual(load_test.check_invariants()['duplicate_exclusive_signatures'], 1)
+
+    def test_mix_and_percentiles(self):
+        self.assertEqual(parse_mix('login=2, get-profile'), {'login': 2.0, 'get-profile': 1.0})
+        with self.assertRaises(ValueError):
+            parse_mix('unknown=1')
+        values = [float(value) for value in range(1, 101)]
+        self.assertEqual((get_percentile(values, 50), get_percentile(values, 99)), (50.0, 99.0))
+
+
+@override_settings(ROOT_URLCONF='subscription.urls', SUBSCRIPTION_METRICS_ENABLED=True,
+                   MIDDLEWARE=['subscription.utils.metrics.QueryMetricsMiddleware'])
+class MetricsTestCase(PlansFileTestCase):
+    """ Instrumentação e rota /metrics (utils/metrics.py) """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = create_customer()
+        cls.owner = cls.customer.owner
+        UserProfile.objects.create(user=cls.owner, client=cls.customer, available_features='auth')
+        PaidContent.register_purchase('free', cls.customer)
+
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+
+    def test_hot_paths_are_instrumented(self):
+        self.client.force_authenticate(self.owner)
+        for _ in range(2):
+            self.assertEqual(self.client.get('/customers').status_code, 200)
+        StripeWebhookEvent.receive({'id': 'evt_1', 'type': 'payment_intent.succeeded',
+                                    'data': {'object': {'description': f'{self.customer.id}-free'}}})
+        StripeWebhookEvent.process_pending()
+        text = APIClient().get('/metrics').content.decode()
+        self.assertIn('# TYPE subscription_check_permissions_seconds histogram', text)
+        self.assertIn('subscription_check_permissions_seconds_count{view="CustomerList"} 2', text)
+        self.assertIn('subscription_entitlement_cache_lookups_total{cache="subscription:ent",result="hit"}', text)
+        self.assertIn('subscription_webhook_processing_seconds_count{status="DON"} 1', text)
+        self.assertIn('subscription_request_queries_bucket{route="customers",le="+Inf"} 2', text)
+        self.assertIn('subscription_hashing_pool_queued 0', text)
+
+    def test_query_metrics_middleware_counts_queries(self):
+        def view(request):
+            list(SystemUser.objects.all()[:1])
+            list(Customer.objects.all()[:1])
+            return 'ok'
+
+        QueryMetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(metrics.histogram('subscription_request_queries', '').get(route='unmatched'), (2, 1))
+
+    def test_metrics_route_is_optional_and_can_require_a_token(self):
+        with override_settings(SUBSCRIPTION_METRICS_ENABLED=False):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(SUBSCRIPTION_METRICS_TOKEN='segredo'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer segredo')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
@@ -5,15 +5,16 @@ from django.utils.translation import gettext_lazy as _
 
 def get_profile_from_request(request) -> 'UserProfile':
     """
-    Pega o perfil do usuário com base na request. Supõe-se que a request já passou pelo Middleware
+    Pega o perfil do usuário com base na request. Supõe-se que a request já passou pela autenticação. O perfil é
+    resolvido uma única vez por requisição (ver `get_entitlements`)
     Args:
         request: Requisição HTTP
 
     Returns:
         Objeto do tipo Profile ligado ao usuário da requisição
     """
-    from django.apps import apps
-    return apps.get_model('core', 'SystemUser').objects.get(id=request.user.id).profile
+    from .entitlements import get_entitlements
+    return get_entitlements(request).profile
 
 
 def get_custom_action_not_allowed_http_code_and_message() -> dict:
@@ -35,6 +36,13 @@ def get_custom_feature_limit_reached_http_code_and_message() -> dict:
     return {'message': _('Você atingiu a cota máxima dessa funcionalidade para o seu plano atual.'), 'code': 407}
 
 
+def get_custom_server_busy_http_code_and_message() -> dict:
+    """ Retorna o código HTTP e mensagem customizados pra quando o servidor está ocupado demais pra atender a requisição
+    (ex.: muitos logins ao mesmo tempo)
+    """
+    return {'message': _('O servidor está ocupado no momento. Tente novamente em instantes.'), 'code': 503}
+
+
 def get_default_response_for_rest_api(http_status: int, data: dict = None, header: dict = None) -> Response:
     """
     Retorna a response padrão para requisicoes do Django Rest
@@ -1,10 +1,19 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from onipkg_contrib.log_helper import log_tests
 from rest_framework import generics, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .api_helpers import get_profile_from_request, get_custom_feature_blocked_http_code_and_message, \
+from .api_helpers import get_custom_feature_blocked_http_code_and_message, \
     get_custom_action_not_allowed_http_code_and_message
+from .entitlements import get_entitlements
+from .exports import EXPORT_FORMATS
+from .metrics import check_permissions_seconds
+from .pagination import KeysetPagination
+from .query_shaping import get_query_shape
+from .rate_limit import rate_limiter
 
 
 def default_list(viewset, request, *args, **kwargs):
@@ -14,9 +23,10 @@ def default_list(viewset, request, *args, **kwargs):
     Utiliza o método get_queryset implementado no modelo pra pegar a queryset, e pagina os objetos normal, de acordo com
     o método list padrao do DRF.
     """
-    queryset = viewset.filter_queryset(viewset.get_queryset().model.get_queryset(request, *args, **kwargs))
-    # viewset.filter_queryset retorna uma queryset. queryset.model retorna o modelo dos seus objetos. model.get_queryset
-    # retorna a queryset de objetos, filtrada de maneira correta pelo modelo.
+    queryset = viewset.get_queryset().model.get_queryset(request, *args, **kwargs)
+    # queryset.model retorna o modelo dos seus objetos. model.get_queryset retorna a queryset de objetos, filtrada de
+    # maneira correta pelo modelo. O formato da consulta (relações e colunas) é aplicado antes dos filtros da view
+    queryset = viewset.filter_queryset(viewset.shape_queryset(queryset))
     page = viewset.paginate_queryset(queryset)
     if page is not None:
         serializer = viewset.get_serializer(page, many=True)
@@ -30,8 +40,7 @@ def default_retrieve(self, request, *args, **kwargs):
     """
     Override do método delete do mixin do DRF pra verificar se o perfil tem permissão de ver objetos
     """
-    profile = get_profile_from_request(request)
-    if not profile.can_read():
+    if not get_entitlements(request).can_read():
         self.permission_denied(
             request,
             **get_custom_action_not_allowed_http_code_and_message()
@@ -45,8 +54,7 @@ def default_create(self, request, *args, **kwargs):
     """
     Override do método delete do mixin do DRF pra verificar se o perfil tem permissão de criar objetos
     """
-    profile = get_profile_from_request(request)
-    if not profile.can_create():
+    if not get_entitlements(request).can_create():
         self.permission_denied(
             request,
             **get_custom_action_not_allowed_http_code_and_message()
@@ -62,8 +70,7 @@ def default_update(self, request, *args, **kwargs):
     """
     Override do método delete do mixin do DRF pra verificar se o perfil tem permissão de editar objetos
     """
-    profile = get_profile_from_request(request)
-    if not profile.can_update():
+    if not get_entitlements(request).can_update():
         self.permission_denied(
             request,
             **get_custom_action_not_allowed_http_code_and_message()
@@ -86,8 +93,7 @@ def default_delete(self, request, *args, **kwargs):
     """
     Override do método delete do mixin do DRF pra verificar se o perfil tem permissão de apagar objetos
     """
-    profile = get_profile_from_request(request)
-    if not profile.can_delete():
+    if not get_entitlements(request).can_delete():
         self.permission_denied(
             request,
             **get_custom_action_not_allowed_http_code_and_message()
@@ -103,13 +109,18 @@ class CustomApiViewFilterClass(APIView):
 
     def check_permissions(self, request):
         """
-        Verifica se o Cliente tem acesso ao conteúdo desejado (se está no plano dele)
+        Verifica se o Cliente tem acesso ao conteúdo desejado (se está no plano dele). O tempo gasto vai pra métrica
+        subscription_check_permissions_seconds
         """
+        with check_permissions_seconds.time(view=type(self).__name__):
+            self._check_permissions(request)
+
+    def _check_permissions(self, request):
         # Verifica se o cliente do usuário da request tem acesso à feature
         from django.core.exceptions import ObjectDoesNotExist
         try:
-            profile = get_profile_from_request(request)
-            if hasattr(self, 'related_module') and self.related_module not in profile.get_available_features():
+            entitlements = get_entitlements(request)
+            if hasattr(self, 'related_module') and not entitlements.can_access_feature(self.related_module):
                 raise ObjectDoesNotExist
         except ObjectDoesNotExist:
             self.permission_denied(
@@ -124,12 +135,56 @@ class CustomApiViewFilterClass(APIView):
                     message=getattr(permission, 'message', None),
                     code=getattr(permission, 'code', None)
                 )
+        self.check_rate_limit(request, entitlements)
+
+    def check_rate_limit(self, request, entitlements):
+        """
+        Consome uma requisição do limite do plano do Cliente para a feature da view (`rate_limits` no json de planos).
+        Se o limite foi atingido, levanta FeatureLimitReached (429 com Retry-After)
+        """
+        plan = entitlements.plan
+        related_module = getattr(self, 'related_module', None)
+        if plan is None or related_module is None:
+            return
+        limit = plan.rate_limits.get(related_module)
+        if limit is not None:
+            rate_limiter.check(entitlements.customer_id, related_module, limit)
 
 
-class CustomListFilterClass(generics.ListAPIView, CustomApiViewFilterClass):
+class QueryShapingMixin:
+    """
+    Formato declarativo das consultas das views genéricas. Por padrão, as relações e as colunas lidas são derivadas do
+    `fields` do serializer da view (ver utils/query_shaping.py): relações atravessadas por serializers aninhados ou
+    sources com pontos vão pro select_related/prefetch_related, e nas leituras (GET) só as colunas usadas pelo
+    serializer são buscadas. As views podem complementar com os atributos abaixo.
+    """
+    select_related_fields = ()  # relações diretas buscadas junto, além das derivadas do serializer
+    prefetch_related_fields = ()  # relações múltiplas buscadas junto, além das derivadas do serializer
+    prune_columns = True  # busca só as colunas usadas pelo serializer nas leituras
+
+    def shape_queryset(self, queryset):
+        shape = get_query_shape(self.get_serializer_class(), queryset.model)
+        select_related = shape.select_related.union(self.select_related_fields)
+        prefetch_related = shape.prefetch_related.union(self.prefetch_related_fields)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        # nas escritas o objeto é salvo de novo, então ele é lido inteiro
+        if self.prune_columns and shape.only is not None and self.request.method in ('GET', 'HEAD'):
+            queryset = queryset.only(*shape.only.union(field.split('__')[0] for field in select_related))
+        return queryset
+
+    def get_queryset(self):
+        return self.shape_queryset(super().get_queryset())
+
+
+class CustomListFilterClass(QueryShapingMixin, generics.ListAPIView, CustomApiViewFilterClass):
     """
     Override de ListAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
+    # paginação por cursor (ver utils/pagination.py). Pode ser trocada por qualquer paginação do DRF na view
+    pagination_class = KeysetPagination
 
     def list(self, request, *args, **kwargs):
         """
@@ -138,10 +193,12 @@ class CustomListFilterClass(generics.ListAPIView, CustomApiViewFilterClass):
         return default_list(self, request, *args, **kwargs)
 
 
-class CustomListCreateFilterClass(generics.ListCreateAPIView, CustomApiViewFilterClass):
+class CustomListCreateFilterClass(QueryShapingMixin, generics.ListCreateAPIView, CustomApiViewFilterClass):
     """
     Override de ListCreateAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
+    # paginação por cursor (ver utils/pagination.py). Pode ser trocada por qualquer paginação do DRF na view
+    pagination_class = KeysetPagination
 
     def list(self, request, *args, **kwargs):
         """
@@ -155,7 +212,7 @@ class CustomListCreateFilterClass(generics.ListCreateAPIView, CustomApiViewFilte
         return default_create(self, request, *args, **kwargs)
 
 
-class CustomRetrieveFilterClass(generics.RetrieveAPIView, CustomApiViewFilterClass):
+class CustomRetrieveFilterClass(QueryShapingMixin, generics.RetrieveAPIView, CustomApiViewFilterClass):
     """
     Override de RetrieveAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -163,7 +220,7 @@ class CustomRetrieveFilterClass(generics.RetrieveAPIView, CustomApiViewFilterCla
         return default_retrieve(self, request, *args, **kwargs)
 
 
-class CustomUpdateFilterClass(generics.UpdateAPIView, CustomApiViewFilterClass):
+class CustomUpdateFilterClass(QueryShapingMixin, generics.UpdateAPIView, CustomApiViewFilterClass):
     """
     Override de UpdateAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -172,7 +229,7 @@ class CustomUpdateFilterClass(generics.UpdateAPIView, CustomApiViewFilterClass):
         return default_update(self, request, *args, **kwargs)
 
 
-class CustomDestroyFilterClass(generics.DestroyAPIView, CustomApiViewFilterClass):
+class CustomDestroyFilterClass(QueryShapingMixin, generics.DestroyAPIView, CustomApiViewFilterClass):
     """
     Override de DestroyAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -181,7 +238,7 @@ class CustomDestroyFilterClass(generics.DestroyAPIView, CustomApiViewFilterClass
         return default_delete(self, request, *args, **kwargs)
 
 
-class CustomRetrieveUpdateFilterClass(generics.RetrieveUpdateAPIView, CustomApiViewFilterClass):
+class CustomRetrieveUpdateFilterClass(QueryShapingMixin, generics.RetrieveUpdateAPIView, CustomApiViewFilterClass):
     """
     Override de RetrieveUpdateAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -192,7 +249,7 @@ class CustomRetrieveUpdateFilterClass(generics.RetrieveUpdateAPIView, CustomApiV
         return default_update(self, request, *args, **kwargs)
 
 
-class CustomRetrieveDestroyFilterClass(generics.RetrieveDestroyAPIView, CustomApiViewFilterClass):
+class CustomRetrieveDestroyFilterClass(QueryShapingMixin, generics.RetrieveDestroyAPIView, CustomApiViewFilterClass):
     """
     Override de RetrieveDestroyAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -204,7 +261,8 @@ class CustomRetrieveDestroyFilterClass(generics.RetrieveDestroyAPIView, CustomAp
         return default_delete(self, request, *args, **kwargs)
 
 
-class CustomRetrieveUpdateDestroyFilterClass(generics.RetrieveUpdateDestroyAPIView, CustomApiViewFilterClass):
+class CustomRetrieveUpdateDestroyFilterClass(QueryShapingMixin, generics.RetrieveUpdateDestroyAPIView,
+                                             CustomApiViewFilterClass):
     """
     Override de RetrieveUpdateDestroyAPIView para verificação de acesso do Cliente e permissão do Perfil
     """
@@ -217,3 +275,34 @@ class CustomRetrieveUpdateDestroyFilterClass(generics.RetrieveUpdateDestroyAPIVi
 
     def delete(self, request, *args, **kwargs):
         return default_delete(self, request, *args, **kwargs)
+
+
+class CustomExportFilterClass(CustomApiViewFilterClass):
+    """
+    Exportação completa de um modelo em streaming (NDJSON ou CSV, escolhido com `?output=csv`). As linhas são lidas do
+    BD em lotes (`.iterator()`), só com as colunas de `export_fields`, e codificadas conforme são enviadas, então o uso
+    de memória não depende da quantidade de linhas. Passa pela mesma verificação de acesso à feature (`related_module`)
+    e pelo mesmo filtro por cliente (`get_queryset` do modelo) das listagens, além da permissão de leitura do perfil.
+    """
+    queryset = None
+    export_fields = ()
+    output_query_param = 'output'
+
+    def get_export_queryset(self, request):
+        return self.queryset.model.get_queryset(request).order_by('pk')
+
+    def get(self, request, *args, **kwargs):
+        if not get_entitlements(request).can_read():
+            self.permission_denied(
+                request,
+                **get_custom_action_not_allowed_http_code_and_message()
+            )
+        output = request.query_params.get(self.output_query_param, 'ndjson')
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({self.output_query_param: list(EXPORT_FORMATS)})
+        content_type, encode = EXPORT_FORMATS[output]
+        chunk_size = getattr(settings, 'SUBSCRIPTION_EXPORT_CHUNK_SIZE', 2000)
+        rows = self.get_export_queryset(request).values(*self.export_fields).iterator(chunk_size=chunk_size)
+        response = StreamingHttpResponse(encode(rows, self.export_fields), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{self.queryset.model._meta.model_name}.{output}"'
+        return response
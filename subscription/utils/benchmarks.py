@@ -0,0 +1,219 @@
+import statistics
+import time
+from dataclasses import dataclass, asdict
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .api_helpers import get_profile_from_request
+from .base_viewsets import CustomApiViewFilterClass
+from .entitlements import invalidate_user_entitlements, invalidate_customer_entitlements
+from .features import feature_registry
+from .plans import plan_catalog, Plan
+
+
+# operações medidas pelo run_benchmarks
+BENCHMARKS = ('check_permissions', 'check_permissions_cold', 'get_profile_from_request', 'get_active_signature',
+              'get_available_features', 'register_purchase', 'get_products')
+
+
+@dataclass
+class BenchmarkResult:
+    """Resultado de uma operação medida. Os tempos são em milissegundos, por execução.
+
+    Attributes:
+        name (str): nome da operação.
+        iterations (int): quantidade de execuções medidas (sem contar o aquecimento).
+        mean (float): tempo médio.
+        median (float): tempo mediano, que é o usado na comparação com o baseline (menos sensível a picos).
+        p95 (float): percentil 95 do tempo.
+        min (float): menor tempo.
+        max (float): maior tempo.
+        queries (float): média de consultas ao BD por execução.
+    """
+    name: str
+    iterations: int
+    mean: float
+    median: float
+    p95: float
+    min: float
+    max: float
+    queries: float
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+def measure(name: str, operation: Callable[[], object], iterations: int = 200, warmup: int = 10) -> BenchmarkResult:
+    """ Executa a operação `warmup` vezes sem medir (pra encher os caches do processo) e depois `iterations` vezes,
+    medindo o tempo e as consultas de cada execução """
+    for _ in range(warmup):
+        operation()
+    timings, queries = [], 0
+    for _ in range(iterations):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            operation()
+            timings.append((time.perf_counter() - start) * 1000)
+        queries += len(context.captured_queries)
+    timings.sort()
+    return BenchmarkResult(
+        name=name,
+        iterations=iterations,
+        mean=statistics.fmean(timings),
+        median=statistics.median(timings),
+        p95=timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        min=timings[0],
+        max=timings[-1],
+        queries=queries / iterations,
+    )
+
+
+def get_default_plan() -> Plan:
+    """ Plano usado nas compras dos benchmarks: a primeira assinatura paga do catálogo com alguma feature (ou a free, se
+    não houver outra) """
+    signatures = [plan for plan in plan_catalog.plans.values() if plan.type == 'SIG' and plan.features]
+    if not signatures:
+        raise ValueError('O catálogo de planos não tem nenhuma assinatura com features pra usar nos benchmarks.')
+    return min(signatures, key=lambda plan: plan.id == 'free')
+
+
+def create_benchmark_customer(email: str, plan: Plan, history: int, profiles: int) -> 'Customer':
+    """
+    Cria um cliente com dono, `profiles` perfis e um histórico de `history` conteúdos pagos: assinaturas exclusivas
+    vencidas, compras pontuais e, por último, uma assinatura ativa do plano. É o caso em que a resolução da assinatura
+    ativa depende dos índices pra não percorrer o histórico inteiro.
+    """
+    from subscription.models import SystemUser, Customer, PaidContent, UserProfile
+    owner = SystemUser.objects.create(email=email, first_name='Benchmark')
+    customer = Customer.objects.create(name='Benchmark', owner=owner)
+    feature_registry.register(plan.features)
+    features = ','.join(sorted(plan.features))
+    UserProfile(user=owner, client=customer, available_features=features).save()
+    users = SystemUser.objects.bulk_create([SystemUser(email=f'{i}.{email}')
+                                            for i in range(profiles)])
+    if users and users[0].pk is None:
+        # o SQLite (no Django 3.2) não devolve as pks no bulk_create
+        users = SystemUser.objects.filter(email__in=[user.email for user in users])
+    mask = feature_registry.get_mask(plan.features)
+    UserProfile.objects.bulk_create([UserProfile(user=user, client=customer, available_features=features,
+                                                 features_mask=mask) for user in users])
+    # as compras pontuais do histórico são de um produto pontual do catálogo, se houver (só o tipo importa aqui)
+    one_time_id = next((item.id for item in plan_catalog.plans.values() if item.type == 'OT'), 'one-time')
+    now = timezone.now()
+    PaidContent.objects.bulk_create([
+        PaidContent(customer=customer, stripe_id=plan.id, type=PaidContent.Types.SIGNATURE, is_exclusive=True,
+                    start_date=now - timedelta(days=60 + i), expiration_date=now - timedelta(days=30 + i))
+        if i % 4 else
+        PaidContent(customer=customer, stripe_id=one_time_id, type=PaidContent.Types.ONE_TIME_ONLY,
+                    start_date=now - timedelta(days=i))
+        for i in range(max(history - 1, 0))
+    ], batch_size=1000)
+    PaidContent.objects.create(customer=customer, stripe_id=plan.id, type=PaidContent.Types.SIGNATURE,
+                               is_exclusive=plan.signature_exclusive, start_date=now)
+    return customer
+
+
+class BenchmarkView(CustomApiViewFilterClass):
+    """ View sem rota, só pra medir o check_permissions """
+
+
+def run_benchmarks(names: Iterable[str] = None, iterations: int = 200, warmup: int = 10, history: int = 1000,
+                   profiles: int = 20, plan: Plan = None) -> Dict[str, BenchmarkResult]:
+    """
+    Cria os dados sintéticos no BD atual e mede as operações do caminho de autorização e de compra. Deve rodar em um BD
+    descartável (o comando run_benchmarks cria um BD de teste), já que grava clientes, perfis e compras.
+
+    Args:
+        names: operações a medir (padrão: todas as de BENCHMARKS)
+        iterations: execuções medidas de cada operação
+        warmup: execuções não medidas antes das medidas
+        history: tamanho do histórico de conteúdos pagos de cada cliente
+        profiles: perfis (além do dono) de cada cliente
+        plan: plano das assinaturas e compras (padrão: get_default_plan)
+
+    Returns:
+        Os resultados indexados pelo nome da operação
+    """
+    from subscription.models import PaidContent, UserProfile
+    plan = plan or get_default_plan()
+    customer = create_benchmark_customer('benchmark@example.com', plan, history, profiles)
+    buyer = create_benchmark_customer('buyer@example.com', plan, history, profiles)
+    owner = customer.owner
+    factory = APIRequestFactory()
+    view = BenchmarkView()
+    # de preferência uma feature sem limite de requisições, pra que o limite não recuse as execuções medidas
+    view.related_module = sorted(plan.features, key=lambda feature: (feature in plan.rate_limits, feature))[0]
+
+    def new_request():
+        request = factory.get('/')
+        force_authenticate(request, owner)
+        return view.initialize_request(request)
+
+    def check_permissions():
+        request = new_request()
+        view.request = request
+        view.check_permissions(request)
+
+    def check_permissions_cold():
+        # entitlements invalidadas: o tempo inclui a invalidação e a reconstrução a partir do BD
+        invalidate_user_entitlements(owner.id)
+        invalidate_customer_entitlements(customer.id)
+        check_permissions()
+
+    def get_available_features():
+        profile = UserProfile.objects.select_related('client').get(user_id=owner.id)
+        return profile.get_available_features()
+
+    operations = {
+        'check_permissions': check_permissions,
+        'check_permissions_cold': check_permissions_cold,
+        'get_profile_from_request': lambda: get_profile_from_request(new_request()),
+        'get_active_signature': customer.get_active_signature,
+        'get_available_features': get_available_features,
+        'register_purchase': lambda: PaidContent.register_purchase(plan.id, buyer),
+        'get_products': PaidContent.get_products,
+    }
+    return {name: measure(name, operations[name], iterations, warmup) for name in names or BENCHMARKS}
+
+
+def compare(results: Dict[str, BenchmarkResult], baseline: Dict[str, dict], threshold: float = 0.2) -> List[dict]:
+    """
+    Compara os resultados com um baseline (o 'results' do json de uma execução anterior). Há regressão quando o tempo
+    mediano passa do baseline em mais de `threshold` (0.2 = 20%) ou quando a quantidade de consultas aumenta (as
+    consultas não variam entre execuções, então qualquer aumento conta). Operações que não estão no baseline são
+    ignoradas.
+
+    Returns:
+        As regressões encontradas, uma por operação e métrica
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result.median > previous['median'] * (1 + threshold):
+            regressions.append({'name': name, 'metric': 'median', 'baseline': previous['median'],
+                                'value': result.median, 'change': result.median / previous['median'] - 1
+                                if previous['median'] else None})
+        if result.queries > previous['queries']:
+            regressions.append({'name': name, 'metric': 'queries', 'baseline': previous['queries'],
+                                'value': result.queries, 'change': result.queries - previous['queries']})
+    return regressions
+
+
+def get_environment(options: Optional[dict] = None) -> dict:
+    """ Informações da execução, gravadas junto com os resultados (o baseline só é comparável no mesmo ambiente) """
+    import platform
+    import django
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+        **(options or {}),
+    }
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Hashable
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import entitlement_cache_lookups
+
+MISSING = object()
+
+
+class LocalLRUCache:
+    """
+    Cache LRU em memória, thread-safe, com prazo de validade por entrada. É o primeiro nível de cache: não sai do
+    processo, então é o mais rápido, mas cada worker tem o seu.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is MISSING:
+                return default
+            value, deadline = entry
+            if deadline is not None and deadline <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            self._data[key] = (value, deadline)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class VersionedTwoTierCache:
+    """
+    Cache de dois níveis (LRU do processo + backend de cache do Django) com invalidação por versão.
+
+    Cada entrada pertence a um escopo (ex.: um cliente) e a chave real inclui a versão atual do escopo. Ao invalidar um
+    escopo, a versão é incrementada no backend compartilhado e todas as entradas antigas ficam órfãs (e expiram
+    sozinhas). A versão também é guardada no LRU por `local_ttl` segundos, o que limita por quanto tempo um worker pode
+    enxergar uma entrada invalidada por outro worker. No próprio processo a invalidação é imediata.
+    """
+
+    def __init__(self, prefix: str, cache_alias: str = None, maxsize: int = None, local_ttl: float = None):
+        self.prefix = prefix
+        self._cache_alias = cache_alias
+        self._local_ttl = local_ttl
+        self.local = LocalLRUCache(maxsize or getattr(settings, 'SUBSCRIPTION_ENTITLEMENT_LRU_SIZE', 10000))
+
+    @property
+    def hits(self) -> int:
+        return entitlement_cache_lookups.get(cache=self.prefix, result='hit')
+
+    @property
+    def misses(self) -> int:
+        return entitlement_cache_lookups.get(cache=self.prefix, result='miss')
+
+    @property
+    def shared(self):
+        return caches[self._cache_alias or getattr(settings, 'SUBSCRIPTION_ENTITLEMENT_CACHE', 'default')]
+
+    @property
+    def local_ttl(self) -> float:
+        if self._local_ttl is not None:
+            return self._local_ttl
+        return getattr(settings, 'SUBSCRIPTION_ENTITLEMENT_LOCAL_TTL', 5)
+
+    def _version_key(self, scope: str) -> str:
+        return f'{self.prefix}:v:{scope}'
+
+    def get_version(self, scope: str) -> int:
+        """ Retorna a versão atual do escopo """
+        key = self._version_key(scope)
+        version = self.local.get(key)
+        if version is None:
+            version = self.shared.get(key)
+            if version is None:
+                # Se a chave de versão sumiu do backend (eviction), recomeçar do zero poderia ressuscitar entradas
+                # antigas, então a versão inicial é derivada do relógio
+                self.shared.add(key, int(time.time() * 1000), None)
+                version = self.shared.get(key)
+            self.local.set(key, version, self.local_ttl)
+        return version
+
+    def bump(self, scope: str) -> None:
+        """ Invalida todas as entradas do escopo """
+        key = self._version_key(scope)
+        try:
+            self.shared.incr(key)
+        except ValueError:
+            self.shared.add(key, int(time.time() * 1000), None)
+        self.local.delete(key)
+
+    def _key(self, scope: str, key: str, version: int) -> str:
+        return f'{self.prefix}:{scope}:{version}:{key}'
+
+    def get(self, scope: str, key: str, default: Any = None, version: int = None) -> Any:
+        if version is None:
+            version = self.get_version(scope)
+        full_key = self._key(scope, key, version)
+        value = self.local.get(full_key, MISSING)
+        if value is MISSING:
+            entry = self.shared.get(full_key, MISSING)
+            if entry is MISSING:
+                entitlement_cache_lookups.inc(cache=self.prefix, result='miss')
+                return default
+            value, expires_at = entry
+            remaining = None if expires_at is None else expires_at - time.time()
+            if remaining is not None and remaining <= 0:
+                entitlement_cache_lookups.inc(cache=self.prefix, result='miss')
+                return default
+            self.local.set(full_key, value, remaining)
+        entitlement_cache_lookups.inc(cache=self.prefix, result='hit')
+        return value
+
+    def set(self, scope: str, key: str, value: Any, timeout: float, version: int = None) -> None:
+        """ Guarda o valor nos dois níveis. Um timeout menor ou igual a zero não guarda nada.
+
+        Quem calcula o valor a partir do BD deve ler a versão antes da consulta e passá-la aqui: assim, se o escopo for
+        invalidado no meio do caminho, o valor calculado fica na versão antiga e nunca é lido.
+        """
+        if timeout is not None and timeout <= 0:
+            return
+        if version is None:
+            version = self.get_version(scope)
+        full_key = self._key(scope, key, version)
+        expires_at = None if timeout is None else time.time() + timeout
+        # o backend do Django só aceita segundos inteiros, então o prazo exato vai junto com o valor
+        self.shared.set(full_key, (value, expires_at), None if timeout is None else int(timeout) + 1)
+        self.local.set(full_key, value, timeout)
+
+    def clear_local(self) -> None:
+        self.local.clear()
@@ -0,0 +1,325 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone as dt_timezone
+from typing import Optional, FrozenSet, Iterable, Dict, Callable
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .cache import VersionedTwoTierCache
+from .features import feature_registry
+from .plans import Plan, plan_catalog
+
+REQUEST_ATTRIBUTE = '_subscription_entitlements'
+TOKEN_CLAIM = 'ent'
+
+entitlement_cache = VersionedTwoTierCache('subscription:ent')
+
+
+@dataclass(frozen=True)
+class CustomerEntitlements:
+    """ O que o plano ativo de um cliente libera. As features vêm do catálogo a partir do plan_id """
+    customer_id: int
+    signature_id: Optional[int]
+    plan_id: Optional[str]
+    expiration_date: Optional[datetime]
+
+    @property
+    def plan(self) -> Optional[Plan]:
+        return plan_catalog.get_plan(self.plan_id) if self.plan_id else None
+
+    @property
+    def features(self) -> FrozenSet[str]:
+        plan = self.plan
+        return plan.features if plan else frozenset()
+
+    @property
+    def features_mask(self) -> int:
+        plan = self.plan
+        return feature_registry.get_plan_mask(plan) if plan else 0
+
+
+@dataclass(frozen=True)
+class ProfileEntitlements:
+    """ O que o perfil de um usuário libera dentro do cliente dele """
+    user_id: int
+    profile_id: int
+    customer_id: Optional[int]
+    allowed_actions: str
+    features_mask: int
+
+
+def get_cache_timeout() -> int:
+    return getattr(settings, 'SUBSCRIPTION_ENTITLEMENT_CACHE_TIMEOUT', 300)
+
+
+def token_claims_enabled() -> bool:
+    return getattr(settings, 'SUBSCRIPTION_JWT_ENTITLEMENT_CLAIMS', False)
+
+
+def _customer_scope(customer_id: int) -> str:
+    return f'customer:{customer_id}'
+
+
+def _user_scope(user_id: int) -> str:
+    return f'user:{user_id}'
+
+
+def invalidate_customer_entitlements(customer_id: Optional[int]) -> None:
+    """ Invalida as entitlements de um cliente (e, por tabela, dos perfis dele) assim que a transação atual commitar """
+    if customer_id:
+        transaction.on_commit(lambda: entitlement_cache.bump(_customer_scope(customer_id)))
+
+
+def invalidate_user_entitlements(user_id: Optional[int]) -> None:
+    """ Invalida as entitlements do perfil de um usuário assim que a transação atual commitar """
+    if user_id:
+        transaction.on_commit(lambda: entitlement_cache.bump(_user_scope(user_id)))
+
+
+def build_customer_entitlements(customer: 'Customer', signature: 'PaidContent' = None) -> CustomerEntitlements:
+    if signature is None:
+        signature = customer.get_active_signature()
+    return CustomerEntitlements(customer_id=customer.id, signature_id=signature.pk, plan_id=signature.stripe_id,
+                                expiration_date=signature.expiration_date)
+
+
+def build_profile_entitlements(profile: 'UserProfile') -> ProfileEntitlements:
+    return ProfileEntitlements(user_id=profile.user_id, profile_id=profile.id, customer_id=profile.client_id,
+                               allowed_actions=profile.allowed_actions, features_mask=profile.get_features_mask())
+
+
+def get_customer_entitlements(customer_id: int, get_customer: Callable[[], 'Customer'] = None,
+                              get_signature: Callable[[], 'PaidContent'] = None) -> CustomerEntitlements:
+    """ Retorna as entitlements do cliente, do cache se possível. Em caso de miss, calcula a partir do BD e guarda com
+    um timeout que termina exatamente no vencimento da assinatura ativa
+
+    Args:
+        customer_id: id do cliente
+        get_customer: função que retorna o cliente, se quem chama já o tiver em mãos
+        get_signature: função que retorna a assinatura ativa, se quem chama já a tiver em mãos
+    """
+    scope = _customer_scope(customer_id)
+    version = entitlement_cache.get_version(scope)
+    entitlements = entitlement_cache.get(scope, 'entitlements', version=version)
+    if entitlements is None:
+        if get_customer is not None:
+            customer = get_customer()
+        else:
+            from subscription.models import Customer
+            customer = Customer.objects.get(id=customer_id)
+        entitlements = build_customer_entitlements(customer, get_signature() if get_signature else None)
+        timeout = get_cache_timeout()
+        if entitlements.expiration_date is not None:
+            timeout = min(timeout, (entitlements.expiration_date - timezone.now()).total_seconds())
+        entitlement_cache.set(scope, 'entitlements', entitlements, timeout, version=version)
+    return entitlements
+
+
+def get_profile_entitlements(user_id: int, get_profile: Callable[[], 'UserProfile'] = None) -> ProfileEntitlements:
+    """ Retorna as entitlements do perfil do usuário, do cache se possível. Dá ObjectDoesNotExist se ele não
+    tiver perfil
+
+    Args:
+        user_id: id do usuário
+        get_profile: função que retorna o perfil, se quem chama já o tiver em mãos
+    """
+    scope = _user_scope(user_id)
+    version = entitlement_cache.get_version(scope)
+    entitlements = entitlement_cache.get(scope, 'profile', version=version)
+    if entitlements is None:
+        if get_profile is not None:
+            profile = get_profile()
+        else:
+            from subscription.models import UserProfile
+            profile = UserProfile.objects.get(user_id=user_id)
+        entitlements = build_profile_entitlements(profile)
+        entitlement_cache.set(scope, 'profile', entitlements, get_cache_timeout(), version=version)
+    return entitlements
+
+
+def _get_versions(user_id: int, customer_id: Optional[int]) -> list:
+    return [entitlement_cache.get_version(_user_scope(user_id)),
+            entitlement_cache.get_version(_customer_scope(customer_id)) if customer_id else None]
+
+
+def get_token_claims(user_id: int) -> Optional[dict]:
+    """
+    Monta as entitlements que vão dentro do token de acesso (claim `ent`): cliente, perfil, ações permitidas, máscara
+    de features do perfil e plano ativo, junto com as versões do cache do usuário e do cliente no momento da emissão.
+    A máscara do plano não vai no token: ela é calculada a partir do catálogo de planos do processo, então uma mudança
+    no plans.json vale na hora. Retorna None se o usuário não tiver perfil (o token sai sem entitlements).
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    try:
+        profile = get_profile_entitlements(user_id)
+    except ObjectDoesNotExist:
+        return None
+    # as versões são lidas antes das entitlements do cliente: se algo mudar no meio, o token já nasce desatualizado
+    versions = _get_versions(user_id, profile.customer_id)
+    customer = get_customer_entitlements(profile.customer_id) if profile.customer_id else None
+    expiration_date = customer.expiration_date if customer else None
+    return {
+        'v': versions,
+        'cid': profile.customer_id,
+        'pid': profile.profile_id,
+        'act': profile.allowed_actions,
+        'fm': profile.features_mask,
+        'plan': customer.plan_id if customer else None,
+        'sig': customer.signature_id if customer else None,
+        'sx': int(expiration_date.timestamp()) if expiration_date else None,
+    }
+
+
+def check_token_claims(claims: Optional[dict], user_id: int) -> Optional[dict]:
+    """
+    Retorna as entitlements do token se elas ainda valerem: as versões do usuário e do cliente no cache têm que ser as
+    mesmas da emissão (qualquer invalidação, como troca de plano ou de perfil, muda a versão) e a assinatura ativa não
+    pode ter vencido. Senão retorna None, e as entitlements são resolvidas pelo cache/BD como sem o token.
+    """
+    if not isinstance(claims, dict) or user_id is None:
+        return None
+    try:
+        if claims['sx'] is not None and claims['sx'] <= timezone.now().timestamp():
+            return None
+        if _get_versions(user_id, claims['cid']) != claims['v']:
+            return None
+    except KeyError:
+        # token emitido por outra versão do pacote
+        return None
+    return claims
+
+
+class RequestEntitlements:
+    """
+    Contexto de autorização de uma requisição. Resolve usuário, perfil, cliente, assinatura ativa, features e ações
+    permitidas uma única vez e guarda tudo na própria requisição, pra que check_permissions e os métodos das viewsets
+    base não repitam as mesmas consultas.
+
+    As features e ações permitidas vêm do cache de entitlements (LRU do processo + cache do Django), então no caso comum
+    a autorização não vai ao BD. Com SUBSCRIPTION_JWT_ENTITLEMENT_CLAIMS, elas vêm do próprio token de acesso, e o cache
+    só é consultado pra comparar as versões. Perfil, cliente e assinatura continuam disponíveis como objetos do BD,
+    carregados só se alguém precisar deles.
+
+    Todos os atributos são preguiçosos: nada é consultado até que alguém precise. Os que dependem do perfil dão
+    ObjectDoesNotExist se o usuário da requisição não tiver perfil, assim como o `user.profile` do Django.
+    """
+
+    def __init__(self, request):
+        self.user_id = getattr(request.user, 'id', None)
+        self._request_user = request.user
+        auth = getattr(request, 'auth', None)
+        self._token_claims = auth.get(TOKEN_CLAIM) if hasattr(auth, 'get') and token_claims_enabled() else None
+
+    @cached_property
+    def profile(self) -> 'UserProfile':
+        """ Perfil do usuário da requisição, já com usuário e cliente carregados (uma única consulta) """
+        from subscription.models import UserProfile
+        return UserProfile.objects.select_related('user', 'client').get(user_id=self.user_id)
+
+    @cached_property
+    def user(self) -> 'SystemUser':
+        from subscription.models import SystemUser
+        if isinstance(self._request_user, SystemUser):
+            return self._request_user
+        return self.profile.user
+
+    @property
+    def customer(self) -> Optional['Customer']:
+        return self.profile.client
+
+    @property
+    def customer_id(self) -> Optional[int]:
+        return self.profile_entitlements.customer_id
+
+    @cached_property
+    def active_signature(self) -> Optional['PaidContent']:
+        return self.customer.get_active_signature() if self.customer else None
+
+    @cached_property
+    def token_claims(self) -> Optional[dict]:
+        """ Entitlements gravadas no token de acesso, se ainda valerem (ver get_token_claims) """
+        return check_token_claims(self._token_claims, self.user_id)
+
+    @cached_property
+    def profile_entitlements(self) -> ProfileEntitlements:
+        claims = self.token_claims
+        if claims is not None:
+            return ProfileEntitlements(user_id=self.user_id, profile_id=claims['pid'], customer_id=claims['cid'],
+                                       allowed_actions=claims['act'], features_mask=claims['fm'])
+        return get_profile_entitlements(self.user_id, lambda: self.profile)
+
+    @cached_property
+    def customer_entitlements(self) -> Optional[CustomerEntitlements]:
+        customer_id = self.profile_entitlements.customer_id
+        if not customer_id:
+            return None
+        claims = self.token_claims
+        if claims is not None:
+            expiration_date = datetime.fromtimestamp(claims['sx'], tz=dt_timezone.utc) if claims['sx'] else None
+            return CustomerEntitlements(customer_id=customer_id, signature_id=claims['sig'], plan_id=claims['plan'],
+                                        expiration_date=expiration_date)
+        return get_customer_entitlements(customer_id, lambda: self.customer, lambda: self.active_signature)
+
+    @cached_property
+    def plan(self) -> Optional[Plan]:
+        return self.customer_entitlements.plan if self.customer_entitlements else None
+
+    @property
+    def customer_features(self) -> FrozenSet[str]:
+        """ Features liberadas pelo plano ativo do cliente """
+        return self.customer_entitlements.features if self.customer_entitlements else frozenset()
+
+    @cached_property
+    def features_mask(self) -> int:
+        """ Máscara das features que o perfil pode acessar (AND entre a máscara do perfil e a do plano do cliente) """
+        if not self.customer_entitlements:
+            return 0
+        return self.profile_entitlements.features_mask & self.customer_entitlements.features_mask
+
+    @cached_property
+    def features(self) -> FrozenSet[str]:
+        """ Features que o perfil pode acessar (interseção entre as do perfil e as do plano do cliente) """
+        return feature_registry.get_codes(self.features_mask)
+
+    @property
+    def allowed_actions(self) -> str:
+        return self.profile_entitlements.allowed_actions
+
+    def can_access_feature(self, feature: str) -> bool:
+        return feature_registry.contains(self.features_mask, feature)
+
+    def can_access_features(self, features: Iterable[str]) -> Dict[str, bool]:
+        """ Verifica várias features de uma vez, retornando um dicionário feature -> acesso """
+        return feature_registry.check(self.features_mask, features)
+
+    def can_read(self) -> bool:
+        from subscription.models import AllowedActions
+        return self.allowed_actions in AllowedActions.get_read_permissions()
+
+    def can_create(self) -> bool:
+        from subscription.models import AllowedActions
+        return self.allowed_actions in AllowedActions.get_create_permissions()
+
+    def can_update(self) -> bool:
+        from subscription.models import AllowedActions
+        return self.allowed_actions in AllowedActions.get_update_permissions()
+
+    def can_delete(self) -> bool:
+        from subscription.models import AllowedActions
+        return self.allowed_actions in AllowedActions.get_delete_permissions()
+
+
+def get_entitlements(request) -> RequestEntitlements:
+    """
+    Retorna o contexto de autorização da requisição, criando-o na primeira chamada. O contexto fica guardado no
+    HttpRequest do Django (e não na Request do DRF), então é o mesmo em middlewares, views e serializers.
+    """
+    http_request = getattr(request, '_request', request)
+    entitlements = getattr(http_request, REQUEST_ATTRIBUTE, None)
+    # O usuário só é definido depois da autenticação do DRF, então não reaproveitamos um contexto de outro usuário
+    if entitlements is None or entitlements.user_id != getattr(request.user, 'id', None):
+        entitlements = RequestEntitlements(request)
+        setattr(http_request, REQUEST_ATTRIBUTE, entitlements)
+    return entitlements
@@ -0,0 +1,47 @@
+import csv
+from typing import Iterable, Iterator, Sequence
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+class _LineBuffer:
+    """ "Arquivo" que só devolve o que foi escrito, pra usar o csv.writer sem acumular nada em memória """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def _batched(lines: Iterable[str], batch_size: int) -> Iterator[bytes]:
+    """ Junta as linhas em blocos, pra não mandar um pedaço minúsculo da resposta por linha """
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield ''.join(batch).encode()
+            batch = []
+    if batch:
+        yield ''.join(batch).encode()
+
+
+def iter_ndjson(rows: Iterable[dict], batch_size: int = 500) -> Iterator[bytes]:
+    """ Codifica as linhas em NDJSON (um objeto json por linha), conforme são lidas """
+    encoder = DjangoJSONEncoder()
+    return _batched((encoder.encode(row) + '\n' for row in rows), batch_size)
+
+
+def iter_csv(rows: Iterable[dict], fields: Sequence[str], batch_size: int = 500) -> Iterator[bytes]:
+    """ Codifica as linhas em CSV (com cabeçalho), conforme são lidas """
+    writer = csv.writer(_LineBuffer())
+
+    def lines():
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow([row[field] for field in fields])
+
+    return _batched(lines(), batch_size)
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', lambda rows, fields: iter_ndjson(rows)),
+    'csv': ('text/csv', iter_csv),
+}
@@ -0,0 +1,211 @@
+import threading
+import time
+from typing import Dict, Iterable, FrozenSet, Optional, List, Iterator, Mapping
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+
+from .plans import Plan, plan_catalog
+
+# as máscaras são guardadas em um BigIntegerField (com sinal), então cabem 63 features
+MAX_FEATURES = 63
+
+
+class FeatureRegistry:
+    """
+    Registro que atribui a cada feature uma posição de bit fixa, guardada na tabela Feature. Com isso, as features de
+    um plano ou de um perfil viram um inteiro (máscara) e verificar se alguém tem acesso a uma feature é um único AND.
+
+    As posições são carregadas do BD uma única vez por processo, e a leitura nunca escreve no BD: features que ainda
+    não foram registradas ficam de fora das máscaras (ou seja, ninguém tem acesso a elas). As features do catálogo de
+    planos são registradas fora das consultas (ver sync_catalog_features): depois de cada `migrate` e sempre que o
+    catálogo carrega uma versão nova do plans.json. Se uma feature desconhecida for consultada, as posições são
+    recarregadas do BD (no máximo uma vez a cada `SUBSCRIPTION_FEATURE_RELOAD_INTERVAL` segundos), pra que os workers
+    enxerguem as features registradas por outro processo sem reiniciar.
+    """
+
+    def __init__(self):
+        self._bits = None
+        self._codes = {}
+        self._plan_masks = {}
+        self._loaded_at = 0.0
+        self._lock = threading.RLock()
+
+    @property
+    def reload_interval(self) -> float:
+        return getattr(settings, 'SUBSCRIPTION_FEATURE_RELOAD_INTERVAL', 60)
+
+    def _load(self) -> None:
+        from subscription.models import Feature
+        bits = dict(Feature.objects.values_list('code', 'bit'))
+        self._codes = {bit: code for code, bit in bits.items()}
+        self._bits = bits
+        self._loaded_at = time.monotonic()
+
+    def register(self, codes: Iterable[str]) -> List[str]:
+        """
+        Registra as features que ainda não têm uma posição de bit. Escreve no BD, então não é chamado pelas consultas,
+        só pelo registro do catálogo (ver sync_catalog_features) e por rotinas de carga. As posições novas valem nesse
+        processo na hora, mesmo antes da transação atual commitar
+
+        Returns:
+            Códigos das features registradas agora
+        """
+        from subscription.models import Feature
+        registered = []
+        with self._lock:
+            for code in sorted(set(codes)):
+                for _ in range(3):
+                    # outro processo pode ter registrado a feature (ou ocupado o próximo bit) nesse meio tempo
+                    self._load()
+                    if code in self._bits:
+                        break
+                    bit = max(self._bits.values(), default=-1) + 1
+                    if bit >= MAX_FEATURES:
+                        raise ValueError(f'Não é possível registrar mais de {MAX_FEATURES} features')
+                    try:
+                        with transaction.atomic():
+                            Feature.objects.create(code=code, bit=bit)
+                    except IntegrityError:
+                        continue
+                    registered.append(code)
+                    break
+                else:
+                    raise RuntimeError(f'Não foi possível registrar a feature {code}')
+            if registered:
+                self._load()
+                self._plan_masks = {}
+        return registered
+
+    def register_catalog(self, plans: Mapping[str, Plan] = None) -> List[str]:
+        """ Registra todas as features do catálogo de planos (ou dos `plans` informados) que ainda não têm posição (ver
+        register) """
+        plans = plan_catalog.plans if plans is None else plans
+        return self.register(code for plan in plans.values() for code in plan.features)
+
+    def _ensure_loaded(self) -> None:
+        if self._bits is None:
+            with self._lock:
+                if self._bits is None:
+                    self._load()
+
+    def get_bit(self, code: str) -> Optional[int]:
+        """ Retorna a posição do bit da feature, ou None se ela não estiver registrada """
+        self._ensure_loaded()
+        bit = self._bits.get(code)
+        if bit is None and time.monotonic() - self._loaded_at >= self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._loaded_at >= self.reload_interval:
+                    self._load()
+                    self._plan_masks = {}
+            bit = self._bits.get(code)
+        return bit
+
+    def get_mask(self, codes: Iterable[str]) -> int:
+        """ Converte uma coleção de features em máscara. Features não registradas são ignoradas """
+        mask = 0
+        for code in codes:
+            bit = self.get_bit(code)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def get_codes(self, mask: int) -> FrozenSet[str]:
+        """ Converte uma máscara de volta na coleção de features """
+        self._ensure_loaded()
+        codes = set()
+        while mask:
+            lowest = mask & -mask
+            code = self._codes.get(lowest.bit_length() - 1)
+            if code is not None:
+                codes.add(code)
+            mask ^= lowest
+        return frozenset(codes)
+
+    def contains(self, mask: int, code: str) -> bool:
+        """ Verifica se a feature está na máscara """
+        bit = self.get_bit(code)
+        return bit is not None and bool(mask >> bit & 1)
+
+    def check(self, mask: int, codes: Iterable[str]) -> Dict[str, bool]:
+        """ Verifica várias features de uma vez contra a mesma máscara """
+        return {code: self.contains(mask, code) for code in codes}
+
+    def get_plan_mask(self, plan: Plan) -> int:
+        """ Máscara das features de um plano. É calculada uma vez por plano compilado pelo catálogo """
+        cached = self._plan_masks.get(plan.id)
+        if cached is not None and cached[0] is plan:
+            return cached[1]
+        mask = self.get_mask(plan.features)
+        # enquanto alguma feature do plano não estiver registrada, a máscara não é guardada, pra que o registro dela
+        # por outro processo seja visto
+        if bin(mask).count('1') == len(plan.features):
+            self._plan_masks[plan.id] = (plan, mask)
+        return mask
+
+    def reset(self) -> None:
+        """ Descarta as posições carregadas, que serão lidas de novo do BD no próximo uso """
+        with self._lock:
+            self._bits = None
+            self._codes = {}
+            self._plan_masks = {}
+
+
+feature_registry = FeatureRegistry()
+
+
+def refresh_profile_masks(codes: Iterable[str] = (), refresh_all: bool = False,
+                          chunk_size: int = 1000) -> Iterator[int]:
+    """
+    Recalcula, em lotes, a máscara dos perfis que ainda não têm uma (features_mask nulo) e dos que têm alguma das
+    features `codes` em available_features (as máscaras gravadas antes do registro de uma feature não têm o bit dela)
+
+    Args:
+        codes: features registradas há pouco
+        refresh_all: recalcula a máscara de todos os perfis
+        chunk_size: quantidade de perfis por lote
+
+    Returns:
+        Gerador com o total de perfis migrados depois de cada lote
+    """
+    from subscription.models import UserProfile
+    from .entitlements import invalidate_user_entitlements
+    if refresh_all:
+        queryset = UserProfile.objects.all()
+    else:
+        condition = Q(features_mask__isnull=True)
+        for code in codes:
+            condition |= Q(available_features__contains=code)
+        queryset = UserProfile.objects.filter(condition)
+    last_id = 0
+    migrated = 0
+    while True:
+        profiles = list(queryset.filter(id__gt=last_id).order_by('id')
+                        .only('id', 'user_id', 'available_features', 'features_mask')[:chunk_size])
+        if not profiles:
+            break
+        with transaction.atomic():
+            for profile in profiles:
+                profile.features_mask = feature_registry.get_mask(profile.get_feature_set())
+                invalidate_user_entitlements(profile.user_id)
+            UserProfile.objects.bulk_update(profiles, ['features_mask'])
+        migrated += len(profiles)
+        last_id = profiles[-1].id
+        yield migrated
+
+
+def sync_catalog_features(plans: Mapping[str, Plan] = None) -> List[str]:
+    """
+    Registra as features do catálogo de planos (ou dos `plans` informados) que ainda não têm posição e corrige a
+    máscara dos perfis que já tinham alguma delas. É chamado depois de cada `migrate` e quando o catálogo carrega uma
+    versão nova do plans.json (ver apps.py), então uma feature nova no plano vale sem rodar nenhum comando
+
+    Returns:
+        Códigos das features registradas agora
+    """
+    registered = feature_registry.register_catalog(plans)
+    if registered:
+        for _ in refresh_profile_masks(registered):
+            pass
+    return registered
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Any, Tuple, Optional
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .api_helpers import get_custom_server_busy_http_code_and_message
+from .metrics import metrics
+
+
+class HashingPoolBusy(APIException):
+    """ Exceção levantada quando a fila do pool de hashing está cheia. O DRF converte o `wait` no header Retry-After """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    def __init__(self, wait: int = 1):
+        payload = get_custom_server_busy_http_code_and_message()
+        super().__init__(detail=payload['message'], code=payload['code'])
+        self.wait = wait
+
+
+class HashingPool:
+    """
+    Pool limitado de threads pro hashing de senhas (PBKDF2, bcrypt, argon2...), que é caro de propósito. No máximo
+    `SUBSCRIPTION_HASHING_WORKERS` hashes rodam ao mesmo tempo no processo, e no máximo `SUBSCRIPTION_HASHING_QUEUE`
+    esperam na fila. Passando disso, a requisição é recusada na hora com 503 e Retry-After (HashingPoolBusy).
+
+    A thread da requisição continua esperando o resultado em `run` (as views de autenticação são síncronas), então o
+    pool não libera workers da aplicação: ele limita a CPU gasta com hashing, pra que um pico de logins não dispute a
+    CPU com as outras rotas, e descarta a carga que passa da fila em vez de acumular requisições esperando. Só `arun`,
+    chamado de views assíncronas em ASGI, espera sem ocupar uma thread.
+
+    Threads bastam porque os hashers liberam o GIL durante o cálculo (hashlib.pbkdf2_hmac, bcrypt e argon2). O pool é
+    criado no primeiro uso, em cada processo (inclusive depois de um fork).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._running = 0
+        self.pending = 0  # hashes na fila ou rodando
+        self.max_pending = 0  # maior profundidade da fila desde que o processo subiu
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0  # tempo total (s) que os hashes passaram na fila
+
+    @property
+    def workers(self) -> int:
+        return getattr(settings, 'SUBSCRIPTION_HASHING_WORKERS', None) or min(4, os.cpu_count() or 1)
+
+    @property
+    def queue_size(self) -> int:
+        queue_size = getattr(settings, 'SUBSCRIPTION_HASHING_QUEUE', None)
+        return self.workers * 8 if queue_size is None else queue_size
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='subscription-hashing')
+                    self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, fn: Callable, *args) -> Future:
+        """ Agenda a função no pool. Levanta HashingPoolBusy se o pool e a fila estiverem cheios """
+        executor = self._get_executor()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingPoolBusy()
+        queued_at = time.monotonic()
+        with self._lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+        def run():
+            with self._lock:
+                self._running += 1
+                self.wait_time += time.monotonic() - queued_at
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self.pending -= 1
+                    self.completed += 1
+                slots.release()
+
+        try:
+            return executor.submit(run)
+        except RuntimeError:
+            with self._lock:
+                self.pending -= 1
+            slots.release()
+            raise
+
+    def run(self, fn: Callable, *args) -> Any:
+        """ Executa a função no pool e espera o resultado, bloqueando a thread que chamou (pra views síncronas) """
+        return self.submit(fn, *args).result()
+
+    async def arun(self, fn: Callable, *args) -> Any:
+        """ Executa a função no pool sem bloquear o event loop (pra views assíncronas, em ASGI) """
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> dict:
+        """ Métricas do pool: tamanho, profundidade atual e máxima da fila, concluídos, recusados e espera média """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'running': self._running,
+                'queued': self.pending - self._running,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'average_wait': self.wait_time / self.completed if self.completed else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        """ Encerra o pool, que será recriado (com as configurações atuais) no próximo uso """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+hashing_pool = HashingPool()
+
+
+def collect_hashing_metrics():
+    stats = hashing_pool.stats()
+    yield 'subscription_hashing_pool_queued', 'gauge', 'Hashes de senha esperando na fila do pool.', \
+        [({}, stats['queued'])]
+    yield 'subscription_hashing_pool_running', 'gauge', 'Hashes de senha rodando no pool.', [({}, stats['running'])]
+    yield 'subscription_hashing_pool_rejected_total', 'counter', 'Hashes recusados com o pool e a fila cheios.', \
+        [({}, stats['rejected'])]
+    yield 'subscription_hashing_pool_completed_total', 'counter', 'Hashes concluídos pelo pool.', \
+        [({}, stats['completed'])]
+
+
+metrics.register_collector(collect_hashing_metrics)
+
+
+def _check_password(raw_password: str, encoded: str) -> Tuple[bool, bool]:
+    must_update = []
+    # o setter só é chamado se a senha estiver correta e o hash tiver que ser refeito (hasher ou parâmetros mudaram)
+    correct = hashers.check_password(raw_password, encoded, setter=must_update.append)
+    return correct, bool(must_update)
+
+
+def make_password(raw_password: Optional[str]) -> str:
+    """ make_password do Django, rodando no pool de hashing """
+    if raw_password is None:
+        # senha inutilizável, não tem hashing
+        return hashers.make_password(None)
+    return hashing_pool.run(hashers.make_password, raw_password)
+
+
+def check_password(raw_password: Optional[str], encoded: str) -> Tuple[bool, bool]:
+    """ check_password do Django, rodando no pool de hashing. Retorna se a senha está correta e se o hash dela tem que
+    ser refeito com o hasher/parâmetros atuais """
+    if raw_password is None or not hashers.is_password_usable(encoded):
+        return False, False
+    return hashing_pool.run(_check_password, raw_password, encoded)
+
+
+async def amake_password(raw_password: Optional[str]) -> str:
+    if raw_password is None:
+        return hashers.make_password(None)
+    return await hashing_pool.arun(hashers.make_password, raw_password)
+
+
+async def acheck_password(raw_password: Optional[str], encoded: str) -> Tuple[bool, bool]:
+    if raw_password is None or not hashers.is_password_usable(encoded):
+        return False, False
+    return await hashing_pool.arun(_check_password, raw_password, encoded)
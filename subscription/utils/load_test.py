@@ -0,0 +1,249 @@
+import itertools
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.urls import reverse, NoReverseMatch
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .benchmarks import get_default_plan
+from .plans import Plan
+from .synthetic import SyntheticDataGenerator
+
+# rotas de api/auth/routes.py exercitadas pelo teste de carga, e o peso padrão de cada uma no sorteio
+ROUTES = {
+    'login': 1,
+    'refresh': 2,
+    'get-profile': 5,
+    'profiles': 3,
+    'customers': 3,
+    'register-purchase': 1,
+}
+LOAD_TEST_PASSWORD = 'load-test-password'
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """ Converte um mix no formato `rota=peso,rota=peso` (ex.: `login=1,get-profile=5`) em dicionário """
+    weights = {}
+    for item in filter(None, (part.strip() for part in mix.split(','))):
+        route, _, weight = item.partition('=')
+        if route not in ROUTES:
+            raise ValueError(f'Rota desconhecida no mix: {route}. Opções: {", ".join(ROUTES)}.')
+        weights[route] = float(weight or 1)
+    if not weights or not any(weights.values()):
+        raise ValueError('O mix não tem nenhuma rota com peso positivo.')
+    return weights
+
+
+def get_percentile(values: List[float], percentile: float) -> float:
+    """ Percentil pelo método do posto mais próximo, sobre uma lista já ordenada """
+    if not values:
+        return 0.0
+    return values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
+
+
+def get_url_prefix() -> str:
+    """ Prefixo das rotas do pacote no urls.py do projeto (ex.: '/auth/'), derivado da rota de login """
+    try:
+        return reverse('subscription:token_obtain_pair')[:-len('login/')]
+    except NoReverseMatch:
+        return reverse('token_obtain_pair')[:-len('login/')]
+
+
+class LoadTestWorker:
+    """ Estado de um usuário virtual: o cliente HTTP e os tokens dele. Cada thread do pool tem o seu """
+
+    def __init__(self, email: str, customer_id: int, plan: Plan, url_prefix: str):
+        self.client = APIClient()
+        self.email = email
+        self.customer_id = customer_id
+        self.plan = plan
+        self.url_prefix = url_prefix
+        self.refresh = None
+        self.access = None
+
+    def set_tokens(self, refresh: Optional[str], access: str) -> None:
+        self.refresh = refresh or self.refresh
+        self.access = access
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def request(self, route: str):
+        url = self.url_prefix
+        if route == 'login':
+            response = self.client.post(url + 'login/', {'email': self.email, 'password': LOAD_TEST_PASSWORD},
+                                        format='json')
+            if response.status_code == 200:
+                self.set_tokens(response.data['refresh'], response.data['access'])
+            return response
+        if route == 'refresh':
+            response = self.client.post(url + 'login/refresh/', {'refresh': self.refresh}, format='json')
+            if response.status_code == 200:
+                self.set_tokens(response.data.get('refresh'), response.data['access'])
+            return response
+        if route == 'register-purchase':
+            # o mesmo cliente compra pelos vários usuários dele ao mesmo tempo, o que expõe a corrida da exclusividade
+            return self.client.post(url + 'register-purchase', {
+                'id': f'evt_load_{uuid.uuid4().hex}', 'type': 'payment_intent.succeeded',
+                'data': {'object': {'description': f'{self.customer_id}-{self.plan.id}'}},
+            }, format='json')
+        return self.client.get(url + route)
+
+
+class LoadTest:
+    """
+    Gerador de carga em processo para as rotas de api/auth/routes.py. Um pool de `concurrency` threads dispara
+    `requests` requisições pelo cliente de teste do DRF (sem servidor HTTP, então mede só a aplicação e o BD), sorteando
+    as rotas de acordo com os pesos de `mix`. Cada thread é um usuário virtual com os próprios tokens, e os usuários são
+    distribuídos entre `customers` clientes gerados pelo SyntheticDataGenerator, então vários usuários disputam os
+    mesmos clientes.
+
+    As compras (`register-purchase`) só gravam o evento na caixa de entrada; `processors` threads processam os eventos
+    durante o teste, como vários process_stripe_webhooks rodando ao mesmo tempo. Depois de cada rodada, as invariantes
+    que as corridas quebrariam são verificadas (ver check_invariants).
+
+    Deve rodar em um BD descartável (o comando load_test cria um BD de teste). Pra medir a contenção de verdade, use o
+    mesmo BD de produção (ex.: PostgreSQL): o SQLite serializa as escritas, e as requisições que esbarram na trava dele
+    aparecem como erros.
+    """
+
+    def __init__(self, mix: Dict[str, float] = None, customers: int = 10, users: int = 16, history: int = 100,
+                 processors: int = 2, plan: Plan = None, seed: int = 0, url_prefix: str = None):
+        self.mix = mix or dict(ROUTES)
+        self.customers = customers
+        self.users = users
+        self.history = history
+        self.processors = processors
+        self.plan = plan or get_default_plan()
+        self.seed = seed
+        self.url_prefix = url_prefix
+        self.workers = []
+
+    def setup(self) -> None:
+        """ Gera os clientes e os usuários virtuais (todos com a mesma senha, com um único hashing) """
+        from subscription.models import SystemUser, Customer, UserProfile, AllowedActions
+        generator = SyntheticDataGenerator(self.customers, profiles=0, history=self.history, seed=self.seed,
+                                           prefix='load-test')
+        generator.generate()
+        customers = list(Customer.objects.filter(owner__email__startswith=f'load-test-{self.seed}-')
+                         .order_by('id').values_list('id', flat=True))
+        password = make_password(LOAD_TEST_PASSWORD)
+        emails = [f'load-test-{self.seed}-user-{i}@example.com' for i in range(self.users)]
+        SystemUser.objects.bulk_create([SystemUser(email=email, password=password) for email in emails])
+        users = dict(SystemUser.objects.filter(email__in=emails).values_list('email', 'id'))
+        features = ','.join(sorted(self.plan.features))
+        for i, email in enumerate(emails):
+            UserProfile(user_id=users[email], client_id=customers[i % len(customers)], available_features=features,
+                        allowed_actions=AllowedActions.ADMINISTRATOR).save()
+        url_prefix = self.url_prefix if self.url_prefix is not None else get_url_prefix()
+        self.workers = []
+        for i, email in enumerate(emails):
+            worker = LoadTestWorker(email, customers[i % len(customers)], self.plan, url_prefix)
+            refresh = RefreshToken.for_user(SystemUser(id=users[email], email=email))
+            worker.set_tokens(str(refresh), str(refresh.access_token))
+            self.workers.append(worker)
+
+    def process_events(self, stop: threading.Event, errors: list) -> None:
+        """ Processa a caixa de entrada de webhooks até o teste acabar e a fila esvaziar """
+        from subscription.models import StripeWebhookEvent
+        try:
+            while True:
+                try:
+                    processed = StripeWebhookEvent.process_pending(batch_size=10)['total']
+                except Exception as e:
+                    errors.append(repr(e))
+                    processed = 0
+                if not processed:
+                    if stop.is_set():
+                        break
+                    time.sleep(0.01)
+        finally:
+            connection.close()
+
+    def run(self, concurrency: int, requests: int) -> dict:
+        """ Dispara `requests` requisições com `concurrency` threads e retorna as métricas da rodada """
+        if not self.workers:
+            self.setup()
+        counter = itertools.count()
+        samples = {route: [] for route in self.mix}
+        routes, weights = list(self.mix), list(self.mix.values())
+
+        def work(index: int):
+            worker = self.workers[index % len(self.workers)]
+            rng = random.Random(f'{self.seed}-{concurrency}-{index}')
+            try:
+                while next(counter) < requests:
+                    route = rng.choices(routes, weights)[0]
+                    start = time.perf_counter()
+                    try:
+                        status = worker.request(route).status_code
+                    except Exception as e:
+                        status = type(e).__name__
+                    samples[route].append((time.perf_counter() - start, status))
+            finally:
+                connection.close()
+
+        stop, processor_errors = threading.Event(), []
+        processors = [threading.Thread(target=self.process_events, args=(stop, processor_errors), daemon=True)
+                      for _ in range(self.processors if 'register-purchase' in self.mix else 0)]
+        for processor in processors:
+            processor.start()
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(concurrency, thread_name_prefix='subscription-load-test') as executor:
+            list(executor.map(work, range(concurrency)))
+        elapsed = time.perf_counter() - started_at
+        stop.set()
+        for processor in processors:
+            processor.join()
+
+        report = {'concurrency': concurrency, 'requests': requests, 'duration': elapsed,
+                  'throughput': requests / elapsed if elapsed else 0.0, 'routes': {}}
+        for route, route_samples in samples.items():
+            latencies = sorted(duration * 1000 for duration, _ in route_samples)
+            statuses = {}
+            for _, status in route_samples:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            report['routes'][route] = {
+                'requests': len(route_samples),
+                'errors': sum(count for status, count in statuses.items() if not status.isdigit() or
+                              int(status) >= 500),
+                'throughput': len(route_samples) / elapsed if elapsed else 0.0,
+                'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+                'p50': get_percentile(latencies, 50),
+                'p95': get_percentile(latencies, 95),
+                'p99': get_percentile(latencies, 99),
+                'statuses': statuses,
+            }
+        report['processor_errors'] = len(processor_errors)
+        report['invariants'] = self.check_invariants()
+        return report
+
+    def check_invariants(self) -> dict:
+        """
+        Verifica o estado que as corridas entre requisições concorrentes quebrariam:
+
+        - `duplicate_exclusive_signatures`: clientes com mais de uma assinatura exclusiva ativa (compras exclusivas
+          concorrentes no register_purchase), pros quais o get_active_signature levanta exceção;
+        - `duplicate_free_signatures`: clientes com mais de uma assinatura free sem vencimento (materializações
+          concorrentes da assinatura free);
+        - `failed_events`: eventos do Stripe que esgotaram as tentativas.
+        """
+        from django.db.models import Count
+        from subscription.models import PaidContent, StripeWebhookEvent
+        customers = PaidContent.objects.filter(customer__owner__email__startswith=f'load-test-{self.seed}-')
+
+        def duplicated(queryset) -> int:
+            return queryset.values('customer_id').annotate(total=Count('id')).filter(total__gt=1).count()
+
+        return {
+            'duplicate_exclusive_signatures': duplicated(customers.filter(
+                id__in=PaidContent.active_signatures_queryset().filter(is_exclusive=True).values('id'))),
+            'duplicate_free_signatures': duplicated(customers.filter(stripe_id='free', expiration_date__isnull=True)),
+            'failed_events': StripeWebhookEvent.objects.filter(status=StripeWebhookEvent.Status.FAILED).count(),
+        }
@@ -0,0 +1,235 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from django.db import connection
+
+# limites (em segundos) dos buckets dos histogramas de tempo
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# limites dos buckets do histograma de consultas por requisição
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base das métricas do registro. Cada combinação de valores dos `labels` é uma série, criada no primeiro uso """
+    type = None
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    @property
+    def family(self) -> str:
+        """ Nome da métrica nas linhas HELP e TYPE da exportação """
+        return self.name
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """ Contador que só cresce (ex.: total de recusas) """
+    type = 'counter'
+
+    @property
+    def family(self) -> str:
+        # no formato de texto 0.0.4, o TYPE de um contador tem o mesmo nome das amostras, com o sufixo _total
+        return f'{self.name}_total'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._series.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        """ Soma de todas as séries """
+        with self._lock:
+            return sum(self._series.values())
+
+    def samples(self):
+        with self._lock:
+            series = list(self._series.items())
+        for key, value in series:
+            yield f'{self.name}_total', dict(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    """ Distribuição de valores (ex.: duração) em buckets cumulativos, com a soma e a quantidade de observações """
+    type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = TIME_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # contagem de cada bucket (o último é o +Inf), soma e quantidade
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observa a duração (em segundos) do bloco, mesmo que ele levante exceção """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels) -> Tuple[float, int]:
+        """ Soma e quantidade de observações da série """
+        series = self._series.get(self._key(labels))
+        return (series[1], series[2]) if series else (0.0, 0)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._series.items()]
+        for key, (counts, total, count) in series:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', {**labels, 'le': _format_value(float(bound))}, cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+# coletor: função chamada na hora da exportação, que retorna as métricas no formato (nome, tipo, ajuda, amostras), com
+# as amostras no formato (labels, valor). Serve pra expor contadores que já existem em outros objetos sem duplicá-los
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+class MetricsRegistry:
+    """
+    Registro das métricas do processo. Os contadores e histogramas são agregados entre as threads (cada métrica tem a
+    sua trava, que só protege um incremento) e ficam em memória, sem nenhuma ida ao BD ou ao cache, então podem ser
+    usados nos caminhos quentes. Com vários workers, cada processo tem o seu registro, e quem agrega é o Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = TIME_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def register_collector(self, collector: Collector) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def reset(self) -> None:
+        """ Zera todas as métricas (os coletores continuam registrados) """
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render(self) -> str:
+        """ Exporta as métricas no formato de texto do Prometheus (versão 0.0.4) """
+        lines = []
+        for metric in sorted(self._metrics.values(), key=lambda item: item.name):
+            lines.append(f'# HELP {metric.family} {metric.help}')
+            lines.append(f'# TYPE {metric.family} {metric.type}')
+            lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}'
+                         for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                lines.extend(f'{name}{_format_labels(labels)} {_format_value(value)}' for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+check_permissions_seconds = metrics.histogram(
+    'subscription_check_permissions_seconds', 'Tempo gasto no check_permissions das views do pacote.', ['view'])
+request_queries = metrics.histogram(
+    'subscription_request_queries', 'Consultas ao BD por requisição (QueryMetricsMiddleware).', ['route'],
+    buckets=QUERY_BUCKETS)
+entitlement_cache_lookups = metrics.counter(
+    'subscription_entitlement_cache_lookups', 'Leituras do cache de entitlements, por resultado (hit ou miss).',
+    ['cache', 'result'])
+rate_limit_rejections = metrics.counter(
+    'subscription_rate_limit_rejections', 'Requisições recusadas pelo limite de requisições dos planos.', ['feature'])
+plan_catalog_reloads = metrics.counter(
+    'subscription_plan_catalog_reloads', 'Vezes que os arquivos do catálogo de planos foram (re)compilados.', ['file'])
+webhook_processing_seconds = metrics.histogram(
+    'subscription_webhook_processing_seconds', 'Tempo de processamento de cada evento do Stripe.', ['status'])
+webhook_lag_seconds = metrics.histogram(
+    'subscription_webhook_lag_seconds', 'Tempo entre o recebimento e o fim do processamento dos eventos do Stripe.',
+    ['status'], buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+
+
+class QueryMetricsMiddleware:
+    """
+    Middleware que conta as consultas ao BD de cada requisição (com o `execute_wrapper` da conexão) e as registra em
+    subscription_request_queries, pela rota. Pra ativar, inclua 'subscription.utils.metrics.QueryMetricsMiddleware' no
+    MIDDLEWARE do projeto. As consultas feitas enquanto uma resposta em streaming é enviada não entram na conta.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        # o padrão da rota (e não a url) mantém a quantidade de séries limitada
+        resolver_match = getattr(request, 'resolver_match', None)
+        request_queries.observe(queries, route=getattr(resolver_match, 'route', None) or 'unmatched')
+        return response
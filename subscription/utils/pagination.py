@@ -0,0 +1,178 @@
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from datetime import datetime, time
+from typing import List, Tuple, Any, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, F, QuerySet
+from django.db.models.expressions import OrderBy
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """ O DjangoJSONEncoder corta datas e horas em milissegundos, o que faria o cursor pular linhas com a mesma data até
+    o milissegundo. Aqui a precisão é total """
+
+    def default(self, o):
+        if isinstance(o, (datetime, time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def get_ordering(queryset: QuerySet) -> List[Tuple[str, bool]]:
+    """ Retorna a ordenação da queryset (a da query ou a do Meta do modelo) como pares (campo, decrescente), sempre
+    terminando na pk, pra que a ordem seja total e o cursor aponte pra uma única linha """
+    ordering = []
+    for item in queryset.query.order_by or queryset.model._meta.ordering or ():
+        if isinstance(item, str):
+            ordering.append((item.lstrip('-'), item.startswith('-')))
+        elif isinstance(item, OrderBy) and isinstance(item.expression, F):
+            ordering.append((item.expression.name, item.descending))
+        elif isinstance(item, F):
+            ordering.append((item.name, False))
+        else:
+            raise ImproperlyConfigured(f'Ordenação não suportada pela paginação por cursor: {item!r}')
+    ordering = [('pk' if field == queryset.model._meta.pk.name else field, descending)
+                for field, descending in ordering]
+    if not any(field == 'pk' for field, _ in ordering):
+        ordering.append(('pk', ordering[-1][1] if ordering else False))
+    return ordering
+
+
+def get_seek_filter(ordering: List[Tuple[str, bool]], values: List[Any]) -> Q:
+    """ Monta o filtro das linhas que vêm depois de `values` na ordenação. A forma aninhada
+    `a >= x AND (a > x OR (b >= y AND (b > y OR ...)))` deixa a primeira coluna como um intervalo simples, então o BD
+    consegue buscar direto a posição no índice da ordenação em vez de percorrer as linhas anteriores """
+    (field, descending), value = ordering[-1], values[-1]
+    condition = Q(**{f'{field}__{"lt" if descending else "gt"}': value})
+    for (field, descending), value in zip(reversed(ordering[:-1]), reversed(values[:-1])):
+        condition = Q(**{f'{field}__{"lte" if descending else "gte"}': value}) & (
+            Q(**{f'{field}__{"lt" if descending else "gt"}': value}) | condition)
+    return condition
+
+
+def get_value(obj, field: str) -> Any:
+    for attribute in field.split('__'):
+        obj = getattr(obj, attribute) if obj is not None else None
+    return obj
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginação por cursor (keyset). Em vez de OFFSET, cada página começa logo depois da última linha da página anterior,
+    buscada pelo índice da ordenação, então o custo de uma página não depende de quão fundo ela está. O cursor é opaco
+    pro cliente e é derivado da ordenação da queryset (a pk é sempre incluída no fim, como desempate). Os campos da
+    ordenação não devem ser nulos. Um cursor inválido ou adulterado responde 400.
+
+    O total de objetos só é calculado (um COUNT a mais) se a requisição pedir, com `?count=true`.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    count_query_param = 'count'
+    max_page_size = 1000
+
+    def __init__(self):
+        self.next_cursor = None
+        self.previous_cursor = None
+        self.count = None
+        self.request = None
+
+    def get_page_size(self, request) -> int:
+        page_size = getattr(settings, 'SUBSCRIPTION_PAGE_SIZE', None) or api_settings.PAGE_SIZE or 100
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, page_size))
+        except ValueError:
+            pass
+        return max(1, min(page_size, self.max_page_size))
+
+    @staticmethod
+    def encode_cursor(values: List[Any], reverse: bool = False) -> str:
+        position = {'p': values, 'r': 1} if reverse else {'p': values}
+        return base64.urlsafe_b64encode(json.dumps(position, cls=CursorEncoder).encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor: str, size: int) -> Tuple[List[Any], bool]:
+        """ Retorna os valores da posição e se a página é a anterior a ela. Qualquer cursor que não tenha saído do
+        `encode_cursor` (adulterado ou de outra ordenação) é um erro do cliente """
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (binascii.Error, ValueError):
+            position = None
+        values = position.get('p') if isinstance(position, dict) else None
+        if not isinstance(values, list) or len(values) != size or \
+                not all(isinstance(value, (str, int, float)) for value in values):
+            raise ValidationError({self.cursor_query_param: ['Cursor inválido.']})
+        return values, bool(position.get('r'))
+
+    def paginate_queryset(self, queryset, request, view=None) -> Optional[list]:
+        self.request = request
+        page_size = self.get_page_size(request)
+        ordering = get_ordering(queryset)
+        if request.query_params.get(self.count_query_param, '').lower() in ('1', 'true'):
+            self.count = queryset.count()
+        cursor = request.query_params.get(self.cursor_query_param)
+        values, reverse = self.decode_cursor(cursor, len(ordering)) if cursor else (None, False)
+        # a página anterior é buscada com a ordenação invertida, a partir da mesma posição, e desinvertida no fim
+        seek_ordering = [(field, descending != reverse) for field, descending in ordering]
+        queryset = queryset.order_by(*[f'{"-" if descending else ""}{field}' for field, descending in seek_ordering])
+        if cursor:
+            try:
+                queryset = queryset.filter(get_seek_filter(seek_ordering, values))
+            except (ValueError, TypeError, DjangoValidationError):
+                raise ValidationError({self.cursor_query_param: ['Cursor inválido.']})
+        # uma linha a mais só pra saber se existe página depois desta (na direção da busca)
+        results = list(queryset[:page_size + 1])
+        page = results[:page_size]
+        has_more = len(results) > page_size
+        if reverse:
+            page.reverse()
+        if page:
+            first, last = ([get_value(obj, field) for field, _ in ordering] for obj in (page[0], page[-1]))
+            # vindo de uma página, sempre existe a página do outro lado da posição
+            if has_more or reverse:
+                self.next_cursor = self.encode_cursor(last)
+            if has_more if reverse else cursor:
+                self.previous_cursor = self.encode_cursor(first, reverse=True)
+        elif reverse:
+            # nada antes da posição: a próxima página é a primeira
+            self.next_cursor = ''
+        return page
+
+    def get_link(self, cursor: Optional[str]) -> Optional[str]:
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        if not cursor:
+            return remove_query_param(url, self.cursor_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_next_link(self) -> Optional[str]:
+        return self.get_link(self.next_cursor)
+
+    def get_previous_link(self) -> Optional[str]:
+        return self.get_link(self.previous_cursor)
+
+    def get_paginated_response(self, data) -> Response:
+        response = OrderedDict([('next', self.get_next_link()), ('previous', self.get_previous_link())])
+        if self.count is not None:
+            response['count'] = self.count
+        response['results'] = data
+        return Response(response)
+
+    def get_paginated_response_schema(self, schema: dict) -> dict:
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'count': {'type': 'integer'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,273 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Optional, Mapping, FrozenSet, Tuple, Callable, Any
+
+from django.conf import settings
+from django.dispatch import Signal
+
+from .metrics import plan_catalog_reloads
+
+logger = logging.getLogger(__name__)
+
+# enviado (com `plans`) sempre que o catálogo compila uma versão nova do plans.json, fora do lock de recarga
+plans_reloaded = Signal()
+
+
+def freeze(value: Any) -> Any:
+    """ Converte recursivamente dicts em MappingProxyType e listas em tuplas, pra que o valor seja compartilhável """
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """ Inverso do freeze: devolve uma cópia mutável (dicts e listas) do valor """
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Limite de requisições de uma feature em um plano, declarado no json em `rate_limits`:
+    `{"<feature>": {"requests": 100, "period": 60, "burst": 20}}`.
+
+    Attributes:
+        requests (int): quantidade de requisições permitidas por período.
+        period (float): duração do período, em segundos.
+        burst (int): quantidade de requisições que podem ser feitas de uma vez (padrão: `requests`).
+    """
+    requests: int
+    period: float
+    burst: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> 'RateLimit':
+        return cls(requests=int(data['requests']), period=float(data.get('period', 60)), burst=data.get('burst'))
+
+    @property
+    def capacity(self) -> int:
+        return int(self.burst or self.requests)
+
+    @property
+    def rate(self) -> float:
+        """ Fichas repostas por segundo """
+        return self.requests / self.period
+
+
+@dataclass(frozen=True, eq=False)
+class Plan:
+    """Plano/produto compilado a partir do arquivo de planos. É imutável e compartilhado entre todas as requisições do
+    processo, então nunca deve ser alterado por quem o consome.
+
+    Attributes:
+        id (str): id do produto no Stripe (ou 'free' para o plano free).
+        type (str): tipo do produto ('SIG' ou 'OT').
+        signature_exclusive (bool): indica se a assinatura é exclusiva.
+        value (float): valor do produto.
+        expiration_time (int): duração do produto em dias (None se não expira).
+        features (frozenset): ids das funcionalidades liberadas pelo produto.
+        quotas (Mapping): cotas liberadas pelo produto, indexadas pelo id do conteúdo.
+        credits (int): créditos concedidos pelo produto (soma dos conteúdos do tipo 'credits').
+        purchased_content (tuple): conteúdos do produto, exatamente como estão no json.
+        rate_limits (Mapping): limites de requisições por feature (RateLimit), indexados pelo id da feature.
+        raw (Mapping): produto inteiro, congelado, no formato do json.
+    """
+    id: str
+    type: Optional[str]
+    signature_exclusive: bool
+    value: Optional[float]
+    expiration_time: Optional[int]
+    features: FrozenSet[str]
+    quotas: Mapping[str, int]
+    credits: int
+    purchased_content: Tuple[Mapping[str, Any], ...]
+    rate_limits: Mapping[str, RateLimit]
+    raw: Mapping[str, Any]
+
+    @classmethod
+    def from_dict(cls, plan_id: str, data: dict) -> 'Plan':
+        """ Compila um produto do json em um objeto imutável """
+        raw = freeze(data)
+        purchased_content = raw.get('purchased_content', ())
+        return cls(
+            id=plan_id,
+            type=data.get('type'),
+            signature_exclusive=bool(data.get('signature_exclusive', False)),
+            value=data.get('value'),
+            expiration_time=data.get('expiration_time'),
+            features=frozenset(content.get('id') for content in purchased_content if content.get('type') == 'feature'),
+            quotas=MappingProxyType({content.get('id'): content.get('amount') for content in purchased_content if
+                                     content.get('type') == 'quota'}),
+            credits=sum(content.get('amount', 0) for content in purchased_content if content.get('type') == 'credits'),
+            purchased_content=purchased_content,
+            rate_limits=MappingProxyType({feature: RateLimit.from_dict(limit) for feature, limit in
+                                          raw.get('rate_limits', {}).items()}),
+            raw=raw,
+        )
+
+    def as_dict(self) -> dict:
+        """ Retorna uma cópia mutável do produto, no mesmo formato do json """
+        return thaw(self.raw)
+
+
+class WatchedJsonFile:
+    """
+    Arquivo json carregado uma única vez por processo. O arquivo só é lido de novo quando o mtime (ou tamanho) muda, e
+    só é recompilado quando o hash do conteúdo muda. O stat do arquivo é feito no máximo uma vez a cada
+    `check_interval` segundos, pra não pagar nem a syscall no caminho quente. Se uma edição deixar o arquivo inválido,
+    o último conteúdo válido continua em uso até o arquivo mudar de novo (na primeira carga, o erro é levantado).
+    """
+
+    def __init__(self, get_path: Callable[[], str], compile_data: Callable[[dict], Any], check_interval: float = None,
+                 on_reload: Callable[[Any], None] = None):
+        self._get_path = get_path
+        self._compile = compile_data
+        self._on_reload = on_reload
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        self._data = None
+        self._compiled = None
+        self._checked_at = 0.0
+        self.reloads = 0  # quantas vezes o arquivo foi (re)compilado nesse processo
+
+    @property
+    def check_interval(self) -> float:
+        if self._check_interval is not None:
+            return self._check_interval
+        return getattr(settings, 'SUBSCRIPTION_PLANS_CHECK_INTERVAL', 1.0)
+
+    def _is_fresh(self) -> bool:
+        return self._compiled is not None and time.monotonic() - self._checked_at < self.check_interval
+
+    def _refresh(self) -> bool:
+        """ Relê o arquivo se ele mudou. Retorna se o conteúdo foi recompilado """
+        path = self._get_path()
+        stat = os.stat(path)
+        self._checked_at = time.monotonic()
+        stat_key = (path, stat.st_mtime_ns, stat.st_size)
+        if stat_key == self._stat and self._compiled is not None:
+            return False
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha1(content).hexdigest()
+        if digest != self._digest or self._compiled is None:
+            try:
+                data = json.loads(content)
+                compiled = self._compile(data)
+            except (ValueError, TypeError, KeyError, AttributeError):
+                if self._compiled is None:
+                    raise
+                logger.exception('Arquivo %s inválido, mantendo o último conteúdo carregado.', path)
+                self._stat = stat_key
+                return False
+            self._compiled = compiled
+            self._data = data
+            self._digest = digest
+            self.reloads += 1
+            plan_catalog_reloads.inc(file=os.path.basename(path))
+            self._stat = stat_key
+            return True
+        self._stat = stat_key
+        return False
+
+    def get(self) -> Any:
+        """ Retorna o conteúdo compilado do arquivo, recarregando se ele mudou """
+        compiled = self._compiled
+        if not self._is_fresh():
+            with self._lock:
+                reloaded = not self._is_fresh() and self._refresh()
+                compiled = self._compiled
+            # fora do lock: quem recebe pode consultar o próprio arquivo de novo
+            if reloaded and self._on_reload is not None:
+                self._on_reload(compiled)
+        return compiled
+
+    def get_data(self) -> dict:
+        """ Retorna uma cópia mutável do json cru """
+        self.get()
+        return copy.deepcopy(self._data)
+
+    @property
+    def digest(self) -> Optional[str]:
+        """ Hash do conteúdo atualmente carregado """
+        self.get()
+        return self._digest
+
+    def invalidate(self) -> None:
+        """ Força a releitura do arquivo no próximo acesso """
+        with self._lock:
+            self._stat = None
+            self._compiled = None
+
+
+def get_plans_file_path() -> str:
+    """ Caminho do arquivo de planos do projeto: <BASE_DIR>/subscription/plans.json """
+    return os.path.join(settings.BASE_DIR, 'subscription/plans.json')
+
+
+def get_subscriptions_file_path() -> str:
+    """ Caminho do arquivo de períodos de assinatura que acompanha o pacote """
+    return os.path.join(os.path.dirname(__file__), 'subscriptions.json')
+
+
+def _compile_plans(data: dict) -> Mapping[str, Plan]:
+    return MappingProxyType({plan_id: Plan.from_dict(plan_id, plan) for plan_id, plan in data.items()})
+
+
+def _compile_subscriptions(data: dict) -> Mapping[str, Mapping[str, Any]]:
+    return freeze(data)
+
+
+class PlanCatalog:
+    """
+    Catálogo de planos do processo. Junta os produtos do `plans.json` do projeto e os períodos de assinatura do
+    `subscriptions.json` do pacote, carregando cada arquivo uma única vez e recarregando apenas quando eles mudam.
+    """
+
+    def __init__(self):
+        self.products = WatchedJsonFile(get_plans_file_path, _compile_plans,
+                                        on_reload=lambda plans: plans_reloaded.send(sender=PlanCatalog, plans=plans))
+        self.subscriptions = WatchedJsonFile(get_subscriptions_file_path, _compile_subscriptions)
+
+    @property
+    def plans(self) -> Mapping[str, Plan]:
+        """ Todos os produtos compilados, indexados pelo stripe_id """
+        return self.products.get()
+
+    def get_plan(self, plan_id: str) -> Plan:
+        """ Retorna o produto compilado. Dá KeyError se ele não existir no json, assim como o acesso direto ao dict """
+        return self.products.get()[plan_id]
+
+    def get_subscription(self, subscription_id: str) -> Mapping[str, Any]:
+        """ Retorna um período de assinatura (somente leitura) do subscriptions.json """
+        return self.subscriptions.get()[subscription_id]
+
+    @property
+    def version(self) -> Tuple[Optional[str], Optional[str]]:
+        """ Identifica o conteúdo carregado dos dois arquivos. Muda sempre que algum deles é recompilado """
+        return self.products.digest, self.subscriptions.digest
+
+    @property
+    def reloads(self) -> int:
+        return self.products.reloads + self.subscriptions.reloads
+
+    def invalidate(self) -> None:
+        self.products.invalidate()
+        self.subscriptions.invalidate()
+
+
+plan_catalog = PlanCatalog()
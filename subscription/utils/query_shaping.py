@@ -0,0 +1,82 @@
+from dataclasses import dataclass
+from typing import Optional, FrozenSet, Type
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from rest_framework import serializers
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    """Formato da consulta necessária pra serializar um modelo.
+
+    Attributes:
+        only (frozenset): colunas lidas pelo serializer (None se não der pra saber, e aí todas são lidas).
+        select_related (frozenset): relações diretas (FK/OneToOne) atravessadas pelo serializer.
+        prefetch_related (frozenset): relações múltiplas (reversas/M2M) lidas pelo serializer.
+    """
+    only: Optional[FrozenSet[str]]
+    select_related: FrozenSet[str]
+    prefetch_related: FrozenSet[str]
+
+
+_shapes = {}
+
+
+def _resolve_related_path(model: Type[models.Model], attrs: list) -> Optional[str]:
+    """ Caminho (no formato do select_related) das relações diretas atravessadas por um source com pontos """
+    path = []
+    for attr in attrs:
+        try:
+            field = model._meta.get_field(attr)
+        except FieldDoesNotExist:
+            break
+        if not (field.is_relation and (field.many_to_one or field.one_to_one) and field.concrete):
+            break
+        path.append(attr)
+        model = field.related_model
+    return '__'.join(path) or None
+
+
+def get_query_shape(serializer_class: Type[serializers.BaseSerializer], model: Type[models.Model]) -> QueryShape:
+    """
+    Deriva do `fields` do serializer as colunas que precisam ser lidas e as relações que precisam ser buscadas junto.
+    O resultado é calculado uma vez por par (serializer, modelo). Campos que o serializer não consegue mapear pra uma
+    coluna (SerializerMethodField, source='*', propriedades do modelo) desligam o corte de colunas, já que não dá pra
+    saber o que eles leem.
+    """
+    key = (serializer_class, model)
+    if key in _shapes:
+        return _shapes[key]
+    only, select_related, prefetch_related = set(), set(), set()
+    prune = True
+    for name, field in serializer_class().fields.items():
+        if field.write_only:
+            continue
+        if isinstance(field, serializers.SerializerMethodField) or field.source == '*':
+            prune = False
+            continue
+        attrs = field.source.split('.')
+        try:
+            model_field = model._meta.get_field(attrs[0])
+        except FieldDoesNotExist:
+            # propriedade ou método do modelo
+            prune = False
+            continue
+        if model_field.is_relation and (model_field.many_to_many or model_field.one_to_many):
+            prefetch_related.add(attrs[0])
+            continue
+        if not model_field.concrete:
+            # lado reverso de um OneToOne
+            prune = False
+            if path := _resolve_related_path(model, attrs):
+                select_related.add(path)
+            continue
+        only.add(attrs[0])
+        nested = isinstance(field, serializers.BaseSerializer) and not isinstance(field, serializers.ListSerializer)
+        if model_field.is_relation and (nested or len(attrs) > 1):
+            select_related.add(_resolve_related_path(model, attrs))
+    shape = QueryShape(only=frozenset(only) if prune else None, select_related=frozenset(select_related),
+                       prefetch_related=frozenset(prefetch_related))
+    _shapes[key] = shape
+    return shape
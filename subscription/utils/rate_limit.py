@@ -0,0 +1,113 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .api_helpers import get_custom_feature_limit_reached_http_code_and_message
+from .metrics import rate_limit_rejections
+from .plans import RateLimit
+
+
+class FeatureLimitReached(APIException):
+    """ Exceção levantada quando o cliente atinge o limite de requisições da feature. O DRF converte o `wait` no
+    header Retry-After """
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+
+    def __init__(self, wait: float):
+        payload = get_custom_feature_limit_reached_http_code_and_message()
+        super().__init__(detail=payload['message'], code=payload['code'])
+        self.wait = max(1, math.ceil(wait))
+
+
+class LocalTokenBucketStore:
+    """ Token buckets em memória (por processo). É o backend padrão: não custa nenhuma ida à rede, mas cada worker
+    aplica o limite de forma independente """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, limit: RateLimit, cost: int = 1) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (limit.capacity, now))
+            tokens = min(limit.capacity, tokens + (now - updated_at) * limit.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (cost - tokens) / limit.rate
+
+
+class CacheWindowStore:
+    """ Contadores por janela de tempo no backend de cache do Django, compartilhados entre os workers. Usa o `incr`
+    atômico do cache, então o limite é exato entre workers (com a granularidade da janela, `period` segundos). Cada
+    janela libera `requests` requisições, então o `burst` do token bucket não se aplica aqui """
+
+    def __init__(self, cache_alias: str):
+        self.cache_alias = cache_alias
+
+    def consume(self, key: str, limit: RateLimit, cost: int = 1) -> Tuple[bool, float]:
+        cache = caches[self.cache_alias]
+        now = time.time()
+        window = int(now // limit.period)
+        cache_key = f'subscription:rl:{key}:{window}'
+        cache.add(cache_key, 0, int(limit.period) + 1)
+        try:
+            count = cache.incr(cache_key, cost)
+        except ValueError:
+            # a chave expirou entre o add e o incr
+            cache.add(cache_key, cost, int(limit.period) + 1)
+            count = cost
+        allowed = count <= limit.requests
+        return allowed, 0 if allowed else (window + 1) * limit.period - now
+
+
+class RateLimiter:
+    """ Aplica os limites de requisições dos planos. Usa o backend de cache `SUBSCRIPTION_RATE_LIMIT_CACHE`, se
+    configurado, ou token buckets em memória """
+
+    def __init__(self):
+        self._local = LocalTokenBucketStore()
+
+    @property
+    def rejections(self) -> int:
+        return rate_limit_rejections.total()
+
+    def reset(self) -> None:
+        """ Descarta os token buckets em memória """
+        self._local = LocalTokenBucketStore()
+
+    def get_store(self):
+        cache_alias = getattr(settings, 'SUBSCRIPTION_RATE_LIMIT_CACHE', None)
+        return CacheWindowStore(cache_alias) if cache_alias else self._local
+
+    def consume(self, customer_id: int, feature: str, limit: RateLimit, cost: int = 1) -> Tuple[bool, float]:
+        """ Consome uma requisição do limite do cliente na feature
+
+        Returns:
+            Tupla (permitido, segundos até a próxima requisição ser permitida)
+        """
+        allowed, wait = self.get_store().consume(f'{customer_id}:{feature}', limit, cost)
+        if not allowed:
+            rate_limit_rejections.inc(feature=feature)
+        return allowed, wait
+
+    def check(self, customer_id: int, feature: str, limit: RateLimit, cost: int = 1) -> None:
+        """ Como o consume, mas levanta FeatureLimitReached se o limite foi atingido """
+        allowed, wait = self.consume(customer_id, feature, limit, cost)
+        if not allowed:
+            raise FeatureLimitReached(wait)
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,224 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import LocalLRUCache, MISSING
+from .metrics import metrics
+
+# quanto voltar no tempo a cada atualização incremental, pra pegar revogações de transações que commitaram atrasadas
+INCREMENTAL_MARGIN = timedelta(seconds=60)
+
+# momento da emissão em microssegundos. O iat do JWT só tem segundos, o que não basta pra separar um token emitido logo
+# depois da revogação do usuário (ex.: o login depois da troca de senha) de um emitido logo antes, no mesmo segundo
+ISSUED_AT_CLAIM = 'iat_us'
+
+
+def get_token_key(jti: str) -> str:
+    return f'jti:{jti}'
+
+
+def get_user_key(user_id) -> str:
+    return f'user:{user_id}'
+
+
+def get_timestamp_us(moment: datetime) -> int:
+    # sem passar por float, que não tem precisão pra microssegundos nessa escala
+    return int(moment.replace(microsecond=0).timestamp()) * 1000000 + moment.microsecond
+
+
+def set_issued_at(token) -> None:
+    """ Grava no token o momento da emissão com precisão de microssegundos (ver ISSUED_AT_CLAIM). O token de acesso
+    gerado a partir de um refresh herda a claim dele """
+    token[ISSUED_AT_CLAIM] = get_timestamp_us(timezone.now())
+
+
+class BloomFilter:
+    """
+    Filtro de Bloom: um conjunto compacto que responde "talvez contenha" ou "com certeza não contém". Com `capacity`
+    chaves, a chance de um falso positivo é de `error_rate`. Ocupa ~1,8 bytes por chave com error_rate de 0,1%.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # double hashing: as k posições saem de dois hashes de 64 bits
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """
+    Lista de tokens revogados do processo. As revogações ficam na tabela RevokedToken; cada worker mantém um filtro de
+    Bloom com as chaves dela e só consulta o BD quando o filtro acusa a chave do token (o próprio jti ou o usuário
+    dele). Como a grande maioria dos tokens não está revogada, a verificação normalmente não sai da memória.
+
+    O filtro recebe as revogações novas da tabela no máximo a cada `SUBSCRIPTION_REVOCATION_REFRESH_INTERVAL` segundos
+    (uma consulta incremental), o que limita o atraso pra um worker enxergar uma revogação feita em outro. No próprio
+    processo a revogação vale na hora. A cada `SUBSCRIPTION_REVOCATION_REBUILD_INTERVAL` segundos o filtro é refeito do
+    zero, sem as revogações que já expiraram. O resultado das consultas ao BD fica em um LRU até a chave ser revogada de
+    novo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filter = None
+        self._since = None
+        self._refreshed_at = 0.0
+        self._rebuilt_at = 0.0
+        self._lookups = LocalLRUCache(10000)
+        self.queries = 0  # consultas ao BD feitas por causa de um acerto no filtro
+
+    @property
+    def refresh_interval(self) -> float:
+        return getattr(settings, 'SUBSCRIPTION_REVOCATION_REFRESH_INTERVAL', 5)
+
+    @property
+    def rebuild_interval(self) -> float:
+        return getattr(settings, 'SUBSCRIPTION_REVOCATION_REBUILD_INTERVAL', 300)
+
+    @property
+    def error_rate(self) -> float:
+        return getattr(settings, 'SUBSCRIPTION_REVOCATION_FALSE_POSITIVE_RATE', 0.001)
+
+    def _rebuild(self) -> None:
+        from subscription.models import RevokedToken
+        now = timezone.now()
+        keys = list(RevokedToken.objects.filter(expires_at__gt=now).values_list('key', flat=True))
+        bloom = BloomFilter(max(len(keys) * 2, 1000), self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        self._filter, self._since = bloom, now
+        self._lookups.clear()
+        self._rebuilt_at = self._refreshed_at = time.monotonic()
+
+    def _refresh(self) -> None:
+        from subscription.models import RevokedToken
+        now = timezone.now()
+        keys = RevokedToken.objects.filter(expires_at__gt=now, revoked_at__gte=self._since - INCREMENTAL_MARGIN) \
+            .values_list('key', flat=True)
+        for key in keys:
+            self._filter.add(key)
+            self._lookups.delete(key)
+        self._since = now
+        self._refreshed_at = time.monotonic()
+
+    def get_filter(self) -> BloomFilter:
+        """ Retorna o filtro do processo, atualizando-o se o intervalo já passou """
+        age = time.monotonic() - self._refreshed_at
+        if self._filter is None or age >= self.refresh_interval:
+            with self._lock:
+                now = time.monotonic()
+                if self._filter is None or now - self._rebuilt_at >= self.rebuild_interval or \
+                        self._filter.count > self._filter.capacity:
+                    self._rebuild()
+                elif now - self._refreshed_at >= self.refresh_interval:
+                    self._refresh()
+        return self._filter
+
+    def _lookup(self, keys: list) -> dict:
+        """ Busca no BD (ou no LRU) as revogações das chaves: chave -> revoked_before (None pra revogação de jti) """
+        found, missing = {}, []
+        for key in keys:
+            value = self._lookups.get(key, MISSING)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            from subscription.models import RevokedToken
+            self.queries += 1
+            rows = dict(RevokedToken.objects.filter(key__in=missing, expires_at__gt=timezone.now())
+                        .values_list('key', 'revoked_before'))
+            for key in missing:
+                # False marca uma chave que não está revogada (falso positivo do filtro)
+                found[key] = rows.get(key, False)
+                self._lookups.set(key, found[key])
+        return found
+
+    def is_revoked(self, token) -> bool:
+        """ Verifica se o token foi revogado, por jti ou por revogação de todos os tokens do usuário """
+        bloom = self.get_filter()
+        keys = [key for key in (get_token_key(token.get(api_settings.JTI_CLAIM)),
+                                get_user_key(token.get(api_settings.USER_ID_CLAIM))) if key in bloom]
+        if not keys:
+            return False
+        for key, revoked_before in self._lookup(keys).items():
+            if revoked_before is False:
+                continue
+            if revoked_before is None:
+                return True
+            # os tokens emitidos até a revogação do usuário
+            issued_at = token.get(ISSUED_AT_CLAIM)
+            if issued_at is not None:
+                if issued_at <= get_timestamp_us(revoked_before):
+                    return True
+            # token sem a claim (ex.: emitido fora do login): o iat só tem segundos, então não dá pra saber se um token
+            # do mesmo segundo veio antes ou depois da revogação, e ele também é revogado
+            elif token.get('iat', 0) <= int(revoked_before.timestamp()):
+                return True
+        return False
+
+    def add(self, keys: Iterable[str]) -> None:
+        """ Revogação feita no próprio processo: vale na hora, sem esperar a próxima atualização """
+        bloom = self.get_filter()
+        for key in keys:
+            bloom.add(key)
+            self._lookups.delete(key)
+
+    def reset(self) -> None:
+        """ Descarta o filtro, que será refeito do BD no próximo uso """
+        with self._lock:
+            self._filter = None
+            self._lookups.clear()
+
+
+revocation_list = RevocationList()
+
+
+def collect_revocation_metrics():
+    yield 'subscription_revocation_queries_total', 'counter', \
+        'Consultas ao BD feitas por acertos (verdadeiros ou falsos) no filtro de revogação.', \
+        [({}, revocation_list.queries)]
+
+
+metrics.register_collector(collect_revocation_metrics)
+
+
+def check_not_revoked(token) -> None:
+    """ Levanta InvalidToken se o token (de acesso ou de refresh) tiver sido revogado """
+    if revocation_list.is_revoked(token):
+        raise InvalidToken(_('Token revogado'))
+
+
+class RevocationJWTAuthentication(JWTAuthentication):
+    """ JWTAuthentication que também recusa os tokens revogados (ver RevocationList) """
+
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        check_not_revoked(token)
+        return token
@@ -0,0 +1,11 @@
+from typing import Tuple
+
+
+def parse_purchase_description(description: str) -> Tuple[int, str]:
+    """ Extrai o cliente e o produto da descrição de um pagamento do Stripe, no formato `<client_id>-<product_id>`
+
+    Returns:
+        Tupla (id do cliente, id do produto no Stripe)
+    """
+    client_id, product_id = description.split('-', 1)
+    return int(client_id), product_id
@@ -0,0 +1,171 @@
+import random
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.db import transaction, connection
+from django.db.models import Max
+from django.utils import timezone
+
+from .features import feature_registry
+from .plans import plan_catalog, Plan
+
+
+class SyntheticDataGenerator:
+    """
+    Gera volumes realistas de clientes, perfis e conteúdos pagos, pra reproduzir localmente o comportamento de produção
+    (planos de consulta de `get_active_signature`, listagens paginadas, varreduras...).
+
+    Cada cliente tem um dono, `profiles` perfis além do dono e um histórico de `history` conteúdos pagos espalhados
+    pelos últimos `years` anos, com planos sorteados do catálogo: assinaturas exclusivas vencidas (uma depois da
+    outra), assinaturas não exclusivas (vencidas ou sem vencimento) e compras pontuais. Uma fração `active_ratio` dos
+    clientes termina com uma assinatura exclusiva ativa; o resto fica no plano free virtual.
+
+    Tudo é gravado com bulk_create, em blocos de no máximo `chunk_size` linhas (uma transação por bloco de clientes),
+    então a memória usada não depende do volume total. O sorteio usa um `random.Random(seed)`, então a mesma seed gera
+    os mesmos dados (as datas são relativas ao momento da geração). Os emails levam o `prefix` e a seed, pra que
+    gerações com seeds diferentes possam conviver no mesmo BD.
+    """
+
+    def __init__(self, customers: int, profiles: int = 5, history: int = 100, seed: int = 0, chunk_size: int = 5000,
+                 prefix: str = 'synthetic', years: int = 5, active_ratio: float = 0.8):
+        self.customers = customers
+        self.profiles = profiles
+        self.history = history
+        self.seed = seed
+        self.chunk_size = max(chunk_size, 1)
+        self.prefix = prefix
+        self.years = years
+        self.active_ratio = active_ratio
+        self.random = random.Random(seed)
+        self.now = timezone.now()
+        plans = list(plan_catalog.plans.values())
+        self.exclusive_plans = [plan for plan in plans if plan.type == 'SIG' and plan.signature_exclusive]
+        self.addon_plans = [plan for plan in plans if plan.type == 'SIG' and not plan.signature_exclusive]
+        self.one_time_plans = [plan for plan in plans if plan.type == 'OT']
+        if not self.exclusive_plans:
+            raise ValueError('O catálogo de planos não tem nenhuma assinatura exclusiva pra gerar os dados.')
+        self._masks = {}
+
+    def get_email(self, customer: int, profile: Optional[int] = None) -> str:
+        suffix = '' if profile is None else f'-{profile}'
+        return f'{self.prefix}-{self.seed}-{customer}{suffix}@example.com'
+
+    def get_mask(self, features: frozenset) -> int:
+        if features not in self._masks:
+            self._masks[features] = feature_registry.get_mask(features)
+        return self._masks[features]
+
+    def build_profile(self, user_id: int, customer_id: int, plan: Plan, allowed_actions: str = None) -> 'UserProfile':
+        """ Perfil com um subconjunto sorteado das features do plano (o dono recebe todas) """
+        from subscription.models import AllowedActions, UserProfile
+        features = sorted(plan.features)
+        if allowed_actions is None:
+            allowed_actions = self.random.choice(AllowedActions.values)
+            features = [feature for feature in features if self.random.random() < 0.7]
+        return UserProfile(user_id=user_id, client_id=customer_id, allowed_actions=allowed_actions,
+                           available_features=','.join(features), features_mask=self.get_mask(frozenset(features)))
+
+    def build_history(self, customer_id: int) -> List['PaidContent']:
+        """ Histórico de conteúdos pagos de um cliente, do mais antigo pro mais recente """
+        from subscription.models import PaidContent
+        rows, active = [], None
+        end = self.now
+        if self.history and self.random.random() < self.active_ratio:
+            plan = self.random.choice(self.exclusive_plans)
+            start_date = self.now - timedelta(days=self.random.randint(0, max((plan.expiration_time or 30) - 1, 0)))
+            active = PaidContent.build_purchase(plan, customer_id, start_date=start_date)
+            if plan.id == 'free':
+                # a assinatura free sem vencimento é única por cliente (paidcontent_unique_open_free)
+                active.expiration_date = active.expiration_date or self.now + timedelta(days=30)
+            end = start_date
+        expired = self.history - 1 if active else self.history
+        # cada linha ocupa uma fatia do período até o início da assinatura ativa, então as assinaturas exclusivas
+        # vencidas nunca se sobrepõem
+        step = timedelta(days=365 * self.years) / max(expired, 1)
+        start = end - step * expired
+        for _ in range(expired):
+            draw = self.random.random()
+            if draw < 0.2 and self.one_time_plans:
+                plan = self.random.choice(self.one_time_plans)
+                rows.append(PaidContent(customer_id=customer_id, stripe_id=plan.id, value=plan.value, start_date=start,
+                                        type=PaidContent.Types.ONE_TIME_ONLY))
+            elif draw < 0.3 and self.addon_plans:
+                plan = self.random.choice(self.addon_plans)
+                # algumas assinaturas não exclusivas continuam ativas, sem vencimento
+                expiration_date = None if self.random.random() < 0.1 else start + step
+                rows.append(PaidContent(customer_id=customer_id, stripe_id=plan.id, type=PaidContent.Types.SIGNATURE,
+                                        value=plan.value, start_date=start, expiration_date=expiration_date))
+            else:
+                plan = self.random.choice(self.exclusive_plans)
+                rows.append(PaidContent(customer_id=customer_id, stripe_id=plan.id, type=PaidContent.Types.SIGNATURE,
+                                        is_exclusive=True, value=plan.value, start_date=start,
+                                        expiration_date=start + step))
+            start += step
+        if active:
+            rows.append(active)
+        return rows
+
+    def insert(self, model, objects: list, key: str) -> Dict:
+        """ Grava os objetos com bulk_create e retorna o mapa `key` -> pk deles """
+        if connection.features.can_return_rows_from_bulk_insert:
+            model.objects.bulk_create(objects, batch_size=self.chunk_size)
+            return {getattr(obj, key): obj.pk for obj in objects}
+        # o BD não devolve as pks do bulk_create (ex.: SQLite no Django 3.2): elas são buscadas pelo intervalo de ids
+        # (um `key__in` estouraria o limite de parâmetros do SQLite em blocos grandes)
+        last_id = model.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        model.objects.bulk_create(objects, batch_size=self.chunk_size)
+        return dict(model.objects.filter(id__gt=last_id).values_list(key, 'id'))
+
+    def generate_chunk(self, first: int, last: int) -> Dict[str, int]:
+        """ Gera os clientes de `first` até `last` (exclusivo), com usuários, perfis e histórico """
+        from subscription.models import SystemUser, Customer, PaidContent, UserProfile
+        emails = [self.get_email(number) for number in range(first, last)]
+        members = {number: [self.get_email(number, profile) for profile in range(self.profiles)]
+                   for number in range(first, last)}
+        all_emails = emails + [email for group in members.values() for email in group]
+        # senha inutilizável: os usuários gerados não fazem login (e o hashing de milhões de senhas levaria horas)
+        user_ids = self.insert(SystemUser, [SystemUser(email=email, first_name='Synthetic',
+                                                       password=UNUSABLE_PASSWORD_PREFIX) for email in all_emails],
+                               'email')
+        customer_ids = self.insert(Customer, [Customer(name=f'Synthetic {number}', owner_id=user_ids[email])
+                                              for number, email in zip(range(first, last), emails)], 'owner_id')
+
+        profiles, history = [], []
+        for number, email in zip(range(first, last), emails):
+            customer_id = customer_ids[user_ids[email]]
+            rows = self.build_history(customer_id)
+            # os perfis recebem as features do plano atual do cliente (ou de um plano exclusivo qualquer)
+            plan = plan_catalog.plans.get(rows[-1].stripe_id) if rows and rows[-1].is_exclusive else None
+            plan = plan or self.random.choice(self.exclusive_plans)
+            profiles.append(self.build_profile(user_ids[email], customer_id, plan, 'ADM'))
+            profiles.extend(self.build_profile(user_ids[member], customer_id, plan) for member in members[number])
+            history.extend(rows)
+        UserProfile.objects.bulk_create(profiles, batch_size=self.chunk_size)
+        PaidContent.objects.bulk_create(history, batch_size=self.chunk_size)
+        return {'customers': len(emails), 'users': len(all_emails), 'profiles': len(profiles),
+                'paid_contents': len(history)}
+
+    def generate(self, progress=None) -> Dict[str, int]:
+        """
+        Gera todos os clientes, em blocos de até `chunk_size` linhas
+
+        Args:
+            progress: função chamada com os totais acumulados depois de cada bloco
+        """
+        from subscription.models import SystemUser
+        if SystemUser.objects.filter(email=self.get_email(0)).exists():
+            raise ValueError(f'Já existem dados gerados com o prefixo {self.prefix} e a seed {self.seed}.')
+        # as máscaras dos perfis só incluem features registradas
+        feature_registry.register_catalog()
+        per_customer = max(self.history, self.profiles + 1)
+        customers_per_chunk = max(self.chunk_size // per_customer, 1)
+        totals = {'customers': 0, 'users': 0, 'profiles': 0, 'paid_contents': 0}
+        for first in range(0, self.customers, customers_per_chunk):
+            with transaction.atomic():
+                counts = self.generate_chunk(first, min(first + customers_per_chunk, self.customers))
+            for key, value in counts.items():
+                totals[key] += value
+            if progress is not None:
+                progress(totals)
+        return totals
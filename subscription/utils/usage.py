@@ -0,0 +1,247 @@
+import itertools
+import threading
+from collections import defaultdict
+from datetime import date
+from typing import Tuple, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from onipkg_contrib.log_helper import log_error
+
+from .cache import LocalLRUCache
+
+
+class _Shard:
+    """ Um pedaço dos contadores, com lock próprio. Cada thread escreve o uso sempre no mesmo shard; os créditos de um
+    cliente ficam sempre no shard dele, pra que a verificação de saldo e o registro do gasto aconteçam sob um único lock
+    """
+    __slots__ = ('lock', 'usage', 'credits', 'in_flight', 'generation', 'operations')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.usage = defaultdict(int)  # (customer_id, feature) -> uso acumulado
+        self.credits = defaultdict(int)  # customer_id -> créditos gastos e ainda não enviados pro BD
+        self.in_flight = defaultdict(int)  # customer_id -> créditos de um flush que ainda não commitou
+        self.generation = 0  # muda a cada flush commitado: saldos lidos antes disso já não valem
+        self.operations = 0
+
+    def swap(self) -> Tuple[dict, dict]:
+        """ Tira o acumulado pra gravar no BD. Os créditos continuam contando como pendentes (in_flight) até o flush
+        terminar (ver UsageCounters._settle) """
+        with self.lock:
+            usage, credits = self.usage, self.credits
+            self.usage, self.credits, self.operations = defaultdict(int), defaultdict(int), 0
+            for customer_id, amount in credits.items():
+                self.in_flight[customer_id] += amount
+        return usage, credits
+
+
+class UsageCounters:
+    """
+    Contadores de uso em memória com escrita adiada (write-behind). Em vez de uma escrita no BD por chamada de API, o
+    uso por cliente/feature e os créditos gastos são acumulados em memória e gravados em lote por uma thread de fundo:
+    um único UPSERT em UsageCounter e um único UPDATE nos saldos de créditos por flush.
+
+    Os contadores são divididos em shards, então threads diferentes não disputam o mesmo lock: o uso vai pro shard da
+    thread (um por grupo de threads) e os créditos de um cliente ficam sempre no mesmo shard (pelo id dele). O flush
+    acontece a cada `SUBSCRIPTION_USAGE_FLUSH_INTERVAL` segundos, ou antes, quando o número de operações pendentes passa
+    de `SUBSCRIPTION_USAGE_FLUSH_THRESHOLD`.
+
+    Como os débitos de créditos só chegam ao BD no flush, a verificação de saldo usa o último saldo lido do BD menos o
+    que está pendente em memória, incluindo o que está sendo gravado por um flush em andamento. Os saldos lidos ficam
+    num LRU de `SUBSCRIPTION_USAGE_BALANCE_CACHE_SIZE` clientes, por no máximo um intervalo de flush. Entre workers
+    diferentes isso pode deixar gastar até `SUBSCRIPTION_USAGE_OVERDRAFT` créditos além do saldo, que é a tolerância
+    configurada; no flush, o excedente é perdoado (ver CreditBalance.debit_many).
+    """
+
+    def __init__(self, shard_count: int = None):
+        self._shards = [_Shard() for _ in range(shard_count or getattr(settings, 'SUBSCRIPTION_USAGE_SHARDS', 16))]
+        self._shard_ids = itertools.count()
+        self._local = threading.local()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # customer_id -> saldo no BD
+        self._balances = LocalLRUCache(getattr(settings, 'SUBSCRIPTION_USAGE_BALANCE_CACHE_SIZE', 10000))
+        self.flushes = 0
+
+    @property
+    def flush_interval(self) -> float:
+        return getattr(settings, 'SUBSCRIPTION_USAGE_FLUSH_INTERVAL', 5)
+
+    @property
+    def flush_threshold(self) -> int:
+        return getattr(settings, 'SUBSCRIPTION_USAGE_FLUSH_THRESHOLD', 1000)
+
+    @property
+    def overdraft(self) -> int:
+        return getattr(settings, 'SUBSCRIPTION_USAGE_OVERDRAFT', 0)
+
+    def _get_shard(self) -> _Shard:
+        index = getattr(self._local, 'shard', None)
+        if index is None:
+            index = self._local.shard = next(self._shard_ids) % len(self._shards)
+        return self._shards[index]
+
+    def _get_customer_shard(self, customer_id: int) -> _Shard:
+        return self._shards[customer_id % len(self._shards)]
+
+    def _wake_if_full(self, operations: int) -> None:
+        if operations * len(self._shards) >= self.flush_threshold:
+            self._wakeup.set()
+
+    def add(self, customer_id: int, feature: str, amount: int = 1) -> None:
+        """ Registra o uso de uma feature por um cliente """
+        self._ensure_thread()
+        shard = self._get_shard()
+        with shard.lock:
+            shard.usage[(customer_id, feature)] += amount
+            shard.operations += 1
+            operations = shard.operations
+        self._wake_if_full(operations)
+
+    def _get_balance(self, customer_id: int, shard: _Shard) -> Tuple[int, int]:
+        """ Saldo do cliente no BD (do LRU, se lido há menos de um intervalo de flush) e a geração do shard em que ele
+        vale. Quem usa o saldo confere a geração sob o lock do shard: se um flush commitou no meio, o saldo está
+        velho """
+        from subscription.models import CreditBalance
+        generation = shard.generation
+        balance = self._balances.get(customer_id)
+        if balance is None:
+            balance = CreditBalance.get_balance(customer_id)
+            with shard.lock:
+                if shard.generation == generation:
+                    self._balances.set(customer_id, balance, self.flush_interval)
+        return balance, generation
+
+    @staticmethod
+    def _pending(shard: _Shard, customer_id: int) -> int:
+        return shard.credits.get(customer_id, 0) + shard.in_flight.get(customer_id, 0)
+
+    def get_pending_credits(self, customer_id: int) -> int:
+        """ Créditos gastos pelo cliente nesse processo que ainda não foram debitados no BD """
+        shard = self._get_customer_shard(customer_id)
+        with shard.lock:
+            return self._pending(shard, customer_id)
+
+    def get_available_credits(self, customer_id: int) -> int:
+        """ Saldo do cliente no BD (relido no máximo uma vez por intervalo de flush) menos os créditos pendentes """
+        shard = self._get_customer_shard(customer_id)
+        while True:
+            balance, generation = self._get_balance(customer_id, shard)
+            with shard.lock:
+                if shard.generation == generation:
+                    return balance - self._pending(shard, customer_id)
+
+    def try_spend(self, customer_id: int, credits: int, feature: str = None) -> bool:
+        """ Gasta créditos do cliente (e registra o uso da feature, se informada), respeitando a tolerância de saldo
+        negativo. A verificação e o registro acontecem sob o lock do shard do cliente, então gastos concorrentes no
+        mesmo processo não passam juntos pela verificação. O débito no BD acontece no próximo flush
+
+        Returns:
+            True se o gasto foi aceito
+        """
+        self._ensure_thread()
+        shard = self._get_customer_shard(customer_id)
+        while True:
+            balance, generation = self._get_balance(customer_id, shard)
+            with shard.lock:
+                if shard.generation != generation:
+                    continue
+                if balance - self._pending(shard, customer_id) - credits < -self.overdraft:
+                    return False
+                if feature is not None:
+                    shard.usage[(customer_id, feature)] += 1
+                shard.credits[customer_id] += credits
+                shard.operations += 1
+                operations = shard.operations
+            break
+        self._wake_if_full(operations)
+        return True
+
+    def _settle(self, shard: _Shard, usage: dict, credits: dict, committed: bool) -> None:
+        """ Encerra o flush no shard: os créditos deixam de estar em andamento e, se o flush commitou, os saldos lidos
+        antes dele são descartados; senão, tudo volta pros contadores pra tentar de novo no próximo flush """
+        with shard.lock:
+            for customer_id, amount in credits.items():
+                shard.in_flight[customer_id] -= amount
+                if not shard.in_flight[customer_id]:
+                    del shard.in_flight[customer_id]
+                if committed:
+                    self._balances.delete(customer_id)
+                else:
+                    shard.credits[customer_id] += amount
+            if not committed:
+                for key, amount in usage.items():
+                    shard.usage[key] += amount
+            elif credits:
+                shard.generation += 1
+
+    def flush(self) -> None:
+        """ Grava no BD tudo o que está acumulado em memória """
+        from subscription.models import UsageCounter, CreditBalance
+        with self._flush_lock:
+            swapped = [(shard, *shard.swap()) for shard in self._shards]
+            usage, credits = defaultdict(int), defaultdict(int)
+            for _, shard_usage, shard_credits in swapped:
+                for key, amount in shard_usage.items():
+                    usage[key] += amount
+                for customer_id, amount in shard_credits.items():
+                    credits[customer_id] += amount
+            if not usage and not credits:
+                return
+            committed = False
+            try:
+                with transaction.atomic():
+                    if usage:
+                        UsageCounter.increment_many(usage)
+                    if credits:
+                        CreditBalance.debit_many(credits, reason='usage')
+                committed = True
+            except Exception as e:
+                log_error(e)
+            for shard, shard_usage, shard_credits in swapped:
+                self._settle(shard, shard_usage, shard_credits, committed)
+            if committed:
+                self.flushes += 1
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                # a thread de flush tem a própria conexão com o BD, que não passa pelo ciclo de requisição do Django
+                connection.close_if_unusable_or_obsolete()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None or self._stopped.is_set():
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='subscription-usage-flush', daemon=True)
+                self._thread.start()
+
+    def shutdown(self) -> None:
+        """ Para a thread de flush e grava o que estiver pendente (chamado no encerramento do processo) """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+def is_write_behind_enabled() -> bool:
+    return getattr(settings, 'SUBSCRIPTION_USAGE_WRITE_BEHIND', False)
+
+
+def get_usage_period() -> date:
+    """ Período dos contadores de uso (um por dia, atribuído no momento do flush) """
+    return timezone.localdate()
+
+
+usage_counters = UsageCounters()
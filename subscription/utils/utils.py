@@ -1,15 +1,13 @@
-import os
-import json
-
 from django.db import models
 
+from .plans import plan_catalog
+
 
 def get_plans():
-    """Carrega todos os planos do arquivo json e retorna um dicionário com os planos.
+    """Retorna um dicionário com os planos do arquivo json. O arquivo é carregado uma única vez pelo catálogo de planos,
+    então o dicionário retornado é uma cópia que pode ser alterada à vontade.
     """
-    with open(os.path.join(os.path.dirname(__file__), 'subscriptions.json')) as f:
-        plans = json.load(f)
-    return plans
+    return plan_catalog.subscriptions.get_data()
 
 
 class BasePermissionClass(models.Model):